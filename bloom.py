@@ -0,0 +1,43 @@
+import hashlib
+import json
+import math
+
+
+class BloomFilter(object):
+    """a compact bit array answering 'maybe present' / 'surely absent' for a set of keys.
+        hashing goes through md5 so that the filter built on the client gives the
+        same answers on every data node (python's hash() is salted per process)"""
+
+    def __init__(self, m, k, bits=None):
+        self.m = m
+        self.k = k
+        self.bits = bits if bits is not None else bytearray((m + 7) // 8)
+
+    @classmethod
+    def for_capacity(cls, n, error_rate=0.01):
+        """sizes the filter for n keys and the requested false positive rate"""
+        n = max(n, 1)
+        m = max(8, int(math.ceil(-n * math.log(error_rate) / (math.log(2) ** 2))))
+        k = max(1, int(round(m / n * math.log(2))))
+        return cls(m, k)
+
+    def _positions(self, key):
+        digest = hashlib.md5(key.encode('utf-8')).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.m for i in range(self.k)]
+
+    def add(self, key):
+        for p in self._positions(key):
+            self.bits[p >> 3] |= 1 << (p & 7)
+
+    def __contains__(self, key):
+        return all(self.bits[p >> 3] & (1 << (p & 7)) for p in self._positions(key))
+
+    def dumps(self):
+        return json.dumps({"m": self.m, "k": self.k, "bits": self.bits.hex()})
+
+    @classmethod
+    def loads(cls, s):
+        d = json.loads(s)
+        return cls(d["m"], d["k"], bytearray.fromhex(d["bits"]))
@@ -0,0 +1,153 @@
+import argparse
+import json
+import os
+
+import luigi
+
+import ra2mr
+
+'''
+Statistics on the base relations, for the cost-based parts of the optimizer: the
+number of tuples of a relation and the number of distinct values of each of its
+attributes. A relation is analyzed the first time it is asked for, from a sample
+of its first tuples, and again whenever its size on disk changes.
+
+The statistics can be kept in a JSON file between runs:
+
+    python catalog.py --env LOCAL CUSTOMER NATION
+
+The queries run by a process share the catalog of their environment (see
+shared), loaded once from the file [minihive] catalog (catalog.json by default).
+Only the relations a query references are looked up, and the size of each is
+checked once per query, not on every estimate.
+
+The catalog also stores relations as hash buckets (see ra2mr.BucketTask), whose
+layout is recorded by their bucket manifest only. Relations bucketed on the
+attributes of a foreign key pair, into as many buckets, are joined bucket by
+bucket, without a shuffle:
+
+    python catalog.py --env LOCAL --bucket C_NATIONKEY 4 CUSTOMER
+    python catalog.py --env LOCAL --bucket N_NATIONKEY 4 NATION
+'''
+
+
+def analyze(target, sample=10000):
+    """returns the statistics of the relation behind a target: size in bytes, number of tuples
+        and the number of distinct values per attribute (extrapolated when the sample is not
+        the whole relation: attributes whose values are (nearly) all distinct in the sample are
+        taken to be keys, the others to have been seen entirely)"""
+    values = {}
+    n = 0
+    for line in ra2mr.sample_lines(target, sample):
+        n += 1
+        for k, v in json.loads(line.split('\t')[1]).items():
+            values.setdefault(k[k.index(".") + 1:], set()).add(json.dumps(v))
+    rows = n if n < sample else ra2mr.estimate_rows(target)
+    distinct = {}
+    for attribute, seen in values.items():
+        d = len(seen)
+        distinct[attribute] = int(round(d * float(rows) / n)) if n < rows and d > 0.9 * n else d
+    return {"bytes": ra2mr.target_size(target), "rows": rows, "distinct": distinct}
+
+
+class Catalog(object):
+    '''
+    The statistics of the relations of one execution environment, optionally
+    persisted in a JSON file (path).
+    '''
+
+    def __init__(self, env=ra2mr.ExecEnv.HDFS, path=None, sample=10000):
+        self.env = env
+        self.path = path
+        self.sample = sample
+        self.relations = {}
+        self.checked = set()
+        if path is not None and os.path.exists(path):
+            with open(path) as f:
+                self.relations = json.load(f)
+
+    def target(self, relation):
+        return ra2mr.InputData(filename=relation + ".json", exec_environment=self.env).output()
+
+    def stats(self, relation):
+        """the statistics of a relation, (re)analyzed if missing or out of date when first asked for
+            since the last expire"""
+        stats = self.relations.get(relation)
+        if relation in self.checked:
+            return stats
+        if stats is None or stats["bytes"] != ra2mr.target_size(self.target(relation)):
+            stats = self.refresh(relation)
+        self.checked.add(relation)
+        return stats
+
+    def expire(self):
+        """checks the statistics against the sizes of the relations again, e.g. before a query"""
+        self.checked = set()
+
+    def refresh(self, relation):
+        """analyzes a relation again, keeping what else is recorded on it"""
+        stats = analyze(self.target(relation), self.sample)
+        stats.update({k: v for k, v in self.relations.get(relation, {}).items() if k not in stats})
+        self.relations[relation] = stats
+        self.checked.add(relation)
+        return stats
+
+    def rows(self, relation):
+        return self.stats(relation)["rows"]
+
+    def distinct(self, relation, attribute):
+        """the number of distinct values of an attribute, None if unknown"""
+        return self.stats(relation)["distinct"].get(attribute)
+
+    def buckets(self, relation):
+        """the bucketing of a relation, {"attribute": ..., "count": ...}, None if it is not bucketed,
+            as read from its bucket manifest, which the planner reads too (see ra2mr.bucket_join)"""
+        layout = ra2mr.bucket_layout(relation, self.env)
+        if layout is None:
+            return None
+        return {"attribute": layout["attribute"], "count": layout["count"]}
+
+    def bucket(self, relation, attribute, count):
+        """stores a relation as count hash buckets on attribute"""
+        task = ra2mr.BucketTask(relation=relation, attribute=attribute, count=count, exec_environment=self.env)
+        if not luigi.build([task], local_scheduler=True):
+            raise Exception("Catalog: bucketing " + relation + " failed.")
+
+    def save(self):
+        if self.path is not None:
+            with open(self.path, 'w') as f:
+                json.dump(self.relations, f, indent=1, sort_keys=True)
+
+
+catalogs = {}
+
+
+def shared(env):
+    """the catalog of an environment shared by the queries of the process, expired for the next query;
+        the catalog of files (LOCAL, HDFS) is loaded from [minihive] catalog"""
+    if env not in catalogs:
+        path = None
+        if env != ra2mr.ExecEnv.MOCK:
+            path = luigi.configuration.get_config().get('minihive', 'catalog', 'catalog.json')
+        catalogs[env] = Catalog(env, path)
+    catalogs[env].expire()
+    return catalogs[env]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Collecting statistics on miniHive relations.')
+    parser.add_argument('--env', choices=['HDFS', 'LOCAL'], default='HDFS',
+                        help='execution environment')
+    parser.add_argument('--path', default='catalog.json', help='the file keeping the statistics')
+    parser.add_argument('--bucket', nargs=2, metavar=('ATTRIBUTE', 'COUNT'), default=None,
+                        help='store the relations as COUNT hash buckets on ATTRIBUTE')
+    parser.add_argument('relations', nargs='+', help='relations to analyze')
+
+    args = parser.parse_args()
+    catalog = Catalog(ra2mr.ExecEnv.LOCAL if args.env == 'LOCAL' else ra2mr.ExecEnv.HDFS, args.path)
+    for relation in args.relations:
+        catalog.refresh(relation)
+        if args.bucket is not None:
+            catalog.bucket(relation, args.bucket[0], int(args.bucket[1]))
+        print(relation, json.dumps(catalog.stats(relation)))
+    catalog.save()
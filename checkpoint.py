@@ -0,0 +1,58 @@
+import json
+
+import luigi
+
+'''
+Checkpoints of a query (see miniHive.py --resume), so that a query restarted
+after a crash repeats neither the tasks nor the parts of tasks that had
+finished.
+
+A task is committed by a manifest next to its output (tmp3.tmp.manifest),
+written once it has succeeded, which records the task and the version (see
+ra2mr.fingerprint) of each of its outputs. While checkpointing, a task is
+complete only if it is committed: an output left behind by a task that died
+while writing it, or by another query, is written again.
+
+Within a MapReduce job run locally (ra2mr.MappedJobRunner), the map input is
+cut into splits of [minihive] checkpoint_partition_mb (64 by default) at line
+boundaries. Each split is mapped (and combined) into a partition of its own
+(tmp3.tmp.m00000, ...), and the sorted map output is reduced in ranges of keys
+of about as many bytes into further partitions (tmp3.tmp.r00000, ...). A
+partition is committed by adding it to the manifest of the job (tmp3.tmp.
+partitions), which also records the versions of the inputs, and is skipped when
+the job runs again on the same inputs. The output of the job is the
+concatenation of its partitions, which are removed once it is written. Jobs on
+a single split are run as they are. In HDFS, hadoop reruns the failed attempts
+of a job itself and tasks are not checkpointed; their output folders are
+removed once consumed like any intermediate, see lifecycle.py.
+
+Checkpointing is on while [minihive] checkpoint is set, see miniHive.build.
+'''
+
+
+def enabled():
+    """True if tasks are checkpointed"""
+    return luigi.configuration.get_config().getboolean('minihive', 'checkpoint', False)
+
+
+def partition_bytes():
+    """the bytes of map input per partition, 0 if jobs are not partitioned"""
+    if not enabled():
+        return 0
+    return int(float(luigi.configuration.get_config().get('minihive', 'checkpoint_partition_mb', 64)) * 2 ** 20)
+
+
+def load(target):
+    """the record of a manifest, None if there is none"""
+    if not target.exists():
+        return None
+    with target.open('r') as f:
+        for line in f:
+            return json.loads(line)
+    return None
+
+
+def save(target, record):
+    """writes the record of a manifest, atomically"""
+    with target.open('w') as f:
+        f.write(json.dumps(record) + "\n")
@@ -0,0 +1,80 @@
+import json
+import os
+import sys
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import simdjson
+except ImportError:
+    simdjson = None
+
+'''
+Encoding and decoding of the JSON tuples exchanged by the tasks. The backend is
+the fastest one installed (orjson, then simdjson for decoding, then the json
+module), or the one named by the MINIHIVE_JSON environment variable; use()
+switches backends at runtime.
+
+The keys of the decoded tuples are interned: the few qualified attribute names
+of a schema ("CUSTOMER.C_NAME", ...) are then shared by all tuples instead of
+being allocated again for every row (orjson caches its keys itself).
+
+Only the tuples themselves go through the codec. Keys that must come out the
+same in every process (join keys, group keys, hashes) are encoded with the json
+module, whatever the backend of the client or of a data node.
+'''
+
+BACKENDS = [name for name, module in (("orjson", orjson), ("simdjson", simdjson)) if module is not None] + ["json"]
+
+MAX_KEYS = 65536
+
+keys = {}
+
+
+def intern_pairs(pairs):
+    """the dict of the (key, value) pairs of a JSON object, its keys interned"""
+    if len(keys) < MAX_KEYS:
+        return {keys.setdefault(k, sys.intern(k)): v for k, v in pairs}
+    return {keys.get(k, k): v for k, v in pairs}
+
+
+decoder = json.JSONDecoder(object_pairs_hook=intern_pairs)
+
+
+def json_loads(s):
+    if not isinstance(s, str):
+        s = bytes(s).decode('utf-8')
+    return decoder.decode(s)
+
+
+def orjson_dumps(value):
+    return orjson.dumps(value).decode('utf-8')
+
+
+def simdjson_loads(s):
+    return simdjson.loads(bytes(s) if isinstance(s, memoryview) else s)
+
+
+def use(name=None):
+    """selects the backend by name, the fastest installed one by default"""
+    global backend, loads, dumps
+    if name is None:
+        name = os.environ.get("MINIHIVE_JSON", BACKENDS[0])
+    if name not in BACKENDS:
+        raise Exception("codec: JSON backend " + name + " is not installed.")
+    backend = name
+    if name == "orjson":
+        loads, dumps = orjson.loads, orjson_dumps
+    elif name == "simdjson":
+        loads, dumps = simdjson_loads, json.dumps
+    else:
+        loads, dumps = json_loads, json.dumps
+
+
+backend = None
+loads = None
+dumps = None
+use()
@@ -0,0 +1,243 @@
+import argparse
+import gzip
+import io
+import time
+
+import luigi
+import luigi.format
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+'''
+Streaming compression of the intermediate files (tmp1, tmp2, ...). A task
+writes its intermediates with the codec named by its compress parameter, which
+can be set per operator in the luigi configuration ([JoinTask] compress=lz4),
+or for all of them in [minihive] compression (see miniHive.py --compress). Readers need no configuration: compressed files are
+recognized by their magic bytes, so intermediates written with any codec, or
+none, can be read by any task.
+
+In HDFS, the MapReduce jobs write their output, and compress their map output
+for the shuffle, through the Hadoop codecs (see codec_jobconfs). Hadoop's lz4
+codec does not write lz4 frames, so lz4 only compresses the shuffle there.
+
+Compression trades CPU for I/O; the trade-off of each codec on the queries of
+miniHive.q (in the local file system) is measured with
+
+    python compression.py miniHive.q
+'''
+
+CODECS = ["gzip", "zstd", "lz4"]
+
+MAGIC = {"gzip": b'\x1f\x8b', "zstd": b'\x28\xb5\x2f\xfd', "lz4": b'\x04\x22\x4d\x18'}
+
+HADOOP_CODECS = {"gzip": "org.apache.hadoop.io.compress.GzipCodec",
+                 "zstd": "org.apache.hadoop.io.compress.ZStandardCodec",
+                 "lz4": "org.apache.hadoop.io.compress.Lz4Codec"}
+
+
+def available():
+    """the codecs that can be used here"""
+    return ["gzip"] + (["zstd"] if zstandard is not None else []) + (["lz4"] if lz4 is not None else [])
+
+
+def configured():
+    """the codec of [minihive] compression in the luigi configuration, "" for none"""
+    return luigi.configuration.get_config().get('minihive', 'compression', '')
+
+
+def sniff(head):
+    """the codec whose magic bytes start head, None for uncompressed data"""
+    for name, magic in MAGIC.items():
+        if head.startswith(magic):
+            return name
+    return None
+
+
+def compressor(name, raw):
+    """a binary stream compressing what is written to it into raw"""
+    if name == "gzip":
+        return gzip.GzipFile(fileobj=raw, mode='wb', compresslevel=6)
+    if name == "zstd" and zstandard is not None:
+        return zstandard.ZstdCompressor().stream_writer(raw, closefd=False)
+    if name == "lz4" and lz4 is not None:
+        return lz4.frame.LZ4FrameFile(raw, mode='wb')
+    raise Exception("compression: codec " + str(name) + " is not available.")
+
+
+def decompressor(name, raw):
+    """a binary stream of the decompressed contents of raw"""
+    if name == "gzip":
+        return gzip.GzipFile(fileobj=raw, mode='rb')
+    if name == "zstd" and zstandard is not None:
+        return zstandard.ZstdDecompressor().stream_reader(raw, read_across_frames=True, closefd=False)
+    if name == "lz4" and lz4 is not None:
+        return lz4.frame.LZ4FrameFile(raw, mode='rb')
+    raise Exception("compression: codec " + str(name) + " is not available.")
+
+
+def decompress(data):
+    """the decompressed contents of bytes, which are returned as they are if not compressed"""
+    name = sniff(data[:4])
+    if name is None:
+        return data
+    return decompressor(name, io.BytesIO(data)).read()
+
+
+def open_binary(path):
+    """the decompressed binary contents of a local file, compressed or not"""
+    return CodecFormat().pipe_reader(open(path, 'rb'))
+
+
+def open_text(path):
+    """the decompressed lines of a local file, compressed or not"""
+    return io.TextIOWrapper(open_binary(path), encoding='utf-8')
+
+
+def is_compressed(path):
+    """True if the local file at path is compressed"""
+    with open(path, 'rb') as f:
+        return sniff(f.read(4)) is not None
+
+
+class CodecPipe(io.BufferedIOBase):
+    '''
+    A (de)compressing stream over the pipe of a target: closing it finishes the
+    compressed stream, then closes the pipe (which commits the target).
+    '''
+
+    def __init__(self, stream, pipe):
+        self.stream = stream
+        self.pipe = pipe
+
+    def readable(self):
+        return self.stream.readable()
+
+    def writable(self):
+        return self.stream.writable()
+
+    def read(self, size=-1):
+        return self.stream.read(size)
+
+    def read1(self, size=-1):
+        return self.stream.read(size)
+
+    def readinto(self, b):
+        data = self.stream.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+    def write(self, b):
+        return self.stream.write(b)
+
+    def flush(self):
+        if not self.stream.closed and self.stream.writable():
+            self.stream.flush()
+
+    def close(self):
+        if not self.closed:
+            self.stream.close()
+            self.pipe.close()
+        super(CodecPipe, self).close()
+
+    def __getattr__(self, name):
+        # e.g. set_wrapper of the buffers of luigi's mock targets
+        if name in ('stream', 'pipe'):
+            raise AttributeError(name)
+        return getattr(self.pipe, name)
+
+
+class CodecFormat(luigi.format.Format):
+    '''
+    The binary format of an intermediate: written with codec (None: as it is),
+    read with the codec found in its first bytes.
+    '''
+    input = 'bytes'
+    output = 'bytes'
+
+    def __init__(self, codec=None):
+        self.codec = codec
+
+    def pipe_reader(self, input_pipe):
+        if not hasattr(input_pipe, 'peek'):
+            input_pipe = io.BufferedReader(input_pipe)
+        name = sniff(input_pipe.peek(4)[:4])
+        if name is None:
+            return input_pipe
+        return CodecPipe(decompressor(name, input_pipe), input_pipe)
+
+    def pipe_writer(self, output_pipe):
+        if not self.codec:
+            return output_pipe
+        return CodecPipe(compressor(self.codec, output_pipe), output_pipe)
+
+
+def text_format(codec=None):
+    """the luigi format of a text intermediate written with codec"""
+    return luigi.format.Text >> CodecFormat(codec)
+
+
+def codec_jobconfs(codec):
+    """the Hadoop settings compressing the output and the map output of a job with codec"""
+    if not codec:
+        return []
+    confs = ['mapreduce.map.output.compress=true',
+             'mapreduce.map.output.compress.codec=' + HADOOP_CODECS[codec]]
+    if codec != "lz4":
+        confs += ['mapreduce.output.fileoutputformat.compress=true',
+                  'mapreduce.output.fileoutputformat.compress.codec=' + HADOOP_CODECS[codec]]
+    return confs
+
+
+def benchmark(queries, codecs, optimize=True):
+    """runs each query locally with each codec (None: uncompressed); yields the query, the codec,
+        the wall and CPU seconds and the raw and on-disk bytes of the intermediate files, or None
+        for a query that failed (e.g. on a relation that is not there)"""
+    import lifecycle
+    import miniHive  # the tool runs queries, miniHive imports ra2mr, which imports this module
+    import ra2mr
+
+    config = luigi.configuration.get_config()
+    for query in queries:
+        for name in codecs:
+            miniHive.clear_local_tmpfiles()
+            config.set('minihive', 'compression', name or '')
+            wall, cpu = time.perf_counter(), time.process_time()
+            try:
+                if not miniHive.eval(0, ra2mr.ExecEnv.LOCAL, query, optimize, workers=1, count=True):
+                    raise Exception("the query failed")
+            except Exception:
+                yield query, name, None
+                continue
+            wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+            costs, raw, disk = lifecycle.written
+            yield query, name, (wall, cpu, raw, disk)
+    miniHive.clear_local_tmpfiles()
+    config.set('minihive', 'compression', '')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Measuring the compression of the miniHive intermediate files.')
+    parser.add_argument('--codecs', nargs='+', choices=CODECS, default=None,
+                        help='the codecs compared with uncompressed files (default: all available ones)')
+    parser.add_argument('queries', help='file of SQL queries, separated by blank lines')
+
+    args = parser.parse_args()
+    with open(args.queries) as f:
+        queries = [q.strip() for q in f.read().split("\n\n") if q.strip()]
+    codecs = [None] + (args.codecs or available())
+    print("query\tcodec\twall s\tcpu s\traw bytes\tdisk bytes\tratio")
+    for i, (query, name, measures) in enumerate(benchmark(queries, codecs)):
+        if measures is None:
+            print(str(i // len(codecs) + 1) + "\t" + (name or "none") + "\tfailed", flush=True)
+            continue
+        wall, cpu, raw, disk = measures
+        print("\t".join([str(i // len(codecs) + 1), name or "none", "%.3f" % wall, "%.3f" % cpu,
+                         str(raw), str(disk), "%.2f" % (raw / disk if disk else 1.0)]), flush=True)
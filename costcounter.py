@@ -1,16 +1,35 @@
 import glob
 import json
+import os
+
+import codec
+import compression
 
 def compute_hdfs_costs():
     costs = 0    
     files = glob.glob('./*.tmp')
     for file in files:
-        f = open(file, 'r')
+        f = compression.open_text(file)  # intermediates may be compressed, see compression.py
         for line in f:
-            key, value = line.split('\t')
-            json_tuple = json.loads(value) # Makes sure it still can be loaded.
-
-            costs += len(json.dumps(json_tuple))
+            costs += line_costs(line)
         f.close()
 
     return costs
+
+def line_costs(line):
+    key, value = line.split('\t')
+    json_tuple = codec.loads(value) # Makes sure it still can be loaded.
+
+    return len(json.dumps(json_tuple))  # in the json module's encoding, whatever the codec
+
+def compute_bytes():
+    """the bytes of the intermediate files, raw (decompressed) and on disk"""
+    raw, disk = 0, 0
+    for file in glob.glob('./*.tmp'):
+        f = compression.open_binary(file)
+        for block in iter(lambda: f.read(1 << 20), b''):
+            raw += len(block)
+        f.close()
+        disk += os.path.getsize(file)
+
+    return raw, disk
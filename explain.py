@@ -0,0 +1,161 @@
+import luigi
+import radb.ast
+import radb.parse
+
+import ra2mr
+import raopt
+
+'''
+EXPLAIN and EXPLAIN ANALYZE (see miniHive.py --explain, --explain-analyze): the
+plan of a query is shown as the tree of the luigi tasks evaluating it, one line
+per task, with the operator of the relational algebra tree it evaluates, the
+physical operator (the task class), the file it writes (tmpN for step N) and the
+number of tuples the optimizer estimates it to produce (raopt.Cardinality, from
+the statistics catalog). Tasks a task needs on the client side (Bloom filters,
+zone maps) are marked local, and get no estimate.
+
+EXPLAIN ANALYZE runs the query first, with one worker and the intermediates
+retained, and adds to each task the tuples and bytes it actually wrote, the
+seconds it ran and the error of the estimate: the factor by which it was over
+(or under) the actual number of tuples. The stages of adaptive queries, which
+are planned while the query runs, are listed after the plan.
+'''
+
+profile = None
+
+
+def operator(ra):
+    """the operator at the top of a relational algebra tree, without its inputs"""
+    if isinstance(ra, radb.ast.RelRef):
+        return ra.rel
+    s = str(raopt.with_inputs(ra, [radb.ast.RelRef("_")] * len(ra.inputs)))
+    if len(ra.inputs) == 2:
+        return s[2:-2]
+    return s[:-2]
+
+
+def label(task):
+    """the operator a task evaluates"""
+    if isinstance(task, ra2mr.InputData):
+        return task.filename
+    querystring = getattr(task, 'querystring', None)
+    if querystring is None:
+        return str(task)
+    order_by, limit = getattr(task, 'order_by', None), getattr(task, 'limit', None)
+    if order_by is not None or limit is not None:
+        return ", ".join((["order by " + ", ".join(" ".join(e) for e in order_by)] if order_by else []) +
+                         (["limit " + str(limit)] if limit is not None else []))
+    return operator(radb.parse.one_statement_from_string(querystring))
+
+
+def estimate(task, optimizer):
+    """the number of tuples the optimizer expects a task to produce, None if it cannot tell"""
+    try:
+        if isinstance(task, ra2mr.InputData):
+            return optimizer.cardinality(radb.ast.RelRef(task.filename[:-len(".json")]))
+        rows = optimizer.cardinality(radb.parse.one_statement_from_string(task.querystring))
+        limit = getattr(task, 'limit', None)
+        return min(rows, limit) if limit is not None else rows
+    except Exception:
+        return None
+
+
+def nodes(task, depth=0, local=False, seen=None):
+    """yields (depth, task, local, repeated) for the tasks of the tree below a task, depth first.
+        A task read by several others is expanded the first time only, and repeated afterwards"""
+    seen = set() if seen is None else seen
+    yield depth, task, local, task.task_id in seen
+    if task.task_id in seen:
+        return
+    seen.add(task.task_id)
+    for dep in luigi.task.flatten(task.requires()):
+        for node in nodes(dep, depth + 1, local, seen):
+            yield node
+    for dep in luigi.task.flatten(getattr(task, 'requires_local', list)()):
+        for node in nodes(dep, depth + 1, True, seen):
+            yield node
+
+
+def measure(task):
+    """(tuples, bytes) of the output of a task that has run, None if it has no (single) output"""
+    targets = luigi.task.flatten(task.output())
+    if len(targets) != 1 or not targets[0].exists():
+        return None
+    return sum(1 for line in ra2mr.read_lines(targets[0])), ra2mr.target_size(targets[0])
+
+
+def error(estimated, actual):
+    """the factor by which an estimate is off, e.g. "4.0x over" """
+    estimated, actual = max(estimated, 1.0), max(actual, 1.0)
+    if estimated >= actual:
+        return "%.1fx over" % (estimated / actual)
+    return "%.1fx under" % (actual / estimated)
+
+
+def describe(depth, task, local, optimizer, profile=None, repeated=False):
+    """the line of a task in the plan, measured if it ran under the profile"""
+    fields = [type(task).__name__, label(task)]
+    path = luigi.task.flatten(task.output())[0].path if not isinstance(task, ra2mr.InputData) else None
+    if path is not None:
+        fields.append("step " + str(getattr(task, 'step', '-')) + " -> " + path)
+    if repeated:
+        return "  " * depth + "  ".join(fields + ["(see above)"])
+    estimated = None if local else estimate(task, optimizer)
+    if local:
+        fields.append("local")
+    elif estimated is not None:
+        fields.append("est %d rows" % round(estimated))
+    if profile is not None:
+        measured = measure(task)
+        if measured is not None:
+            rows, size = measured
+            fields.append("actual %d rows, %d bytes" % (rows, size))
+            if task.task_id in profile.times:
+                fields.append("%.3f s" % profile.times[task.task_id])
+            if estimated is not None:
+                fields.append("error " + error(estimated, rows))
+    return "  " * depth + "  ".join(fields)
+
+
+def explain(task, optimizer, profile=None):
+    """the lines of the plan of a task (a query): the query, then one line per task of its tree"""
+    lines = ["query: " + getattr(task, 'querystring', str(task))]
+    seen = set()
+    for depth, t, local, repeated in nodes(task):
+        seen.add(t.task_id)
+        lines.append(describe(depth, t, local, optimizer, profile, repeated))
+    if profile is not None:
+        stages = [t for t in profile.tasks if t.task_id not in seen]
+        if stages:
+            lines.append("stages planned at run time:")
+            lines += [describe(1, t, False, optimizer, profile) for t in stages]
+    return lines
+
+
+class Profile(object):
+    '''
+    The tasks run while the profile is installed, in the order they finished,
+    and the seconds each of them ran, by task id. Tasks are timed in the process
+    running them, so they must be run by a single worker.
+    '''
+
+    def __init__(self):
+        self.tasks = []
+        self.times = {}
+
+    def __enter__(self):
+        global profile
+        profile = self
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        global profile
+        profile = None
+        return False
+
+
+@luigi.Task.event_handler(luigi.Event.PROCESSING_TIME)
+def processing_time(task, seconds):
+    if profile is not None:
+        profile.tasks.append(task)
+        profile.times[task.task_id] = seconds
@@ -0,0 +1,102 @@
+import argparse
+import bisect
+import json
+
+import luigi
+
+'''
+Secondary indexes on the attributes of a relation, kept as sidecar files next
+to the relation (CUSTOMER.C_CUSTKEY.hash.idx for CUSTOMER.json). An index maps
+the values of the attribute to the byte offsets of the lines holding them, in a
+hash table or in a sorted array. Values are compared the way selections compare
+them (see ra2mr.cmp): on their letters and digits.
+
+An index records the size (and modification time) of the relation it was built
+from: ra2mr.IndexTask rebuilds it once the relation has changed. Selections
+attr = constant over an indexed relation are evaluated by ra2mr.IndexSeekTask,
+reading only the lines the index points to. Indexes are created with
+
+    python index.py CUSTOMER C_CUSTKEY
+
+in the local file system; the mock file system of the tests is indexed through
+the same task. HDFS streams cannot be read at an offset, they are not indexed.
+'''
+
+KINDS = ["hash", "sorted"]
+
+
+def key(value):
+    """the index key of an attribute value (or of the text of a literal)"""
+    return "".join(c for c in str(value) if c.isalnum())
+
+
+def filename(relation, attribute, kind):
+    return relation + "." + attribute + "." + kind + ".idx"
+
+
+class Index(object):
+    '''
+    The byte offsets of the lines of a relation per value of one attribute. A
+    hash index holds a dict from keys to offsets, a sorted index a sorted list
+    of keys and the list of their offsets.
+    '''
+
+    def __init__(self, relation, attribute, kind="hash", fingerprint=None, entries=None):
+        if kind not in KINDS:
+            raise Exception("Index: unknown kind of index " + str(kind) + ".")
+        self.relation = relation
+        self.attribute = attribute
+        self.kind = kind
+        self.fingerprint = fingerprint
+        self.entries = entries if entries is not None else ({} if kind == "hash" else [[], []])
+
+    @classmethod
+    def build(cls, relation, attribute, kind, fingerprint, records):
+        """indexes the (offset, tuple) pairs of a relation"""
+        name = relation + "." + attribute
+        table = {}
+        for offset, json_tuple in records:
+            if name in json_tuple:
+                table.setdefault(key(json_tuple[name]), []).append(offset)
+        if kind == "hash":
+            return cls(relation, attribute, kind, fingerprint, table)
+        keys, offsets = [], []
+        for k in sorted(table):
+            for offset in table[k]:
+                keys.append(k)
+                offsets.append(offset)
+        return cls(relation, attribute, kind, fingerprint, [keys, offsets])
+
+    def lookup(self, value):
+        """the offsets of the lines whose attribute may equal value, in file order"""
+        k = key(value)
+        if self.kind == "hash":
+            return list(self.entries.get(k, []))
+        keys, offsets = self.entries
+        return sorted(offsets[bisect.bisect_left(keys, k):bisect.bisect_right(keys, k)])
+
+    def dumps(self):
+        """two lines: a header, which can be checked without reading the entries, and the entries"""
+        header = {"relation": self.relation, "attribute": self.attribute, "kind": self.kind,
+                  "fingerprint": self.fingerprint}
+        return json.dumps(header) + "\n" + json.dumps(self.entries) + "\n"
+
+    @classmethod
+    def loads(cls, s):
+        header, entries = s.split("\n", 1)
+        d = json.loads(header)
+        return cls(d["relation"], d["attribute"], d["kind"], d["fingerprint"], json.loads(entries))
+
+
+if __name__ == "__main__":
+    import ra2mr  # ra2mr imports this module, the tool needs its tasks
+
+    parser = argparse.ArgumentParser(description='Creating miniHive indexes (CREATE INDEX ON relation (attribute)).')
+    parser.add_argument('--kind', choices=KINDS, default='hash', help='hash table or sorted array')
+    parser.add_argument('relation', help='the indexed relation')
+    parser.add_argument('attribute', help='the indexed attribute, unqualified')
+
+    args = parser.parse_args()
+    task = ra2mr.IndexTask(relation=args.relation, attribute=args.attribute, kind=args.kind,
+                           exec_environment=ra2mr.ExecEnv.LOCAL)
+    luigi.build([task], local_scheduler=True)
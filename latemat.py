@@ -0,0 +1,136 @@
+import json
+
+import luigi
+import radb.ast
+
+import raopt
+
+'''
+Late materialization (see miniHive.py --late-materialization): the joins of a
+query only need the attributes of their conditions (and of the selections
+below them), yet every tuple carries all the attributes of its relations
+through every shuffle and intermediate file, the long comments included. Under
+late materialization, the mappers read the relations below the joins narrow
+(ra2mr.RelAlgQueryTask.map_lines): only the attributes the conditions refer to
+are kept, with a locator, [file, byte offset], of the tuple in its relation.
+The other attributes are fetched once, after the last join, for the tuples that
+made it through (ra2mr.FetchTask), before the operators above the joins
+(projections, aggregations) run.
+
+The locators take room of their own, and the output of the joins is written
+twice, narrow and fetched, so a query is only evaluated narrow if its
+intermediates are estimated to take fewer bytes that way, from a sample of its
+relations (see costs).
+
+Tuples are located by their byte offset, which is not available in HDFS, so
+late materialization is only applied to local (and mock) files.
+
+The plan of a query is installed in [minihive] late_materialization of the
+luigi configuration, for the tasks reading the relations (see
+ra2mr.relation_input) and the task_factory placing the FetchTask.
+'''
+
+LOCATOR = "__locator"
+
+
+def configured():
+    """the plan, {"root": the joins (a relational algebra string), "relations": {relation: [attributes]}},
+        {} if late materialization is off"""
+    return json.loads(luigi.configuration.get_config().get('minihive', 'late_materialization', '') or '{}')
+
+
+def configure(plan):
+    """installs a plan (None: turns late materialization off)"""
+    luigi.configuration.get_config().set('minihive', 'late_materialization', json.dumps(plan) if plan else '')
+
+
+def joins(ra):
+    """the tree of joins and cross products below the selections, projections and aggregations at the top of ra"""
+    while isinstance(ra, radb.ast.Select) or isinstance(ra, radb.ast.Project) or isinstance(ra, radb.ast.Aggr):
+        ra = ra.inputs[0]
+    return ra
+
+
+def narrow_bytes(relation, attributes, line):
+    """the length of a line of a relation read narrow, with the given attributes and a locator"""
+    json_tuple = json.loads(line.split('\t')[1])
+    d = {relation + "." + a: json_tuple[relation + "." + a] for a in attributes}
+    d[relation + "." + LOCATOR] = [relation + ".json", 10 ** 9]
+    return len(relation + "\t" + json.dumps(d) + "\n")
+
+
+def plan(ra, dd, sample, optimize=False):
+    """the late materialization of a query: its joins and the attributes of each relation they
+        need, for the relations with other attributes (to be fetched later); None without joins,
+        or if it would not write fewer intermediate bytes (see costs). sample(relation) gives the
+        size in bytes and some lines of a relation"""
+    root = joins(ra)
+    if not (isinstance(root, radb.ast.Join) or isinstance(root, radb.ast.Cross)):
+        return None
+    optimizer = raopt.Optimizer(dd)
+    bases = optimizer.bases(root)
+    needed = {base: set() for base in bases.values()}
+    stack = [root]
+    while stack:
+        e = stack.pop()
+        stack += e.inputs or []
+        if (isinstance(e, radb.ast.Join) or isinstance(e, radb.ast.Select)) and e.cond is not None:
+            for rel, name in optimizer.references(e.cond):
+                for alias, base in bases.items():
+                    if (rel is None or rel == alias) and name in dd.get(base, {}):
+                        needed[base].add(name)
+    relations = {base: sorted(attributes) for base, attributes in needed.items()
+                 if set(dd.get(base, {})) - attributes}
+    if not relations:
+        return None
+    wide, narrow = costs(root, relations, sample, optimize)
+    if narrow >= wide:
+        return None
+    return {"root": str(root), "relations": relations}
+
+
+def costs(root, relations, sample, optimize=False):
+    """the bytes the operators below and at the root of the joins write, (wide, narrow): the output
+        of an operator has as many tuples as the largest relation below it (foreign key joins, no
+        selectivity), each as long as the lines of these relations, as sampled, together. Narrow,
+        the output of the root is written twice, narrow and then fetched. The optimized joins
+        evaluate the selection and renaming of their inputs in their mappers (ra2mr.JointOpTask),
+        these write nothing"""
+    widths = {}
+    for relation in set(relation_refs(root)):
+        size, lines = sample(relation)
+        if not lines:
+            widths[relation] = (0, 0, 0)
+            continue
+        length = float(sum(len(line) for line in lines))
+        attributes = relations.get(relation)
+        narrow = sum(narrow_bytes(relation, attributes, line) for line in lines) if attributes else length
+        widths[relation] = (size * len(lines) / length, length / len(lines), narrow / len(lines))
+
+    def written(e):
+        below = [widths[relation] for relation in relation_refs(e)]
+        rows = max(rows for rows, w, n in below)
+        return rows * sum(w for rows, w, n in below), rows * sum(n for rows, w, n in below)
+
+    wide, narrow = written(root)
+    narrow += wide
+    stack = [(e, optimize and isinstance(root, radb.ast.Join)) for e in root.inputs]
+    while stack:
+        e, fused = stack.pop()
+        if isinstance(e, radb.ast.RelRef):
+            continue
+        fused = fused and (isinstance(e, radb.ast.Select) or isinstance(e, radb.ast.Rename))
+        stack += [(i, optimize and isinstance(e, radb.ast.Join) or fused and isinstance(e, radb.ast.Select))
+                  for i in e.inputs]
+        if not fused:
+            w, n = written(e)
+            wide += w
+            narrow += n
+    return wide, narrow
+
+
+def relation_refs(e):
+    """the relations read by e, once per reference"""
+    if isinstance(e, radb.ast.RelRef):
+        return [e.rel]
+    return [relation for i in e.inputs for relation in relation_refs(i)]
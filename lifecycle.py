@@ -0,0 +1,154 @@
+import logging
+import multiprocessing
+import time
+
+import luigi
+
+import costcounter
+import ra2mr
+
+'''
+Lifecycle of the intermediate files (tmp1, tmp2, ... and the files kept with
+them, such as Bloom filters) while a query runs: every intermediate is counted
+against the tasks consuming it, and removed as soon as the last of them has
+succeeded. The outputs of the tasks built (the query results) are kept, and so
+is everything when [minihive] retain_intermediates is set, e.g. for debugging
+or for reusing intermediates across queries.
+
+A disk quota ([minihive] disk_quota, in MiB) bounds the footprint of the
+intermediates: a task whose output (estimated by the size of its inputs) would
+not fit in next to the intermediates already written waits for consumers to
+finish and free theirs, for at most disk_quota_wait seconds, and then runs
+anyway. Only concurrent workers free space while a task waits.
+
+The intermediates are removed as they are consumed, so a build counting the
+costs of a query (see costcounter.py) counts every intermediate file when the
+task writing it succeeds, before it can be removed; the totals are left in
+written when the build is over. Tasks skipped as complete (e.g. committed by
+an earlier build, see checkpoint.py) are not counted.
+
+The collector of a build is installed by miniHive.build; luigi's event
+handlers run in the worker processes, which the collector is forked into.
+'''
+
+logger = logging.getLogger('luigi-interface')
+
+collector = None
+
+# costs, raw and on-disk bytes of the intermediate files written by the last build counting them
+written = (0, 0, 0)
+
+
+def dependencies(task):
+    """the tasks whose outputs a task reads, its local (client side) requirements included"""
+    requires_local = getattr(task, 'requires_local', list)
+    return luigi.task.flatten(task.requires()) + luigi.task.flatten(requires_local())
+
+
+def is_intermediate(task):
+    return isinstance(task, ra2mr.OutputMixin) and task.intermediate
+
+
+class Collector(object):
+    '''
+    The consumers of every intermediate of the task graph below the given tasks,
+    by task id; the retained tasks (the roots) are left out.
+    '''
+
+    def __init__(self, tasks, retain=False, quota=0, wait=0, count=False):
+        self.retain = retain
+        self.quota = quota
+        self.wait = wait
+        self.count = count
+        self.counts = multiprocessing.Array('q', 3)  # shared with the worker processes
+        self.roots = {task.task_id for task in tasks}
+        self.tasks = {}
+        self.consumers = {}
+        stack = list(tasks)
+        while stack:
+            task = stack.pop()
+            if task.task_id in self.tasks:
+                continue
+            self.tasks[task.task_id] = task
+            for dep in dependencies(task):
+                if is_intermediate(dep) and dep.task_id not in self.roots:
+                    self.consumers.setdefault(dep.task_id, set()).add(task.task_id)
+                stack.append(dep)
+
+    def __enter__(self):
+        global collector
+        collector = self
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        global collector, written
+        collector = None
+        if self.count:
+            written = tuple(self.counts)
+        return False
+
+    def counted(self, task):
+        """adds the costs and bytes of the intermediate files a task that has succeeded has written"""
+        if not self.count:
+            return
+        costs, raw, disk = 0, 0, 0
+        for target in luigi.task.flatten(task.output()):
+            if not target.path.endswith('.tmp') or not target.exists():
+                continue
+            for line in ra2mr.read_lines(target):
+                costs += costcounter.line_costs(line)
+                raw += len(line.encode())
+            disk += ra2mr.target_size(target)
+        with self.counts.get_lock():
+            for i, n in enumerate((costs, raw, disk)):
+                self.counts[i] += n
+
+    def consumed(self, task):
+        """removes the intermediates read by a task that has succeeded whose consumers have all succeeded"""
+        if self.retain:
+            return
+        for dep in dependencies(task):
+            consumers = self.consumers.get(dep.task_id)
+            if consumers is None or not all(c == task.task_id or self.tasks[c].complete() for c in consumers):
+                continue
+            committed = [dep.manifest()] if dep.checkpointed() else []
+            for target in luigi.task.flatten(dep.output()) + committed:
+                try:
+                    if target.exists():
+                        target.remove()
+                except Exception:
+                    logger.warning("Could not remove the intermediate " + target.path)
+
+    def footprint(self):
+        """the bytes taken by the intermediates written so far"""
+        return sum(ra2mr.target_size(target) for task_id in self.consumers
+                   for target in luigi.task.flatten(self.tasks[task_id].output()) if target.exists())
+
+    def claim(self, task):
+        """the bytes a task is expected to write: as many as it reads"""
+        return sum(ra2mr.target_size(target) for target in luigi.task.flatten(task.input()) if target.exists())
+
+    def admit(self, task):
+        """waits until the output of a task fits into the disk quota, or for wait seconds"""
+        if self.quota <= 0 or task.task_id not in self.tasks:
+            return
+        claim = self.claim(task)
+        deadline = time.time() + self.wait
+        while self.footprint() + claim > self.quota * 2 ** 20:
+            if time.time() >= deadline:
+                logger.warning("Disk quota of " + str(self.quota) + " MiB exceeded by " + str(task))
+                return
+            time.sleep(min(1, self.wait))
+
+
+@luigi.Task.event_handler(luigi.Event.START)
+def admit(task):
+    if collector is not None:
+        collector.admit(task)
+
+
+@luigi.Task.event_handler(luigi.Event.SUCCESS)
+def consumed(task):
+    if collector is not None:
+        collector.counted(task)
+        collector.consumed(task)
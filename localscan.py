@@ -0,0 +1,108 @@
+import mmap
+import os
+
+import codec
+
+'''
+Scanning of local JSON-lines files (RELATION\t{json} per line) through a memory
+map: record boundaries are found with a byte search in the mapped file, and the
+JSON part of a record is handed to the decoder (see codec.py) as a memoryview
+slice, without a copy into a Python string first.
+
+A file can be read in byte ranges (splits), e.g. by parallel readers: like an
+input split of Hadoop, the range [start, end) owns the records beginning in it.
+
+Only the scans of the client decode records this way (tuples). The MapReduce
+jobs run locally read the mapped files as lines (lines), since their mappers
+take text lines, as under hadoop streaming (see ra2mr.MappedJobRunner).
+'''
+
+
+class MappedFile(object):
+    '''
+    A read-only memory map of a file; empty files, which cannot be mapped, have
+    no records.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.f = open(path, 'rb')
+        self.size = os.fstat(self.f.fileno()).st_size
+        self.mm = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ) if self.size > 0 else None
+
+    def close(self):
+        if self.mm is not None:
+            self.mm.close()
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def boundaries(self, start=0, end=None):
+        """yields (begin, end) of the records beginning in the byte range [start, end), newline excluded"""
+        mm = self.mm
+        end = self.size if end is None else min(end, self.size)
+        if mm is None or start >= end:
+            return
+        pos = start
+        if start > 0 and mm[start - 1] != 0x0a:
+            # the record under start belongs to the previous range
+            pos = mm.find(b'\n', start)
+            if pos == -1:
+                return
+            pos += 1
+        while pos < end:
+            eol = mm.find(b'\n', pos)
+            if eol == -1:
+                eol = self.size
+            if eol > pos:
+                yield pos, eol
+            pos = eol + 1
+
+    def records(self, start=0, end=None):
+        """yields the records beginning in [start, end) as memoryview slices of the map"""
+        view = memoryview(self.mm) if self.mm is not None else None
+        try:
+            for begin, eol in self.boundaries(start, end):
+                yield view[begin:eol]
+        finally:
+            if view is not None:
+                view.release()
+
+    def tuples(self, start=0, end=None):
+        """yields (relation, decoded tuple) of the records beginning in [start, end)"""
+        mm = self.mm
+        view = memoryview(mm) if mm is not None else None
+        try:
+            for begin, eol in self.boundaries(start, end):
+                tab = mm.find(b'\t', begin, eol)
+                yield mm[begin:tab].decode('utf-8'), codec.loads(view[tab + 1:eol])
+        finally:
+            if view is not None:
+                view.release()
+
+
+def splits(path, n):
+    """cuts a file into n byte ranges of (nearly) equal size"""
+    size = os.path.getsize(path)
+    n = max(1, min(n, size))
+    return [(size * i // n, size * (i + 1) // n) for i in range(n)]
+
+
+def tuples(path, start=0, end=None):
+    """yields (relation, decoded tuple) of the records of a local file beginning in [start, end)"""
+    with MappedFile(path) as f:
+        for relation, json_tuple in f.tuples(start, end):
+            yield relation, json_tuple
+
+
+def lines(path, start=0, end=None):
+    """yields the lines of a local file beginning in [start, end) (newline included), read through a memory map"""
+    with MappedFile(path) as f:
+        mm = f.mm
+        for begin, eol in f.boundaries(start, end):
+            yield (mm[begin:eol + 1] if eol < f.size else mm[begin:eol] + b'\n').decode('utf-8')
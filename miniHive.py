@@ -1,11 +1,20 @@
 import argparse
 import glob
+import json
 import luigi
 import os
 import radb
+import random
+import time
 import sqlparse
+import zlib
 
-import costcounter
+import catalog
+import compression
+import explain
+import latemat
+import lifecycle
+import sampling
 import sql2ra
 import raopt
 import ra2mr
@@ -14,12 +23,12 @@ import ra2mr
 # You may want to add your own imports here.
 
 def clear_local_tmpfiles():
-    files = glob.glob('./*.tmp')
+    files = glob.glob('./*.tmp') + glob.glob('./*.tmp.*')  # with their partitions and manifests, see checkpoint.py
     for f in files:
         os.remove(f)
 
 
-def eval(sf, env, query, optimize):
+def data_dictionary():
     dd = {}
     dd["PART"] = {"P_PARTKEY": "int", "P_NAME": "string", "P_MFGR": "string",
                   "P_BRAND": "string", "P_TYPE": "string", "P_SIZE": "int", "P_CONTAINER": "string",
@@ -44,9 +53,12 @@ def eval(sf, env, query, optimize):
 
     dd["PARTSUPP"] = {"PS_PARTKEY": "int", "PS_SUPPKEY": "int", "PS_AVAILQTY": "int",
                       "PS_SUPPLYCOST": "float", "PS_COMMENT": "string"}
+    return dd
 
-    ''' ...................... you may edit code below ........................'''
 
+def plan(query, dd, stats=None, bushy=True):
+    """translates a SQL query into an optimized relational algebra query. With a statistics
+        catalog, the joins are reordered by estimated cost (see raopt.rule_reorder_joins)"""
     stmt = sqlparse.parse(query)[0]
     ra0 = sql2ra.translate(stmt)
 
@@ -54,10 +66,174 @@ def eval(sf, env, query, optimize):
     ra2 = raopt.rule_push_down_selections(ra1, dd)
     ra3 = raopt.rule_merge_selections(ra2)
     ra4 = raopt.rule_introduce_joins(ra3)
+    if stats is not None:
+        ra4 = raopt.rule_reorder_joins(ra4, dd, stats, bushy)
+    return ra4
+
+
+def relation_sample(relation, env, lines=100):
+    """the size in bytes and the first lines of a relation, from which late materialization is planned"""
+    target = ra2mr.InputData(filename=relation + ".json", exec_environment=env).output()
+    if not target.exists():
+        return 0, []
+    return ra2mr.target_size(target), ra2mr.sample_lines(target, lines)
+
+
+def query_task(query, dd, env, optimize, prefix="", cache=None, stats=None, adaptive=False, late=False):
+    """returns the luigi task evaluating a SQL query, ORDER BY and LIMIT included.
+        The query is planned through the cache (see plancache.py) if there is one.
+        The optimized physical operators only handle left-deep join trees. Adaptive
+        queries plan their joins while they run (see ra2mr.AdaptiveTask). With late,
+        the late materialization of the query is installed (see latemat.py) for its
+        tasks, until latemat.configure(None)"""
+    if cache is not None:
+        ra, order_by, limit = cache.plan(query)
+    else:
+        ra = plan(query, dd, stats, bushy=not optimize)
+        order_by, limit = sql2ra.order_by_limit(sqlparse.parse(query)[0])
+    if late:
+        latemat.configure(latemat.plan(ra, dd, lambda relation: relation_sample(relation, env), optimize))
+    if len(order_by) != 0 or limit is not None:
+        return ra2mr.sort_task_factory(ra, order_by, limit, env=env, optimize=optimize, prefix=prefix)
+    if adaptive:
+        return ra2mr.AdaptiveTask(querystring=str(ra) + ";", exec_environment=env, prefix=prefix)
+    return ra2mr.task_factory(ra, env=env, optimize=optimize, prefix=prefix)
+
+
+def explain_query(query, env, optimize, adaptive=False, analyze=False):
+    """the lines of the plan of a SQL query (see explain.py), with what the operators did when analyzed"""
+    dd = data_dictionary()
+    stats = catalog.shared(env)
+    task = query_task(query, dd, env, optimize, stats=stats, adaptive=adaptive)
+    optimizer = raopt.Optimizer(dd, stats)
+    if not analyze:
+        return explain.explain(task, optimizer)
+    with explain.Profile() as profile:
+        build([task], workers=1, retain=True)
+    return explain.explain(task, optimizer, profile)
+
+
+def approximate(query, dd, env, fraction, method="bernoulli", confidence=0.95, seed=0, stats=None, retain=None):
+    """evaluates a SQL query on samples of its relations (see sampling.py), ORDER BY and LIMIT
+        aside: returns the samples, the sampled tuples of the query (below its aggregation) and
+        the estimated result, as (tuple, confidence intervals) pairs. The intermediates are
+        prefixed with the hash of the samples, apart from those of other samples and exact plans"""
+    ra = plan(query, dd, stats)
+    aggr = ra if isinstance(ra, radb.ast.Aggr) else None
+    below = aggr.inputs[0] if aggr is not None else ra
+    specs, clusters = sampling.plan(below, dd, fraction, method, seed, stats)
+    prefix = "sample%08x_" % zlib.crc32(json.dumps(specs, sort_keys=True).encode('utf-8'))
+    with sampling.Sampling(specs):
+        task = ra2mr.task_factory(below, env=env, prefix=prefix)
+        if not build([task], retain=retain):
+            raise Exception("miniHive: evaluating the query on the samples failed.")
+    tuples = [json.loads(line.split('\t')[1]) for line in ra2mr.read_lines(task.output())]
+    return specs, tuples, list(sampling.estimates(tuples, aggr, fraction, clusters, confidence))
+
+
+def first_rows(query, dd, env):
+    """yields the result tuples of a SQL query as soon as they are found, without MapReduce jobs"""
+    order_by, limit = sql2ra.order_by_limit(sqlparse.parse(query)[0])
+    return ra2mr.first_rows(plan(query, dd), order_by, limit, env)
+
+
+def physical_memory():
+    """the physical memory of the machine in MiB, None if unknown"""
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') // 2 ** 20
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+class TaskProcessSeed(object):
+    '''
+    Context of the processes running the tasks when there are several workers:
+    luigi seeds their random generators with a tuple, which Python 3.11 rejects,
+    they are seeded here instead.
+    '''
+
+    def __init__(self, process):
+        self.process = process
+
+    def __enter__(self):
+        random.seed(hash((os.getpid(), time.time())))
+        self.process.use_multiprocessing = False  # only skips luigi's seeding, the process is running
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+class Settings(object):
+    '''
+    Sets options of the luigi configuration, {(section, option): value}, while a
+    build runs, and restores them afterwards, so that they do not carry over to
+    the next build of the process (e.g. of the query server).
+    '''
+
+    def __init__(self, options):
+        self.options = options
+        self.saved = {}
+
+    def __enter__(self):
+        config = luigi.configuration.get_config()
+        for (section, option), value in self.options.items():
+            self.saved[(section, option)] = config.get(section, option) if config.has_option(section, option) \
+                else None
+            config.set(section, option, value)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        config = luigi.configuration.get_config()
+        for (section, option), value in self.saved.items():
+            if value is not None:
+                config.set(section, option, value)
+            elif config.has_option(section, option):
+                config.remove_option(section, option)
+        return False
+
+
+def build(tasks, workers=1, memory=None, compress=None, retain=None, disk_quota=None, checkpoint=None, count=False):
+    """runs luigi tasks; with several workers, independent subtrees (such as the two inputs of
+        a join) run concurrently on a pool of as many worker processes. Tasks claim memory in proportion
+        to the relations they scan (see ra2mr.memory_claim), and only run together while their
+        claims fit into the memory budget in MiB, half of the physical memory by default.
+        Intermediate files are compressed with the codec compress, if any (see compression.py), and
+        removed once consumed unless retained; disk_quota (MiB) bounds their footprint (see lifecycle.py).
+        With checkpoint, tasks and the partitions of jobs are committed as they finish, and those
+        committed by an earlier build are skipped (see checkpoint.py). With count, the costs of the
+        intermediate files are counted as they are written, into lifecycle.written (see costcounter.py)"""
+    if memory is None:
+        memory = (physical_memory() or 2048) // 2
+    config = luigi.configuration.get_config()
+    options = {('resources', 'memory'): str(memory)}
+    if compress:
+        options[('minihive', 'compression')] = compress
+    if checkpoint is not None:
+        options[('minihive', 'checkpoint')] = str(checkpoint)
+    if workers > 1:
+        options[('worker', 'task_process_context')] = 'miniHive.TaskProcessSeed'
+    if retain is None:
+        retain = config.getboolean('minihive', 'retain_intermediates', False)
+    if disk_quota is None:
+        disk_quota = config.getint('minihive', 'disk_quota', 0)
+    wait = config.getint('minihive', 'disk_quota_wait', 60) if workers > 1 else 0
+    with Settings(options), lifecycle.Collector(tasks, retain, disk_quota, wait, count):
+        return luigi.build(tasks, local_scheduler=True, workers=workers)
+
+
+def eval(sf, env, query, optimize, workers=1, memory=None, compress=None, retain=None, disk_quota=None,
+         adaptive=False, late=False, checkpoint=None, count=False):
+    dd = data_dictionary()
+
+    ''' ...................... you may edit code below ........................'''
 
-    task = ra2mr.task_factory(ra4, env=env, optimize=optimize)
+    task = query_task(query, dd, env, optimize, stats=catalog.shared(env), adaptive=adaptive, late=late)
 
-    luigi.build([task], local_scheduler=True)
+    try:
+        return build([task], workers, memory, compress, retain, disk_quota, checkpoint, count)
+    finally:
+        latemat.configure(None)
 
     ''' ...................... you may edit code above ........................'''
 
@@ -69,17 +245,75 @@ if __name__ == "__main__":
                         help='the TPC-H scale factor')
     parser.add_argument('--env', choices=['HDFS', 'LOCAL'], default='HDFS',
                         help='execution environment')
+    parser.add_argument('--first-rows', action='store_true',
+                        help='stream the result tuples as they are found, stopping at the LIMIT')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of tasks run concurrently, e.g. the number of CPUs (default: 1)')
+    parser.add_argument('--memory', type=int, default=None,
+                        help='memory budget of the concurrent tasks in MiB (default: half of the physical memory)')
+    parser.add_argument('--compress', choices=compression.CODECS, default=None,
+                        help='compress the intermediate files (zstd and lz4 when their modules are installed)')
+    parser.add_argument('--keep-intermediates', action='store_true',
+                        help='keep the intermediate files instead of removing them once consumed')
+    parser.add_argument('--disk-quota', type=int, default=None,
+                        help='MiB the intermediate files may take, tasks wait for space beyond')
+    parser.add_argument('--adaptive', action='store_true',
+                        help='plan the joins from the sizes of the intermediates, as the query runs')
+    parser.add_argument('--explain', action='store_true',
+                        help='print the plan, with the estimated tuples per operator, instead of running the query')
+    parser.add_argument('--explain-analyze', action='store_true',
+                        help='run the query and print the plan, with the actual tuples, bytes and time per operator')
+    parser.add_argument('--resume', action='store_true',
+                        help='keep the intermediates committed by an earlier run of the query, only running what it '
+                             'did not finish (in LOCAL, where every run is checkpointed)')
+    parser.add_argument('--late-materialization', action='store_true',
+                        help='join narrow tuples, fetching the attributes the joins do not need at the end (not in HDFS)')
+    parser.add_argument('--sample', type=float, default=None, metavar='FRACTION',
+                        help='evaluate the query approximately, on samples of FRACTION of the tuples')
+    parser.add_argument('--sample-method', choices=sampling.METHODS, default='bernoulli',
+                        help='sampling of a relation that is not joined on a key (default: bernoulli)')
+    parser.add_argument('--confidence', type=float, default=0.95,
+                        help='confidence level of the intervals of the approximate results')
     parser.add_argument('query', help='SQL query')
 
     args = parser.parse_args()
 
-    # Assuming the default environment.
-    env = ra2mr.ExecEnv.HDFS
-    if args.env == 'LOCAL':
-        clear_local_tmpfiles()
-        env = ra2mr.ExecEnv.LOCAL
+    if args.first_rows:
+        env = ra2mr.ExecEnv.LOCAL if args.env == 'LOCAL' else ra2mr.ExecEnv.HDFS
+        for relation, json_tuple in first_rows(args.query, data_dictionary(), env):
+            print(relation + "\t" + json.dumps(json_tuple), flush=True)
+    elif args.sample is not None:
+        env = ra2mr.ExecEnv.LOCAL if args.env == 'LOCAL' else ra2mr.ExecEnv.HDFS
+        if args.env == 'LOCAL':
+            clear_local_tmpfiles()
+        specs, tuples, estimates = approximate(args.query, data_dictionary(), env, args.sample, args.sample_method,
+                                               args.confidence, stats=catalog.shared(env))
+        for relation, spec in sorted(specs.items()):
+            print("sample: " + relation + " " + spec["method"] + " " + ",".join(spec["key"]) +
+                  " fraction " + str(spec["fraction"]) + ", scale-up " + str(1 / spec["fraction"]))
+        print(str(len(tuples)) + " sampled tuples, " + str(args.confidence) + " confidence intervals")
+        for json_tuple, intervals in estimates:
+            print(json.dumps(json_tuple) + "\t" + json.dumps(intervals), flush=True)
+    elif args.explain or args.explain_analyze:
+        env = ra2mr.ExecEnv.LOCAL if args.env == 'LOCAL' else ra2mr.ExecEnv.HDFS
+        if args.explain_analyze and args.env == 'LOCAL':
+            clear_local_tmpfiles()
+        for line in explain_query(args.query, env, args.O, args.adaptive, args.explain_analyze):
+            print(line)
+    else:
+        # Assuming the default environment.
+        env = ra2mr.ExecEnv.HDFS
+        if args.env == 'LOCAL':
+            if not args.resume:
+                clear_local_tmpfiles()
+            env = ra2mr.ExecEnv.LOCAL
 
-    eval(args.SF, env, args.query, args.O)
+        # the costs are counted on the intermediate files as they are written, see lifecycle.py
+        eval(args.SF, env, args.query, args.O, args.workers, args.memory, args.compress, args.keep_intermediates,
+             args.disk_quota, args.adaptive, args.late_materialization, args.env == 'LOCAL', args.env == 'LOCAL')
 
-    if args.env == 'LOCAL':
-        print(str(costcounter.compute_hdfs_costs()))
+        if args.env == 'LOCAL':
+            costs, raw, disk = lifecycle.written
+            print(str(costs))
+            if args.compress:
+                print("intermediate bytes: " + str(raw) + " raw, " + str(disk) + " on disk")
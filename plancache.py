@@ -0,0 +1,108 @@
+import collections
+import copy
+import re
+
+import radb
+import radb.ast
+import sqlparse
+
+import miniHive
+import sql2ra
+
+'''
+Memoizes the translation and optimization of SQL queries. Queries that only
+differ in their literals (and whitespace) share one cache entry: its key is the
+query text with every string and integer literal replaced by "?".
+
+On a miss, the query is planned once with a placeholder in place of each literal
+(a string or number that cannot occur in the query itself), which gives a plan
+template: the optimized RA tree with ORDER BY and LIMIT. On a hit, the literals
+of the query are written into a copy of the template, no parsing or rewriting
+takes place. The task DAG is derived from the plan by ra2mr.task_factory.
+'''
+
+# decimals stay in the shape: sql2ra reads 1.5 as an attribute reference, which changes the plan.
+LITERAL = re.compile(r"'(?:[^']|'')*'|(?<![\w.])\d+(?![\w.])")
+
+NUMBER_PLACEHOLDER = 900000000000000000
+
+
+def literals(query):
+    """returns the shape of a query, its text with whitespace collapsed and literals replaced
+        by '?', and the list of its literals in order"""
+    query = " ".join(query.split())
+    return LITERAL.sub("?", query), LITERAL.findall(query)
+
+
+def placeholder(i, literal):
+    """the placeholder standing for the i-th literal of a query in its plan template"""
+    if literal.startswith("'"):
+        return "'placeholder_" + str(i) + "'"
+    return str(NUMBER_PLACEHOLDER + i)
+
+
+def bind(node, values):
+    """writes the literals into the placeholders of a (copied) plan template, in place"""
+    if isinstance(node, radb.ast.Literal):
+        node.val = values.get(node.val, node.val)
+    elif isinstance(node, radb.ast.AttrRef):
+        node.name = values.get(node.name, node.name)  # sql2ra keeps literals as attribute names
+    elif isinstance(node, list):
+        for e in node:
+            bind(e, values)
+    elif isinstance(node, radb.ast.Node):
+        for e in vars(node).values():
+            if isinstance(e, radb.ast.Node) or isinstance(e, list):
+                bind(e, values)
+
+
+def bind_text(text, values):
+    """writes the literals into the placeholders of an ORDER BY attribute (aggregates may hold literals)"""
+    for p, literal in values.items():
+        text = text.replace(p, literal)
+    return text
+
+
+class PlanCache(object):
+    '''
+    An LRU cache of plan templates for one data dictionary, holding at most
+    capacity query shapes. hits and misses count the lookups.
+    '''
+
+    def __init__(self, dd, capacity=1024):
+        self.dd = dd
+        self.capacity = capacity
+        self.templates = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def plan(self, query):
+        """returns the optimized relational algebra query, the ORDER BY pairs and the LIMIT of a SQL query"""
+        shape, found = literals(query)
+        values = collections.OrderedDict((placeholder(i, literal), literal) for i, literal in enumerate(found))
+        if any(literal in values for literal in found):
+            self.misses += 1  # the query holds a placeholder: plan it as it is
+            return self.plan_query(query)
+
+        if shape in self.templates:
+            self.hits += 1
+            self.templates.move_to_end(shape)
+        else:
+            self.misses += 1
+            placeholders = iter(values)
+            templated = LITERAL.sub(lambda m: next(placeholders), " ".join(query.split()))
+            self.templates[shape] = self.plan_query(templated)
+            if len(self.templates) > self.capacity:
+                self.templates.popitem(last=False)
+
+        ra, order_by, limit = self.templates[shape]
+        ra = copy.deepcopy(ra)
+        bind(ra, values)
+        order_by = [(bind_text(attribute, values), direction) for attribute, direction in order_by]
+        if limit is not None:
+            limit = int(values.get(str(limit), str(limit)))
+        return ra, order_by, limit
+
+    def plan_query(self, query):
+        order_by, limit = sql2ra.order_by_limit(sqlparse.parse(query)[0])
+        return miniHive.plan(query, self.dd), order_by, limit
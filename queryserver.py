@@ -0,0 +1,204 @@
+import argparse
+import asyncio
+import concurrent.futures
+import itertools
+import json
+import os
+import sys
+
+import luigi
+import luigi.configuration
+import radb
+import radb.parse
+
+import miniHive
+import plancache
+import ra2mr
+
+'''
+A long-running miniHive: SQL queries are read one per line, from stdin or from
+a local (unix) socket, and answered with one JSON line each as soon as they are
+evaluated, in the form {"query": ..., "rows": [...]} or {"query": ...,
+"error": ...}.
+
+Queries are planned as soon as they arrive, through a cache of the plans of
+query shapes (see plancache.py), and evaluated in batches: whatever arrived
+while the previous batch was running. All scan chains
+of a batch (selections and renamings over a base relation) that read the same
+relation are merged into one SharedScanTask, which reads the relation once and
+fans its tuples out to the operator pipeline of every query.
+'''
+
+
+def query_plan(task):
+    """returns the relational algebra query evaluated by the task at the root of a query, and its step"""
+    raquery = radb.parse.one_statement_from_string(task.querystring)
+    if isinstance(task, ra2mr.TopKTask) or isinstance(task, ra2mr.SortTask):
+        return raquery, task.step + 1
+    return raquery, task.step
+
+
+def shared_scans(tasks, env):
+    """returns the SharedScanTasks for the relations read by more than one scan chain
+        of the queries evaluated by the given tasks"""
+    scans = {}
+    for query in tasks:
+        if isinstance(query, ra2mr.InputData) or isinstance(query, ra2mr.LimitScanTask):
+            continue  # a limited scan stops early, it reads the relation on its own
+        raquery, step = query_plan(query)
+        for chain, chain_step in ra2mr.scan_leaves(raquery, step):
+            task = ra2mr.task_factory(chain, step=chain_step, env=env, prefix=query.prefix)
+            scans.setdefault(ra2mr.chain_relation(chain), []).append((str(chain) + ";", task.output().path))
+    return [ra2mr.SharedScanTask(relation=relation, scans=chains, exec_environment=env)
+            for relation, chains in sorted(scans.items()) if len(chains) > 1]
+
+
+def intermediates(task):
+    """returns the outputs of all tasks evaluating a query, the base relations and the files
+        kept with them (indexes, zone maps, buckets) excepted"""
+    if isinstance(task, (ra2mr.InputData, ra2mr.IndexTask, ra2mr.ZoneMapTask, ra2mr.BucketTask)):
+        return []
+    targets = luigi.task.flatten(task.output())
+    requires_local = getattr(task, 'requires_local', list)
+    for t in luigi.task.flatten(task.requires()) + luigi.task.flatten(requires_local()):
+        targets += intermediates(t)
+    return targets
+
+
+class QueryService(object):
+
+    def __init__(self, dd, env=ra2mr.ExecEnv.HDFS, plan_cache_size=1024, workers=1, memory=None):
+        self.dd = dd
+        self.env = env
+        self.workers = workers
+        self.memory = memory
+        self.plans = plancache.PlanCache(dd, plan_cache_size)
+        self.pending = []
+        self.running = False
+        self.ids = itertools.count(1)
+        self.shared_scan_count = 0
+
+        # luigi runs in a worker thread, where it cannot install its signal handler.
+        luigi.configuration.get_config().set('worker', 'no_install_shutdown_handler', 'true')
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+    async def submit(self, query):
+        """plans a query and returns the list of its result tuples once its batch has been evaluated"""
+        future = asyncio.get_running_loop().create_future()
+        prefix = "q" + str(os.getpid()) + "_" + str(next(self.ids)) + "_"
+        try:
+            self.pending.append((miniHive.query_task(query, self.dd, self.env, False, prefix, self.plans), future))
+        except Exception as e:
+            future.set_exception(e)
+        if not self.running:
+            self.running = True
+            asyncio.ensure_future(self.run_batches())
+        return await future
+
+    async def run_batches(self):
+        loop = asyncio.get_running_loop()
+        while self.pending:
+            batch, self.pending = self.pending, []
+            try:
+                results = await loop.run_in_executor(self.executor, self.evaluate, [task for task, future in batch])
+                for (task, future), rows in zip(batch, results):
+                    if isinstance(rows, Exception):
+                        future.set_exception(rows)
+                    else:
+                        future.set_result(rows)
+            except Exception as e:
+                for task, future in batch:
+                    future.set_exception(e)
+        self.running = False
+
+    def evaluate(self, tasks):
+        """evaluates a batch of queries, returns the result tuples of each, or the exception of
+            those that failed: a failing query does not fail the others of its batch"""
+        scans = shared_scans(tasks, self.env)
+        self.shared_scan_count += len(scans)
+        try:
+            if scans:
+                miniHive.build(scans, self.workers, self.memory)  # the queries of failed scans fail below
+            miniHive.build(tasks, self.workers, self.memory)
+            results = []
+            for task in tasks:
+                if not task.complete():
+                    results.append(Exception("query evaluation failed"))
+                    continue
+                rows = []
+                for line in ra2mr.read_lines(task.output()):
+                    rows.append(json.loads(line.split('\t')[1]))
+                results.append(rows)
+            return results
+        finally:
+            for task in tasks + scans:
+                for target in intermediates(task):
+                    if target.exists():
+                        target.remove()
+
+    async def answer(self, query):
+        """the JSON line answering a query"""
+        try:
+            return json.dumps({"query": query, "rows": await self.submit(query)})
+        except Exception as e:
+            return json.dumps({"query": query, "error": str(e)})
+
+
+async def serve_connection(service, reader, writer):
+    """answers the queries of one client, one per line, each as soon as it is evaluated: the client
+        may wait for an answer before it sends its next query"""
+    async def reply(query):
+        writer.write((await service.answer(query) + "\n").encode('utf-8'))
+        await writer.drain()
+
+    replies = []
+    while True:
+        line = await reader.readline()
+        if not line:
+            break
+        if line.strip():
+            replies.append(asyncio.ensure_future(reply(line.decode('utf-8').strip())))
+    if replies:
+        await asyncio.wait(replies)
+    writer.close()
+
+
+async def serve_stdin(service):
+    """answers the queries read from stdin, each as soon as it is evaluated"""
+    loop = asyncio.get_running_loop()
+    answers = []
+    while True:
+        line = await loop.run_in_executor(None, sys.stdin.readline)
+        if not line:
+            break
+        if line.strip():
+            answer = asyncio.ensure_future(service.answer(line.strip()))
+            answer.add_done_callback(lambda f: print(f.result(), flush=True))
+            answers.append(answer)
+    if answers:
+        await asyncio.wait(answers)
+
+
+async def main(args):
+    env = ra2mr.ExecEnv.LOCAL if args.env == 'LOCAL' else ra2mr.ExecEnv.HDFS
+    service = QueryService(miniHive.data_dictionary(), env=env, workers=args.workers, memory=args.memory)
+    if args.socket is None:
+        await serve_stdin(service)
+    else:
+        server = await asyncio.start_unix_server(lambda r, w: serve_connection(service, r, w), path=args.socket)
+        async with server:
+            await server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Serving miniHive queries.')
+    parser.add_argument('--env', choices=['HDFS', 'LOCAL'], default='HDFS',
+                        help='execution environment')
+    parser.add_argument('--socket', default=None,
+                        help='path of the unix socket to listen on (default: read queries from stdin)')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of tasks of a batch run concurrently')
+    parser.add_argument('--memory', type=int, default=None,
+                        help='memory budget of the concurrent tasks in MiB (default: half of the physical memory)')
+
+    asyncio.run(main(parser.parse_args()))
@@ -1,5 +1,14 @@
 from enum import Enum
+import bisect
+import heapq
+import io
+import itertools
 import json
+import logging
+import math
+import os
+import random
+import zlib
 
 import luigi
 import luigi.contrib.hadoop
@@ -10,6 +19,20 @@ import radb.ast
 import radb.parse
 import re
 
+import bloom
+import checkpoint
+import codec
+import compression
+import index
+import latemat
+import localscan
+import raopt
+import sampling
+import views
+import zonemap
+
+logger = logging.getLogger('luigi-interface')
+
 '''
 Control where the input data comes from, and where output data should go.
 '''
@@ -25,11 +48,70 @@ def extract_tabname_record(json_tuple):
 
 
 def extract_cond_joint(cond):
-    """" returns a list L of condition """
-    condition = re.sub("and", "", str(cond))
-    cond_list = re.findall(r"[\w.\w]+", condition)
-    n = len(cond_list)
-    return [(cond_list[i], cond_list[i + 1]) for i in range(0, n - 1, 2)]
+    """" returns the list of pairs (a, b) of the equality terms a = b between two attributes """
+    return [(str(term.inputs[0]), str(term.inputs[1])) for term in conjuncts(cond)
+            if isinstance(term, radb.ast.ValExprBinaryOp) and term.op == radb.ast.sym.EQ and
+            all(isinstance(e, radb.ast.AttrRef) for e in term.inputs)]
+
+
+def literal_value(literal):
+    """the python value of a radb string or number literal"""
+    if isinstance(literal, radb.ast.RAString):
+        return literal.val[1:-1].replace("''", "'")
+    value = float(literal.val)
+    return int(value) if value.is_integer() and "." not in literal.val else value
+
+
+def attribute_name(attr, json_tuple):
+    """the key of an attribute in a tuple, unqualified attributes match any relation"""
+    if attr.rel is not None:
+        return str(attr)
+    for k in json_tuple.keys():
+        if k.endswith("." + attr.name):
+            return k
+    raise KeyError(attr.name)
+
+
+def attribute_value(attr, json_tuple):
+    """looks up an attribute in a tuple, unqualified attributes match any relation"""
+    return json_tuple[attribute_name(attr, json_tuple)]
+
+
+def eval_cond(cond, json_tuple):
+    """evaluates a radb value expression (conditions included) on a tuple"""
+    if isinstance(cond, radb.ast.AttrRef):
+        return attribute_value(cond, json_tuple)
+    if isinstance(cond, radb.ast.Literal):
+        return literal_value(cond)
+    if isinstance(cond, radb.ast.ValExprUnaryOp):
+        value = eval_cond(cond.inputs[0], json_tuple)
+        return not value if cond.op == radb.ast.sym.NOT else -value
+    op = cond.op
+    if op == radb.ast.sym.AND:
+        return eval_cond(cond.inputs[0], json_tuple) and eval_cond(cond.inputs[1], json_tuple)
+    if op == radb.ast.sym.OR:
+        return eval_cond(cond.inputs[0], json_tuple) or eval_cond(cond.inputs[1], json_tuple)
+    a, b = eval_cond(cond.inputs[0], json_tuple), eval_cond(cond.inputs[1], json_tuple)
+    return COMPARISONS[op](a, b)
+
+
+COMPARISONS = {
+    radb.ast.sym.EQ: lambda a, b: a == b,
+    radb.ast.sym.NE: lambda a, b: a != b,
+    radb.ast.sym.LT: lambda a, b: a < b,
+    radb.ast.sym.LE: lambda a, b: a <= b,
+    radb.ast.sym.GT: lambda a, b: a > b,
+    radb.ast.sym.GE: lambda a, b: a >= b,
+    radb.ast.sym.PLUS: lambda a, b: a + b,
+    radb.ast.sym.MINUS: lambda a, b: a - b,
+    radb.ast.sym.STAR: lambda a, b: a * b,
+    radb.ast.sym.SLASH: lambda a, b: a / b,
+    radb.ast.sym.CONCAT: lambda a, b: str(a) + str(b),
+}
+
+FLIPPED = {radb.ast.sym.LT: radb.ast.sym.GT, radb.ast.sym.LE: radb.ast.sym.GE,
+           radb.ast.sym.GT: radb.ast.sym.LT, radb.ast.sym.GE: radb.ast.sym.LE,
+           radb.ast.sym.EQ: radb.ast.sym.EQ}
 
 
 def sort_cond(term):
@@ -64,10 +146,866 @@ def get_table(ra):
         return ra.relname, ra.inputs[0].rel
 
 
+def relation_names(ra):
+    """returns the set of relation names (or aliases) prefixing the attributes produced by ra"""
+    if isinstance(ra, radb.ast.RelRef):
+        return {ra.rel}
+    if isinstance(ra, radb.ast.Rename) and ra.relname is not None:
+        return {ra.relname}
+    names = set()
+    for e in ra.inputs:
+        names |= relation_names(e)
+    return names
+
+
+def conjuncts(cond):
+    """returns the list of terms of a conjunctive condition"""
+    if isinstance(cond, radb.ast.ValExprBinaryOp) and cond.op == radb.ast.sym.AND:
+        return conjuncts(cond.inputs[0]) + conjuncts(cond.inputs[1])
+    return [cond]
+
+
+def is_selective(ra):
+    """returns True if ra contains a selection comparing an attribute with a constant"""
+    if isinstance(ra, radb.ast.Select):
+        for term in conjuncts(ra.cond):
+            if any(isinstance(e, radb.ast.Literal) for e in term.inputs):
+                return True
+    return any(is_selective(e) for e in ra.inputs)
+
+
+def join_attributes(ra):
+    """returns the join attributes of the left and the right input of a join, in condition order"""
+    names0 = relation_names(ra.inputs[0])
+    attrs0, attrs1 = [], []
+    for a, b in extract_cond_joint(ra.cond):
+        if a[:a.index(".")] in names0:
+            attrs0.append(a)
+            attrs1.append(b)
+        else:
+            attrs0.append(b)
+            attrs1.append(a)
+    return attrs0, attrs1
+
+
+def linear_term(expr):
+    """returns (attribute, offset) if expr is of the form a, a + c, a - c or c + a, else None"""
+    if isinstance(expr, radb.ast.AttrRef) and expr.rel is not None:
+        return str(expr), 0
+    if isinstance(expr, radb.ast.ValExprBinaryOp) and expr.op in (radb.ast.sym.PLUS, radb.ast.sym.MINUS):
+        left, right = expr.inputs
+        if isinstance(left, radb.ast.AttrRef) and left.rel is not None and isinstance(right, radb.ast.RANumber):
+            c = literal_value(right)
+            return str(left), c if expr.op == radb.ast.sym.PLUS else -c
+        if isinstance(right, radb.ast.AttrRef) and right.rel is not None and isinstance(left, radb.ast.RANumber) \
+                and expr.op == radb.ast.sym.PLUS:
+            return str(right), literal_value(left)
+    return None
+
+
+def difference_bounds(term, names0):
+    """normalizes a comparison between an attribute x0 of the left input and x1 of the right input
+        into bounds (x0, x1, lo, hi) on x0 - x1 (None when unbounded), or returns None"""
+    if not isinstance(term, radb.ast.ValExprBinaryOp) or term.op not in FLIPPED:
+        return None
+    l, r = linear_term(term.inputs[0]), linear_term(term.inputs[1])
+    if l is None or r is None:
+        return None
+    op = term.op
+    if l[0][:l[0].index(".")] not in names0:
+        l, r, op = r, l, FLIPPED[op]
+    if l[0][:l[0].index(".")] not in names0 or r[0][:r[0].index(".")] in names0:
+        return None
+    c = r[1] - l[1]  # x0 + c0 op x1 + c1  <=>  x0 - x1 op c1 - c0
+    if op == radb.ast.sym.EQ:
+        return l[0], r[0], c, c
+    if op in (radb.ast.sym.LT, radb.ast.sym.LE):
+        return l[0], r[0], None, c
+    return l[0], r[0], c, None
+
+
+def join_strategy(ra):
+    """chooses how a join partitions its inputs:
+        ('hash',)  equality terms between the inputs: partition on the join attributes
+        ('band', x0, x1, lo, hi)  lo <= x0 - x1 <= hi: range partitions of width hi - lo on x1,
+                                  the left tuples being replicated to the neighboring partitions
+        ('inequality', x0, x1, lo, hi)  a one-sided bound: sort-based interval matching
+        ('grid',)  any other condition: grid partitioning as for cross products"""
+    if len(extract_cond_joint(ra.cond)) > 0:
+        return ('hash',)
+    names0 = relation_names(ra.inputs[0])
+    bounds = {}
+    for term in conjuncts(ra.cond):
+        b = difference_bounds(term, names0)
+        if b is None:
+            continue
+        lo, hi = bounds.get(b[:2], (None, None))
+        if b[2] is not None:
+            lo = b[2] if lo is None else max(lo, b[2])
+        if b[3] is not None:
+            hi = b[3] if hi is None else min(hi, b[3])
+        bounds[b[:2]] = (lo, hi)
+    for (x0, x1), (lo, hi) in bounds.items():
+        if lo is not None and hi is not None:
+            return ('band', x0, x1, lo, hi)
+    for (x0, x1), (lo, hi) in bounds.items():
+        return ('inequality', x0, x1, lo, hi)
+    return ('grid',)
+
+
+def band_partitions(side, json_tuple, strategy):
+    """the range partitions of a band join a tuple of the left (0) or right (1) input is sent to.
+        Bands without offsets may bound strings, which cannot be cut into ranges: those tuples
+        all go to a single partition and are matched on sorted inputs, as for inequality joins"""
+    x0, x1, lo, hi = strategy[1:]
+    v = json_tuple[x1 if side == 1 else x0]
+    if isinstance(v, bool) or not isinstance(v, (int, float)):
+        return ["join"]
+    width = hi - lo if hi > lo else 1
+    if side == 1:
+        return [int(math.floor(v / width))]
+    return list(range(int(math.floor((v - hi) / width)), int(math.floor((v - lo) / width)) + 1))
+
+
+def match_join(cond, strategy, attrs, left, right):
+    """yields the joined tuples of the pairs (left, right) satisfying the join condition.
+        For hash joins the right tuples are indexed on their join attributes, for band and
+        inequality joins they are sorted on x1 and each left tuple is only compared with
+        the interval of right tuples its bounds allow"""
+    if strategy[0] == 'hash':
+        index = {}
+        for e2 in right:
+            index.setdefault(join_key(e2, attrs[1]), []).append(e2)
+        for e1 in left:
+            for e2 in index.get(join_key(e1, attrs[0]), []):
+                d = dict(e1)
+                d.update(e2)
+                if eval_cond(cond, d):
+                    yield d
+    elif strategy[0] in ('band', 'inequality'):
+        x0, x1, lo, hi = strategy[1:]
+        right = sorted(right, key=lambda e: e[x1])
+        values = [e[x1] for e in right]
+        for e1 in left:
+            v = e1[x0]
+            start = 0 if hi is None else bisect.bisect_left(values, v - hi if hi else v)
+            end = len(right) if lo is None else bisect.bisect_right(values, v - lo if lo else v)
+            for e2 in right[start:end]:
+                d = dict(e1)
+                d.update(e2)
+                if eval_cond(cond, d):
+                    yield d
+    else:
+        for e1 in left:
+            for e2 in right:
+                d = dict(e1)
+                d.update(e2)
+                if eval_cond(cond, d):
+                    yield d
+
+
+def join_key(json_tuple, attrs):
+    """the values of the join attributes, serialized so that both join sides agree on them"""
+    return json.dumps([json_tuple[a] for a in attrs])
+
+
+def heavy_hitters(samples, cells, skew_factor):
+    """finds the join keys holding more than skew_factor times a reducer's fair share of the
+        sampled tuples. samples holds the sampled join keys of the left and the right input.
+        Returns {key: (side, splits)}: the tuples of the given side with that key are split
+        over several reducers, the matching tuples of the other side are replicated to all of them"""
+    counts = [{}, {}]
+    for side in (0, 1):
+        for key in samples[side]:
+            counts[side][key] = counts[side].get(key, 0) + 1
+    fair_share = float(len(samples[0]) + len(samples[1])) / cells
+    heavy = {}
+    for key in set(counts[0]) | set(counts[1]):
+        c0, c1 = counts[0].get(key, 0), counts[1].get(key, 0)
+        if c0 + c1 > skew_factor * fair_share and min(c0, c1) > 0:
+            side = 0 if c0 >= c1 else 1
+            heavy[key] = (side, min(cells, int(math.ceil(max(c0, c1) / fair_share))))
+    return heavy
+
+
+def split_partitions(key, side, res, heavy):
+    """the reducer keys of a tuple whose join key is a heavy hitter"""
+    large_side, splits = heavy[key]
+    if side == large_side:
+        return [(key, zlib.crc32(res.encode('utf-8')) % splits)]
+    return [(key, i) for i in range(splits)]
+
+
+def semi_join_side(ra):
+    """returns the index of the join input a Bloom filter is built on (the only filtered one), or None"""
+    if len(extract_cond_joint(ra.cond)) == 0:
+        return None
+    selective = [is_selective(e) for e in ra.inputs]
+    if selective[0] and not selective[1]:
+        return 0
+    if selective[1] and not selective[0]:
+        return 1
+    return None
+
+
+def read_lines(target):
+    """iterates over the lines of a target, hadoop job outputs on HDFS being folders of part files"""
+    if isinstance(target, luigi.contrib.hdfs.HdfsTarget) and target.fs.isdir(target.path):
+        target = luigi.contrib.hdfs.HdfsTarget(target.path + "/part-*", format=compression.text_format())
+    if isinstance(target, luigi.LocalTarget) and not compression.is_compressed(target.path):
+        for line in localscan.lines(target.path):
+            yield line
+        return
+    with target.open('r') as f:
+        for line in f:
+            yield line
+
+
+def scan_tuples(target):
+    """iterates over the (relation, tuple) pairs of a target, local files through a memory map"""
+    if isinstance(target, luigi.LocalTarget) and not compression.is_compressed(target.path):
+        for relation, json_tuple in localscan.tuples(target.path):
+            yield relation, json_tuple
+        return
+    for line in read_lines(target):
+        relation, tuple = line.rstrip('\n').split('\t')
+        yield relation, codec.loads(tuple)
+
+
+def range_lines(target, ranges=None):
+    """iterates over the lines (newline included) of a local or mock file beginning in the
+        given byte ranges, over all its lines if ranges is None; compressed files are read
+        whole (only uncompressed relations have zone maps)"""
+    if ranges is None:
+        ranges = [(0, None)]
+    if isinstance(target, luigi.LocalTarget) and compression.is_compressed(target.path):
+        for line in read_lines(target):
+            yield line
+        return
+    for start, end in ranges:
+        if isinstance(target, MockTarget):
+            data = compression.decompress(target.fs.get_data(target.path))
+            for line in data[start:end].decode('utf-8').splitlines(True):
+                yield line if line.endswith('\n') else line + '\n'
+        else:
+            for line in localscan.lines(target.path, start, end):
+                yield line
+
+
+def line_start(target, offset):
+    """the offset of the first line of a local or mock file beginning at or after offset"""
+    if offset == 0:
+        return 0
+    if isinstance(target, MockTarget):
+        data = target.fs.get_data(target.path)
+        eol = data.find(b'\n', offset - 1)
+        return len(data) if eol == -1 else eol + 1
+    with open(target.path, 'rb') as f:
+        f.seek(offset - 1)
+        f.readline()
+        return f.tell()
+
+
+def input_splits(target, ranges, size):
+    """the splits of the map input from a local or mock file: the byte ranges read (all of the file if
+        None), cut into pieces of about size bytes at line boundaries. Compressed files are not split"""
+    length = target_size(target)
+    if size <= 0 or length <= size:
+        return [ranges]
+    if isinstance(target, MockTarget):
+        compressed = compression.sniff(target.fs.get_data(target.path)[:4]) is not None
+    else:
+        compressed = compression.is_compressed(target.path)
+    if compressed:
+        return [ranges]
+    bounds = sorted(set([0, length] + [line_start(target, offset) for offset in range(size, length, size)]))
+    splits = []
+    for begin, end in zip(bounds, bounds[1:]):
+        if ranges is None:
+            splits.append([(begin, end)])
+            continue
+        split = [(max(start, begin), min(stop if stop is not None else length, end)) for start, stop in ranges
+                 if start < end and (stop is None or stop > begin)]
+        if split:
+            splits.append(split)
+    return splits or [ranges]
+
+
+def key_ranges(lines, size):
+    """cuts the sorted lines of a map output into ranges of keys of about size bytes, a key never spanning two"""
+    chunk, length, last = [], 0, None
+    for line in lines:
+        key = line.rstrip('\n').split('\t')[:-1]
+        if length >= size and key != last:
+            yield chunk
+            chunk, length = [], 0
+        chunk.append(line)
+        length += len(line)
+        last = key
+    yield chunk
+
+
+class LineCounter(object):
+    '''
+    The output file of a job, counting the lines written to it.
+    '''
+
+    def __init__(self, f):
+        self.f = f
+        self.lines = 0
+
+    def write(self, s):
+        self.lines += s.count("\n")
+        self.f.write(s)
+
+    def close(self):
+        self.f.close()
+
+
+class MappedJobRunner(luigi.contrib.hadoop.LocalJobRunner):
+    '''
+    Runs a job locally like luigi's LocalJobRunner, except that the map input is
+    streamed from the memory mapped input files instead of being copied into
+    memory first, and that only the byte ranges of an input the job asks for are
+    read (see RelAlgQueryTask.input_ranges), narrow under late materialization
+    (see RelAlgQueryTask.map_lines). While checkpointing, a job on
+    large inputs is run in partitions (see checkpoint.py).
+
+    The mappers still get each record as a decoded line, which they split and
+    decode themselves, as they do under hadoop streaming: the decoding of
+    memoryview slices (localscan.tuples) only serves the scans of the client,
+    such as shared scans and first rows, not the jobs.
+
+    The jobs with count_rows set record the number of rows of their output in
+    a sidecar (tmp3.tmp.rows, see counted_rows) once it is written.
+    '''
+
+    def run_job(self, job):
+        inputs = luigi.task.flatten(job.input_hadoop())
+        splits = [(target, ranges) for target in inputs
+                  for ranges in input_splits(target, job.input_ranges(target), checkpoint.partition_bytes())]
+        if len(splits) > len(inputs):
+            self.run_partitioned(job, splits)
+            return
+        map_input = itertools.chain.from_iterable(job.map_lines(target, ranges) for target, ranges in splits)
+
+        if job.reducer == NotImplemented:
+            map_output = LineCounter(job.output().open('w'))
+            job.run_mapper(map_input, map_output)
+            map_output.close()
+            self.written(job, map_output.lines)
+            return
+
+        map_output = io.StringIO()
+        job.run_mapper(map_input, map_output)
+        map_output.seek(0)
+
+        if job.combiner == NotImplemented:
+            reduce_input = self.group(map_output)
+        else:
+            combine_output = io.StringIO()
+            job.run_combiner(self.group(map_output), combine_output)
+            combine_output.seek(0)
+            reduce_input = self.group(combine_output)
+
+        reduce_output = LineCounter(job.output().open('w'))
+        job.run_reducer(reduce_input, reduce_output)
+        reduce_output.close()
+        self.written(job, reduce_output.lines)
+
+    def written(self, job, rows):
+        """records the rows of the output of a job, if it counts them"""
+        if job.count_rows:
+            output = job.output()
+            sidecar = rows_sidecar(output, job.exec_environment)
+            checkpoint.save(sidecar, {"rows": rows, "fingerprint": fingerprint(output)})
+
+    def run_partitioned(self, job, splits):
+        """runs a job split by split, then range of keys by range of keys, skipping the partitions
+            committed by an earlier run of the job on the same inputs"""
+        output = job.output()
+        manifest = InputData(filename=output.path + ".partitions", exec_environment=job.exec_environment).output()
+        inputs = [[target.path, fingerprint(target)] for target in luigi.task.flatten(job.input_hadoop())]
+        record = checkpoint.load(manifest)
+        if record is None or record["task"] != job.task_id or record["inputs"] != inputs:
+            record = {"task": job.task_id, "inputs": inputs, "map": [], "reduce": [], "reducers": None}
+        elif record["map"] or record["reduce"]:
+            logger.info("Resuming " + str(job) + ": " + str(len(record["map"])) + " map and " +
+                        str(len(record["reduce"])) + " reduce partitions committed")
+
+        def partition(phase, i):
+            return job.get_output(output.path + "." + phase[0] + "%05d" % i)
+
+        def commit(phase, i):
+            record[phase].append(i)
+            checkpoint.save(manifest, record)
+
+        for i, (target, ranges) in enumerate(splits):
+            if i in record["map"]:
+                continue
+            map_output = partition("map", i).open('w')
+            if job.reducer == NotImplemented or job.combiner == NotImplemented:
+                job.run_mapper(job.map_lines(target, ranges), map_output)
+            else:
+                buffer = io.StringIO()
+                job.run_mapper(job.map_lines(target, ranges), buffer)
+                buffer.seek(0)
+                job.run_combiner(self.group(buffer), map_output)
+            map_output.close()
+            commit("map", i)
+        map_outputs = [partition("map", i) for i in range(len(splits))]
+        outputs = map_outputs
+
+        if job.reducer != NotImplemented:
+            if record["reducers"] is None or len(record["reduce"]) < record["reducers"]:
+                reduce_input = self.group(itertools.chain.from_iterable(read_lines(p) for p in map_outputs))
+                count = 0
+                for r, chunk in enumerate(key_ranges(reduce_input, checkpoint.partition_bytes())):
+                    count += 1
+                    if r in record["reduce"]:
+                        continue
+                    reduce_output = partition("reduce", r).open('w')
+                    job.run_reducer(iter(chunk), reduce_output)
+                    reduce_output.close()
+                    commit("reduce", r)
+                record["reducers"] = count
+                checkpoint.save(manifest, record)
+            outputs = [partition("reduce", r) for r in range(record["reducers"])]
+
+        f = LineCounter(output.open('w'))
+        for p in outputs:
+            for line in read_lines(p):
+                f.write(line)
+        f.close()
+        self.written(job, f.lines)
+        for target in map_outputs + outputs + [manifest]:
+            if target.exists():
+                target.remove()
+
+
+def target_size(target):
+    """returns the size in bytes of the data behind a target"""
+    if isinstance(target, MockTarget):
+        return len(target.fs.get_data(target.path))
+    if isinstance(target, luigi.contrib.hdfs.HdfsTarget):
+        return int(target.fs.count(target.path)['content_size'])
+    return os.path.getsize(target.path)
+
+
+def sample_lines(target, n):
+    """returns the first n lines of a target"""
+    lines = []
+    for line in read_lines(target):
+        if len(lines) == n:
+            break
+        lines.append(line)
+    return lines
+
+
+def reservoir_lines(target, n, seed=0):
+    """returns n lines of a target drawn uniformly at random (all of them if it has fewer), by
+        reservoir sampling, in a single pass over the target"""
+    rng = random.Random(seed)
+    lines = []
+    for i, line in enumerate(read_lines(target)):
+        if i < n:
+            lines.append(line)
+        else:
+            j = rng.randint(0, i)
+            if j < n:
+                lines[j] = line
+    return lines
+
+
+def offset_lines(target, offsets):
+    """the lines (newline included) beginning after the given byte offsets of an uncompressed local or
+        mock file, the first line at offset 0; offsets within its last line have none"""
+    f = io.BytesIO(target.fs.get_data(target.path)) if isinstance(target, MockTarget) else open(target.path, 'rb')
+    lines = []
+    with f:
+        for offset in offsets:
+            f.seek(max(offset - 1, 0))
+            if offset > 0:
+                f.readline()
+            line = f.readline()
+            if line:
+                lines.append(line.decode('utf-8') if line.endswith(b'\n') else line.decode('utf-8') + '\n')
+    return lines
+
+
+def random_lines(target, n, whole, seed=0):
+    """returns about n lines of a target drawn at random, reading a bounded part of it: a reservoir
+        sample of its lines if it has at most whole bytes, else the lines beginning after n uniformly
+        random byte offsets (a line being drawn in proportion to its length); None if the target is
+        larger and cannot be read at an offset (HDFS, compressed files)"""
+    size = target_size(target)
+    if size <= whole:
+        return reservoir_lines(target, n, seed)
+    if isinstance(target, MockTarget):
+        seekable = compression.sniff(target.fs.get_data(target.path)[:4]) is None
+    else:
+        seekable = isinstance(target, luigi.LocalTarget) and not compression.is_compressed(target.path)
+    if not seekable:
+        return None
+    rng = random.Random(seed)
+    return offset_lines(target, sorted(rng.randrange(size) for i in range(n)))
+
+
+def estimate_rows(target, sample=100):
+    """estimates the number of lines of a target from its size and the length of its first lines"""
+    size = target_size(target)
+    if size == 0:
+        return 0
+    n, length = 0, 0
+    for line in read_lines(target):
+        n += 1
+        length += len(line)
+        if n == sample:
+            break
+    return int(math.ceil(size * n / max(length, 1)))
+
+
+def base_relations(ra):
+    """returns the set of (stored) relations read by ra"""
+    if isinstance(ra, radb.ast.RelRef):
+        return {ra.rel}
+    relations = set()
+    for e in ra.inputs:
+        relations |= base_relations(e)
+    return relations
+
+
+def memory_budget():
+    """the units (MiB) of the scheduler's memory resource, 0 if tasks are not throttled"""
+    return luigi.configuration.get_config().getint('resources', 'memory', 0)
+
+
+def memory_claim(relations, env):
+    """the resources claimed by a task over the given relations: as many units of memory
+        as they have MiB (the local job runner sorts the map output in memory), capped by
+        the budget so that any task can run alone. Nothing is claimed without a budget"""
+    budget = memory_budget()
+    if budget <= 0:
+        return {}
+    size = 0
+    for relation in relations:
+        target = InputData(filename=relation + ".json", exec_environment=env).output()
+        if target.exists():
+            size += target_size(target)
+    return {"memory": min(max(int(math.ceil(size / 2.0 ** 20)), 1), budget)}
+
+
+def grid_shape(size0, size1, cells):
+    """rows x columns of a reducer grid: the left input is split into rows, the right one
+        into columns, chosen so that the replicated bytes size0 * columns + size1 * rows are minimal"""
+    rows = int(round(math.sqrt(cells * max(size0, 1) / max(size1, 1))))
+    rows = min(max(rows, 1), cells)
+    return rows, max(cells // rows, 1)
+
+
+def grid_cells(side, json_tuple, rows, columns):
+    """the reducer cells (row, column) of the grid a tuple of the left (0) or right (1) input is sent to"""
+    h = zlib.crc32(json.dumps(json_tuple, sort_keys=True).encode('utf-8'))
+    if side == 0:
+        return [(h % rows, c) for c in range(columns)]
+    return [(r, h % columns) for r in range(rows)]
+
+
+def select_matches(ra, json_tuple):
+    """returns True if the tuple satisfies the condition of the selection ra"""
+    condition = clean_select(ra).cond
+    table_name = extract_tabname_record(json_tuple)
+    for c1, c2 in extract_cond(table_name, condition):
+        if not cmp(str(json_tuple[c1]), c2):
+            return False
+    return True
+
+
+def scan_chain(ra):
+    """returns True if ra is a chain of selections and renamings over a relation"""
+    return (isinstance(ra, radb.ast.Select) or isinstance(ra, radb.ast.Rename)) and \
+        (isinstance(ra.inputs[0], radb.ast.RelRef) or scan_chain(ra.inputs[0]))
+
+
+def chain_relation(ra):
+    """the name of the relation read by a scan chain"""
+    return ra.rel if isinstance(ra, radb.ast.RelRef) else chain_relation(ra.inputs[0])
+
+
+def apply_chain(ra, relation, json_tuple):
+    """evaluates a scan chain on one tuple of the relation, returns the resulting tuple or None"""
+    if isinstance(ra, radb.ast.RelRef):
+        return json_tuple if ra.rel == relation else None
+    json_tuple = apply_chain(ra.inputs[0], relation, json_tuple)
+    if json_tuple is None:
+        return None
+    if isinstance(ra, radb.ast.Rename):
+        return {k.replace(relation + ".", ra.relname + "."): v for k, v in json_tuple.items()}
+    return json_tuple if select_matches(ra, json_tuple) else None
+
+
+def fingerprint(target):
+    """identifies the version of a file: its size, and its modification time when local"""
+    if isinstance(target, luigi.LocalTarget):
+        return [target_size(target), os.stat(target.path).st_mtime_ns]
+    return [target_size(target)]
+
+
+def rows_sidecar(target, env):
+    """the sidecar recording the number of rows of the output of a job, see MappedJobRunner"""
+    return InputData(filename=target.path + ".rows", exec_environment=env).output()
+
+
+def counted_rows(target, env):
+    """the number of rows of a job output as counted by the job, None if it was not counted or has changed since"""
+    sidecar = rows_sidecar(target, env)
+    if not up_to_date(sidecar, target):
+        return None
+    return checkpoint.load(sidecar)["rows"]
+
+
+def up_to_date(sidecar, target):
+    """True if the sidecar file (an index or zone map) exists and was built from the current version of target"""
+    if not sidecar.exists():
+        return False
+    for line in read_lines(sidecar):
+        return json.loads(line)["fingerprint"] == fingerprint(target)
+    return False
+
+
+def offset_tuples(target, ranges=None):
+    """iterates over the (byte offset, tuple) pairs of the lines of a local or mock file beginning
+        in the given byte ranges, of all its lines if ranges is None"""
+    if ranges is None:
+        ranges = [(0, None)]
+    if isinstance(target, luigi.LocalTarget):
+        with localscan.MappedFile(target.path) as f:
+            for start, end in ranges:
+                for begin, eol in f.boundaries(start, end):
+                    tab = f.mm.find(b'\t', begin, eol)
+                    yield begin, codec.loads(f.mm[tab + 1:eol])
+    elif isinstance(target, MockTarget):
+        data = target.fs.get_data(target.path)
+        for start, end in ranges:
+            begin = line_start(target, start)
+            while begin < min(len(data), end if end is not None else len(data)):
+                eol = data.find(b'\n', begin)
+                eol = len(data) if eol == -1 else eol
+                if eol > begin:
+                    yield begin, codec.loads(data[data.find(b'\t', begin, eol) + 1:eol])
+                begin = eol + 1
+    else:
+        raise Exception("offset_tuples: " + target.path + " cannot be read at byte offsets.")
+
+
+def narrow_lines(target, ranges, relation, attributes):
+    """the lines of a relation beginning in the byte ranges (all of them if None), its tuples cut down
+        to the given attributes and their locator [file, byte offset] (see latemat.py)"""
+    names = [relation + "." + a for a in attributes]
+    locator = relation + "." + latemat.LOCATOR
+    for offset, json_tuple in offset_tuples(target, ranges):
+        d = {name: json_tuple[name] for name in names}
+        d[locator] = [target.path, offset]
+        yield relation + "\t" + codec.dumps(d) + "\n"
+
+
+def lines_at(target, offsets):
+    """iterates over the lines beginning at the given byte offsets of a local or mock file, newline stripped"""
+    if isinstance(target, MockTarget):
+        data = target.fs.get_data(target.path)
+        for offset in offsets:
+            eol = data.find(b'\n', offset)
+            yield data[offset:eol if eol != -1 else len(data)].decode('utf-8')
+    else:
+        with open(target.path, 'rb') as f:
+            for offset in offsets:
+                f.seek(offset)
+                yield f.readline().decode('utf-8').rstrip('\n')
+
+
+def range_tuples(target, start, end):
+    """iterates over the (relation, tuple) pairs of the lines of a local or mock file beginning in [start, end)"""
+    if isinstance(target, luigi.LocalTarget):
+        for relation, json_tuple in localscan.tuples(target.path, start, end):
+            yield relation, json_tuple
+    elif isinstance(target, MockTarget):
+        for line in range_lines(target, [(start, end)]):
+            relation, tuple = line.rstrip('\n').split('\t')
+            yield relation, codec.loads(tuple)
+    else:
+        raise Exception("range_tuples: " + target.path + " cannot be read at byte offsets.")
+
+
+def append_lines(target, size, lines):
+    """cuts a local or mock file back to size bytes and appends the lines to it, returns its new size"""
+    data = "".join(lines).encode('utf-8')
+    if isinstance(target, MockTarget):
+        kept = target.fs.get_data(target.path)[:size] if target.exists() else b''
+        with target.open('w') as f:
+            f.write((kept + data).decode('utf-8'))
+        return len(kept) + len(data)
+    elif isinstance(target, luigi.LocalTarget):
+        with open(target.path, 'r+b' if os.path.exists(target.path) else 'wb') as f:
+            kept = min(size, f.seek(0, os.SEEK_END))
+            f.truncate(kept)
+            f.seek(kept)
+            f.write(data)
+        return kept + len(data)
+    else:
+        raise Exception("append_lines: " + target.path + " cannot be appended to.")
+
+
+def index_constant(e):
+    """the text of a literal (sql2ra keeps literals as attribute references), None for an attribute"""
+    if isinstance(e, radb.ast.RAString) or isinstance(e, radb.ast.RANumber):
+        return e.val
+    if isinstance(e, radb.ast.AttrRef) and e.rel is None and (e.name.startswith("'") or e.name.isdigit()):
+        return e.name
+    return None
+
+
+def zone_terms(raquery):
+    """the terms attribute = literal of a selection evaluated on the tuples of a relation (renamed
+        or not), as pairs (attribute as stored, text of the literal) per relation"""
+    relation = chain_relation(raquery)
+    terms = []
+    for term in conjuncts(raquery.cond):
+        if isinstance(term, radb.ast.ValExprBinaryOp) and term.op == radb.ast.sym.EQ:
+            for attr, literal in (term.inputs, term.inputs[::-1]):
+                if isinstance(attr, radb.ast.AttrRef) and index_constant(attr) is None and \
+                        index_constant(literal) is not None:
+                    terms.append((relation + "." + attr.name, index_constant(literal)))
+    return {relation: terms} if terms else {}
+
+
+def bucket_filename(relation, i):
+    return relation + ".bucket" + str(i) + ".json"
+
+
+def bucket_of(key, count):
+    """the bucket of a tuple with the given join key (see join_key)"""
+    return zlib.crc32(key.encode('utf-8')) % count
+
+
+def bucket_layout(relation, env):
+    """the header of the bucket manifest of a relation (attribute, count, fingerprint), None if not bucketed"""
+    manifest = OutputMixin(exec_environment=env).get_output(relation + ".buckets")
+    if not manifest.exists():
+        return None
+    for line in read_lines(manifest):
+        return json.loads(line)
+    return None
+
+
+def bucket_join(raquery, env):
+    """(count, [left attribute, right attribute]) if a join can be evaluated bucket by bucket:
+        both inputs are relations (or scan chains over them) bucketed into as many buckets on
+        attributes the join condition equates, None otherwise"""
+    if not isinstance(raquery, radb.ast.Join) or join_strategy(raquery)[0] != 'hash':
+        return None
+    layouts = []
+    for ra in raquery.inputs:
+        if not isinstance(ra, radb.ast.RelRef) and not scan_chain(ra):
+            return None
+        if chain_relation(ra) in sampling.configured():
+            return None
+        layouts.append(bucket_layout(chain_relation(ra), env))
+    if None in layouts or layouts[0]["count"] != layouts[1]["count"]:
+        return None
+    for a, b in zip(*join_attributes(raquery)):
+        if a[a.index(".") + 1:] == layouts[0]["attribute"] and b[b.index(".") + 1:] == layouts[1]["attribute"]:
+            return layouts[0]["count"], [layouts[0]["attribute"], layouts[1]["attribute"]]
+    return None
+
+
+def index_seek(raquery, env):
+    """the (kind, attribute, literal) of an index the selection on top of the scan chain raquery
+        can be looked up in with a term attribute = literal, None if there is no such index"""
+    if env == ExecEnv.HDFS or not isinstance(raquery, radb.ast.Select) or not scan_chain(raquery):
+        return None
+    relation = chain_relation(raquery)
+    if relation in sampling.configured():
+        return None
+    for term in conjuncts(raquery.cond):
+        if not isinstance(term, radb.ast.ValExprBinaryOp) or term.op != radb.ast.sym.EQ:
+            continue
+        for attr, literal in (term.inputs, term.inputs[::-1]):
+            if isinstance(attr, radb.ast.AttrRef) and index_constant(attr) is None and \
+                    index_constant(literal) is not None:
+                for kind in index.KINDS:
+                    task = IndexTask(relation=relation, attribute=attr.name, kind=kind, exec_environment=env)
+                    if task.output().exists():
+                        return kind, attr.name, index_constant(literal)
+    return None
+
+
+def initial_state(func, value):
+    """the partial aggregation state of a single value"""
+    if func == 'count':
+        return 1
+    if func == 'avg':
+        return [value, 1]
+    return value
+
+
+def merge_states(func, a, b):
+    """merges two partial aggregation states"""
+    if func in ('count', 'sum'):
+        return a + b
+    if func == 'min':
+        return min(a, b)
+    if func == 'max':
+        return max(a, b)
+    if func == 'avg':
+        return [a[0] + b[0], a[1] + b[1]]
+    raise Exception("Aggregate function " + func + " not implemented (yet).")
+
+
+def final_value(func, state):
+    """the aggregate value of a (fully merged) aggregation state"""
+    return float(state[0]) / state[1] if func == 'avg' else state
+
+
+def order_value(attribute, json_tuple):
+    """the value of an order by attribute (or aggregate) in a tuple, unqualified attributes match any relation"""
+    if attribute in json_tuple:
+        return json_tuple[attribute]
+    for k, v in json_tuple.items():
+        if k.endswith("." + attribute):
+            return v
+    raise KeyError(attribute)
+
+
+class SortKey(object):
+    """orders tuples on a list of (attribute, 'asc' or 'desc') pairs"""
+
+    def __init__(self, order_by, json_tuple):
+        self.values = [order_value(attribute, json_tuple) for attribute, direction in order_by]
+        self.descending = [direction == 'desc' for attribute, direction in order_by]
+
+    def __lt__(self, other):
+        for a, b, desc in zip(self.values, other.values, self.descending):
+            if a != b:
+                return a > b if desc else a < b
+        return False
+
+
+class HeapItem(object):
+    """an entry of a bounded top-k heap, the root being the last tuple in sort order"""
+
+    def __init__(self, key, line):
+        self.key = key
+        self.line = line
+
+    def __lt__(self, other):
+        return other.key < self.key
+
+
 def extract_cond(table_name, cond):
     """returns a list of tuple(s) each tuple contains the 2 terms of a condition"""
-    condition = re.sub("and", "", str(cond))
-    cond_list = re.findall(r"[\w']+[.|\s][\w']+|[\d']+[-]+[\w']+|[\w']+[\d']+|[\d']+|[\w']+[\w']+", condition)
+    cond_list = []
+    for term in conjuncts(cond):
+        cond_list += re.findall(r"[\w']+[.|\s][\w']+|[\d']+[-]+[\w']+|[\w']+[\d']+|[\d']+|[\w']+[\w']+", str(term))
     L = []
     n = len(cond_list)
     for i in range(0, n - 1, 2):
@@ -91,22 +1029,102 @@ Switches between different execution environments and file systems.
 class OutputMixin(luigi.Task):
     exec_environment = luigi.EnumParameter(enum=ExecEnv, default=ExecEnv.HDFS)
 
+    '''
+    The codec (gzip, zstd, lz4) the task compresses its intermediate files with,
+    e.g. set per operator in the luigi configuration ([JoinTask] compress=lz4);
+    by default the one of [minihive] compression, if any (see compression.py).
+    Base relations and the files kept with them are never compressed. Outputs
+    are read whatever their codec.
+    '''
+    compress = luigi.Parameter(default="", significant=False)
+    intermediate = True
+
+    @property
+    def resources(self):
+        if memory_budget() <= 0:
+            return {}
+        return memory_claim(self.scanned_relations(), self.exec_environment)
+
+    def scanned_relations(self):
+        """the relations below the task, which its memory claim is proportional to"""
+        querystring = getattr(self, 'querystring', None)
+        if querystring is None:
+            return set()
+        return base_relations(radb.parse.one_statement_from_string(querystring))
+
+    def codec(self):
+        """the codec of the files the task writes, None for plain files; in HDFS, the hadoop
+            jobs compress their outputs themselves (see jobconfs)"""
+        if not self.intermediate or self.exec_environment == ExecEnv.HDFS:
+            return None
+        return self.compress or compression.configured() or None
+
     def get_output(self, fn):
+        format = compression.text_format(self.codec())
         if self.exec_environment == ExecEnv.HDFS:
-            return luigi.contrib.hdfs.HdfsTarget(fn)
+            return luigi.contrib.hdfs.HdfsTarget(fn, format=format)
         elif self.exec_environment == ExecEnv.MOCK:
-            return MockTarget(fn)
+            return MockTarget(fn, format=format)
         else:
-            return luigi.LocalTarget(fn)
+            return luigi.LocalTarget(fn, format=format)
+
+    '''
+    While checkpointing (see checkpoint.py), an intermediate is complete once the
+    task writing it has been committed by its manifest, not as soon as it exists.
+    '''
+
+    def checkpointed(self):
+        return self.intermediate and self.exec_environment != ExecEnv.HDFS and checkpoint.enabled()
+
+    def manifest(self):
+        """the manifest committing the outputs of the task, next to the first of them"""
+        path = luigi.task.flatten(self.output())[0].path
+        return InputData(filename=path + ".manifest", exec_environment=self.exec_environment).output()
+
+    def versions(self):
+        """the [path, fingerprint] of each output of the task, None if any of them is missing"""
+        outputs = luigi.task.flatten(self.output())
+        if not all(target.exists() for target in outputs):
+            return None
+        return [[target.path, fingerprint(target)] for target in outputs]
+
+    def commit(self):
+        checkpoint.save(self.manifest(), {"task": self.task_id, "outputs": self.versions()})
+
+    def complete(self):
+        if not self.checkpointed():
+            return super(OutputMixin, self).complete()
+        versions = self.versions()
+        if versions is None:
+            return False
+        record = checkpoint.load(self.manifest())
+        return record is not None and record["task"] == self.task_id and record["outputs"] == versions
 
 
 class InputData(OutputMixin):
     filename = luigi.Parameter()
+    intermediate = False
 
     def output(self):
         return self.get_output(self.filename)
 
 
+@luigi.Task.event_handler(luigi.Event.SUCCESS)
+def commit(task):
+    if isinstance(task, OutputMixin) and task.checkpointed():
+        task.commit()
+
+
+def relation_input(relation, env):
+    """the task providing the tuples of a relation: its file, or a sample of it for approximate
+        queries (see sampling.py)"""
+    spec = sampling.configured().get(relation)
+    if spec is not None:
+        return SampleTask(relation=relation, method=spec["method"], fraction=spec["fraction"], key=spec["key"],
+                          seed=spec["seed"], exec_environment=env)
+    return InputData(filename=relation + ".json", exec_environment=env)
+
+
 '''
 Counts the number of steps / luigi tasks that we need for evaluating this query.
 '''
@@ -119,9 +1137,12 @@ def count_steps(raquery):
             isinstance(raquery, radb.ast.Rename)):
         return 1 + count_steps(raquery.inputs[0])
 
-    elif isinstance(raquery, radb.ast.Join):
+    elif isinstance(raquery, radb.ast.Join) or isinstance(raquery, radb.ast.Cross):
         return 1 + count_steps(raquery.inputs[0]) + count_steps(raquery.inputs[1])
 
+    elif isinstance(raquery, radb.ast.Aggr):
+        return 1 + count_steps(raquery.inputs[0])
+
     elif isinstance(raquery, radb.ast.RelRef):
         return 1
 
@@ -129,6 +1150,396 @@ def count_steps(raquery):
         raise Exception("count_steps: Cannot handle operator " + str(type(raquery)) + ".")
 
 
+class BloomFilterTask(OutputMixin):
+    '''
+    Cheap pre-pass of the semi-join reduction: reads the filtered input of a join
+    and stores a Bloom filter of its join keys as a side file (bloom1, bloom2, ...).
+    '''
+    querystring = luigi.Parameter()
+    step = luigi.IntParameter(default=1)
+    prefix = luigi.Parameter(default="")
+
+    def requires(self):
+        raquery = radb.parse.one_statement_from_string(self.querystring)
+        assert (isinstance(raquery, radb.ast.Join))
+
+        return join_input_tasks(raquery, self.step, self.exec_environment, self.prefix)[semi_join_side(raquery)]
+
+    def output(self):
+        if self.exec_environment == ExecEnv.HDFS:
+            filename = self.prefix + "bloom" + str(self.step)
+        else:
+            filename = self.prefix + "bloom" + str(self.step) + ".tmp"
+        return self.get_output(filename)
+
+    def run(self):
+        raquery = radb.parse.one_statement_from_string(self.querystring)
+        attrs = join_attributes(raquery)[semi_join_side(raquery)]
+        keys = set()
+        for line in read_lines(self.input()):
+            relation, tuple = line.split('\t')
+            keys.add(join_key(codec.loads(tuple), attrs))
+
+        keys_filter = bloom.BloomFilter.for_capacity(len(keys))
+        for key in keys:
+            keys_filter.add(key)
+        with self.output().open('w') as f:
+            f.write("bloom\t" + keys_filter.dumps() + "\n")
+
+
+def scan_leaves(raquery, step=1):
+    """returns the scan chains of a query with the steps of the (non optimized) tasks evaluating them"""
+    if scan_chain(raquery):
+        return [(raquery, step)]
+    if isinstance(raquery, radb.ast.Join) or isinstance(raquery, radb.ast.Cross):
+        return scan_leaves(raquery.inputs[0], step + 1) + \
+            scan_leaves(raquery.inputs[1], step + count_steps(raquery.inputs[0]) + 1)
+    if isinstance(raquery, radb.ast.RelRef):
+        return []
+    return scan_leaves(raquery.inputs[0], step + 1)
+
+
+class SharedScanTask(OutputMixin):
+    '''
+    Reads a relation once for several scan chains (selections and renamings over
+    the relation), typically of different queries evaluated together, and writes
+    the result of each chain where the task evaluating it alone would have written
+    it. Those tasks are then complete and never read the relation themselves.
+    '''
+    relation = luigi.Parameter()
+
+    '''
+    Pairs (querystring of the scan chain, output filename).
+    '''
+    scans = luigi.ListParameter()
+
+    def requires(self):
+        return InputData(filename=self.relation + ".json", exec_environment=self.exec_environment)
+
+    def scanned_relations(self):
+        return {self.relation}
+
+    def output(self):
+        return [self.get_output(filename) for querystring, filename in self.scans]
+
+    def run(self):
+        chains = [radb.parse.one_statement_from_string(querystring) for querystring, filename in self.scans]
+        outputs = [target.open('w') for target in self.output()]
+        for relation, json_tuple in scan_tuples(self.input()):
+            for ra, f in zip(chains, outputs):
+                res = apply_chain(ra, relation, json_tuple)
+                if res is not None:
+                    f.write(relation + "\t" + codec.dumps(res) + "\n")
+        for f in outputs:
+            f.close()
+
+
+class BucketTask(OutputMixin):
+    '''
+    Stores a relation as count hash buckets on one attribute, next to the relation
+    (CUSTOMER.bucket0.json, ...). The manifest (CUSTOMER.buckets), written last,
+    records the layout and the version of the relation: once the relation has
+    changed, the buckets are built again.
+    '''
+    relation = luigi.Parameter()
+    attribute = luigi.Parameter()
+    count = luigi.IntParameter()
+    intermediate = False
+
+    def requires(self):
+        return InputData(filename=self.relation + ".json", exec_environment=self.exec_environment)
+
+    def output(self):
+        return [self.get_output(self.relation + ".buckets")] + \
+            [self.get_output(bucket_filename(self.relation, i)) for i in range(self.count)]
+
+    def complete(self):
+        layout = bucket_layout(self.relation, self.exec_environment)
+        return layout is not None and layout["attribute"] == self.attribute and layout["count"] == self.count and \
+            up_to_date(self.output()[0], self.input()) and all(target.exists() for target in self.output())
+
+    def run(self):
+        attrs = [self.relation + "." + self.attribute]
+        buckets = [target.open('w') for target in self.output()[1:]]
+        for line in read_lines(self.input()):
+            relation, tuple = line.rstrip('\n').split('\t')
+            buckets[bucket_of(join_key(codec.loads(tuple), attrs), self.count)].write(line.rstrip('\n') + "\n")
+        for f in buckets:
+            f.close()
+        with self.output()[0].open('w') as f:
+            f.write(json.dumps({"relation": self.relation, "attribute": self.attribute, "count": self.count,
+                                "fingerprint": fingerprint(self.input())}) + "\n")
+
+
+class IndexTask(OutputMixin):
+    '''
+    The index of a relation on one attribute (see index.py). It is complete while
+    it is up to date: when the relation changes, the index is built again.
+    '''
+    relation = luigi.Parameter()
+    attribute = luigi.Parameter()
+    kind = luigi.Parameter(default="hash")
+    intermediate = False
+
+    def requires(self):
+        return InputData(filename=self.relation + ".json", exec_environment=self.exec_environment)
+
+    def output(self):
+        return self.get_output(index.filename(self.relation, self.attribute, self.kind))
+
+    def complete(self):
+        return up_to_date(self.output(), self.input())
+
+    def run(self):
+        built = index.Index.build(self.relation, self.attribute, self.kind, fingerprint(self.input()),
+                                  offset_tuples(self.input()))
+        with self.output().open('w') as f:
+            f.write(built.dumps())
+
+
+class ZoneMapTask(OutputMixin):
+    '''
+    The zone map of a relation (see zonemap.py), built again when the relation
+    changes.
+    '''
+    relation = luigi.Parameter()
+    block_rows = luigi.IntParameter(default=1000, significant=False)
+    intermediate = False
+
+    def requires(self):
+        return InputData(filename=self.relation + ".json", exec_environment=self.exec_environment)
+
+    def output(self):
+        return self.get_output(zonemap.filename(self.relation))
+
+    def complete(self):
+        return up_to_date(self.output(), self.input())
+
+    def run(self):
+        zones = zonemap.ZoneMap.build(self.relation, fingerprint(self.input()), offset_tuples(self.input()),
+                                      target_size(self.input()), self.block_rows)
+        with self.output().open('w') as f:
+            f.write(zones.dumps())
+
+
+class SampleTask(OutputMixin):
+    '''
+    A sample of a relation (see sampling.py): its tuples kept with probability
+    fraction (bernoulli), those of its blocks of block_size bytes kept with that
+    probability (block), or those whose key hashes below fraction (hash).
+    '''
+    relation = luigi.Parameter()
+    method = luigi.Parameter(default="bernoulli")
+    fraction = luigi.FloatParameter()
+    key = luigi.ListParameter(default=[])
+    seed = luigi.IntParameter(default=0)
+    block_size = luigi.IntParameter(default=64 * 1024, significant=False)
+
+    def requires(self):
+        return InputData(filename=self.relation + ".json", exec_environment=self.exec_environment)
+
+    def output(self):
+        spec = json.dumps([self.method, self.fraction, list(self.key), self.seed])
+        filename = self.relation + ".sample" + "%08x" % zlib.crc32(spec.encode('utf-8'))
+        return self.get_output(filename if self.exec_environment == ExecEnv.HDFS else filename + ".tmp")
+
+    def blocks(self):
+        """the byte ranges of the blocks kept by block sampling"""
+        size = target_size(self.input())
+        return [(start, min(start + self.block_size, size)) for start in range(0, size, self.block_size)
+                if sampling.hashed(start // self.block_size, self.seed) < self.fraction]
+
+    def sample(self):
+        """yields the lines of the sample"""
+        if self.method == "block" and self.exec_environment != ExecEnv.HDFS:
+            for line in range_lines(self.input(), self.blocks()):
+                yield line
+            return
+        offset = 0
+        rng = random.Random(self.seed)
+        for line in read_lines(self.input()):
+            if self.method == "hash":
+                json_tuple = codec.loads(line.split('\t')[1])
+                keep = sampling.hashed([json_tuple[self.relation + "." + a] for a in self.key], self.seed)
+            elif self.method == "block":
+                keep = sampling.hashed(offset // self.block_size, self.seed)
+                offset += len(line.encode('utf-8'))
+            else:
+                keep = rng.random()
+            if keep < self.fraction:
+                yield line
+
+    def run(self):
+        with self.output().open('w') as f:
+            for line in self.sample():
+                f.write(line)
+
+
+class FetchTask(OutputMixin):
+    '''
+    The joins of a query evaluated on narrow tuples, whose other attributes are
+    fetched at their locators (see latemat.py), one read per relation tuple.
+    '''
+    querystring = luigi.Parameter()
+    step = luigi.IntParameter(default=1)
+    prefix = luigi.Parameter(default="")
+    optimize = luigi.BoolParameter(default=False)
+
+    def requires(self):
+        raquery = radb.parse.one_statement_from_string(self.querystring)
+        return task_factory(raquery, step=self.step + 1, env=self.exec_environment, optimize=self.optimize,
+                            prefix=self.prefix, materialize=False)
+
+    def output(self):
+        if self.exec_environment == ExecEnv.HDFS:
+            filename = self.prefix + "tmp" + str(self.step)
+        else:
+            filename = self.prefix + "tmp" + str(self.step) + ".tmp"
+        return self.get_output(filename)
+
+    def locators(self, json_tuple):
+        """(alias, file, offset) of the relation tuples a narrow tuple was joined from"""
+        for k, v in json_tuple.items():
+            if k.endswith("." + latemat.LOCATOR):
+                yield k[:-len(latemat.LOCATOR) - 1], v[0], v[1]
+
+    def run(self):
+        offsets = {}
+        for relation, json_tuple in scan_tuples(self.input()):
+            for alias, path, offset in self.locators(json_tuple):
+                offsets.setdefault(path, set()).add(offset)
+        fetched = {}
+        for path, wanted in offsets.items():
+            wanted = sorted(wanted)
+            lines = lines_at(InputData(filename=path, exec_environment=self.exec_environment).output(), wanted)
+            fetched[path] = {offset: codec.loads(line.split('\t')[1]) for offset, line in zip(wanted, lines)}
+
+        with self.output().open('w') as f:
+            for relation, json_tuple in scan_tuples(self.input()):
+                d = {k: v for k, v in json_tuple.items() if not k.endswith("." + latemat.LOCATOR)}
+                for alias, path, offset in self.locators(json_tuple):
+                    for k, v in fetched[path][offset].items():
+                        d[alias + k[k.index("."):]] = v
+                f.write(relation + "\t" + codec.dumps(d) + "\n")
+
+
+class ViewTask(OutputMixin):
+    '''
+    A materialized view (see views.py): evaluates its query on the rows appended
+    to its relations since the last refresh and merges the result into the
+    stored output. It is complete while none of its relations has grown.
+    '''
+    name = luigi.Parameter()
+    querystring = luigi.Parameter()
+    intermediate = False
+
+    def requires(self):
+        raquery = radb.parse.one_statement_from_string(self.querystring)
+        return {relation: InputData(filename=relation + ".json", exec_environment=self.exec_environment)
+                for relation in sorted(base_relations(raquery))}
+
+    def output(self):
+        return [self.get_output(views.filename(self.name)), self.get_output(views.output_filename(self.name))]
+
+    def load(self):
+        """the state of the view, a new one if there is none for the query"""
+        manifest = self.output()[0]
+        if manifest.exists():
+            with manifest.open('r') as f:
+                view = views.View.loads(f.read())
+            if view.querystring == self.querystring:
+                return view
+        return views.View(self.name, self.querystring)
+
+    def complete(self):
+        if not self.output()[0].exists():
+            return False
+        marks = self.load().marks
+        return all(target.exists() and marks.get(relation) == target_size(target)
+                   for relation, target in self.input().items())
+
+    def run(self):
+        raquery = radb.parse.one_statement_from_string(self.querystring)
+        view = self.load()
+        sizes = {relation: target_size(target) for relation, target in self.input().items()}
+        if any(sizes[relation] < view.marks.get(relation, 0) for relation in sizes):
+            view = views.View(self.name, self.querystring)  # a relation was rewritten, not appended to
+        lines = []
+        for ranges in delta_terms(raquery, view.marks, sizes):
+            lines += view.merge(delta_stream(raquery, ranges, self.exec_environment))
+        view.output_size = append_lines(self.output()[1], view.output_size, lines)
+        view.marks = sizes
+        with self.output()[0].open('w') as f:
+            f.write(view.dumps())
+
+
+class IndexSeekTask(OutputMixin):
+    '''
+    Evaluates a scan chain whose top selection holds a term attribute = literal on
+    an indexed attribute: only the lines the index points to are read, and the
+    whole chain is evaluated on them.
+    '''
+    querystring = luigi.Parameter()
+    kind = luigi.Parameter(default="hash")
+    attribute = luigi.Parameter()
+    literal = luigi.Parameter()
+    step = luigi.IntParameter(default=1)
+    prefix = luigi.Parameter(default="")
+
+    def requires(self):
+        raquery = radb.parse.one_statement_from_string(self.querystring)
+        return IndexTask(relation=chain_relation(raquery), attribute=self.attribute, kind=self.kind,
+                         exec_environment=self.exec_environment)
+
+    def output(self):
+        if self.exec_environment == ExecEnv.HDFS:
+            filename = self.prefix + "tmp" + str(self.step)
+        else:
+            filename = self.prefix + "tmp" + str(self.step) + ".tmp"
+        return self.get_output(filename)
+
+    def run(self):
+        raquery = radb.parse.one_statement_from_string(self.querystring)
+        with self.input().open('r') as f:
+            found = index.Index.loads(f.read())
+        data = self.requires().input()
+        with self.output().open('w') as f:
+            for line in lines_at(data, found.lookup(self.literal)):
+                relation, tuple = line.split('\t')
+                res = apply_chain(raquery, relation, codec.loads(tuple))
+                if res is not None:
+                    f.write(relation + "\t" + codec.dumps(res) + "\n")
+
+
+class LimitScanTask(OutputMixin):
+    '''
+    LIMIT pushed into a scan: evaluates a scan chain (or a bare relation) and stops
+    reading the relation as soon as limit tuples have been written. Only used where
+    no operator between the scan and the LIMIT may drop or reorder tuples.
+    '''
+    querystring = luigi.Parameter()
+    limit = luigi.IntParameter()
+    step = luigi.IntParameter(default=1)
+    prefix = luigi.Parameter(default="")
+
+    def requires(self):
+        raquery = radb.parse.one_statement_from_string(self.querystring)
+        return InputData(filename=chain_relation(raquery) + ".json", exec_environment=self.exec_environment)
+
+    def output(self):
+        if self.exec_environment == ExecEnv.HDFS:
+            filename = self.prefix + "tmp" + str(self.step)
+        else:
+            filename = self.prefix + "tmp" + str(self.step) + ".tmp"
+        return self.get_output(filename)
+
+    def run(self):
+        raquery = radb.parse.one_statement_from_string(self.querystring)
+        with self.output().open('w') as f:
+            for relation, json_tuple in itertools.islice(stream_tuples(raquery, self.exec_environment), self.limit):
+                f.write(relation + "\t" + codec.dumps(json_tuple) + "\n")
+
+
 class RelAlgQueryTask(luigi.contrib.hadoop.JobTask, OutputMixin):
     '''
     Each physical operator knows its (partial) query string.
@@ -144,6 +1555,18 @@ class RelAlgQueryTask(luigi.contrib.hadoop.JobTask, OutputMixin):
     '''
     step = luigi.IntParameter(default=1)
 
+    '''
+    Queries evaluated side by side (see queryserver.py) prefix their
+    temporary files, so that they do not overwrite each other.
+    '''
+    prefix = luigi.Parameter(default="")
+
+    '''
+    Run locally, jobs with count_rows set record the number of rows they
+    output (see MappedJobRunner), which the adaptive plans below are made from.
+    '''
+    count_rows = luigi.BoolParameter(default=False, significant=False)
+
     '''
     In HDFS, we call the folders for temporary data tmp1, tmp2, ...
     In the local or mock file system, we call the files tmp1.tmp...
@@ -151,11 +1574,171 @@ class RelAlgQueryTask(luigi.contrib.hadoop.JobTask, OutputMixin):
 
     def output(self):
         if self.exec_environment == ExecEnv.HDFS:
-            filename = "tmp" + str(self.step)
+            filename = self.prefix + "tmp" + str(self.step)
         else:
-            filename = "tmp" + str(self.step) + ".tmp"
+            filename = self.prefix + "tmp" + str(self.step) + ".tmp"
         return self.get_output(filename)
 
+    def job_runner(self):
+        if self.exec_environment != ExecEnv.HDFS:
+            return MappedJobRunner()
+        return super(RelAlgQueryTask, self).job_runner()
+
+    '''
+    Hadoop streaming ships luigi and the module of the job (ra2mr) to the
+    cluster, the modules of miniHive the jobs import are shipped with them.
+    '''
+
+    def extra_modules(self):
+        return [bloom, checkpoint, codec, compression, index, latemat, localscan, raopt, sampling, views, zonemap]
+
+    def jobconfs(self):
+        return super(RelAlgQueryTask, self).jobconfs() + \
+            compression.codec_jobconfs(self.compress or compression.configured())
+
+    '''
+    Operators reading a relation with a selection attr = literal only read the
+    blocks of the relation that may hold matching tuples, as told by its zone
+    map (see zonemap.py), if it has one. Not in HDFS, where hadoop reads the
+    input itself.
+    '''
+
+    def zone_predicates(self):
+        """the terms (attribute, literal) of the selection per relation read, see zone_terms"""
+        return {}
+
+    def requires_local(self):
+        if self.exec_environment == ExecEnv.HDFS:
+            return []
+        tasks = [ZoneMapTask(relation=relation, exec_environment=self.exec_environment)
+                 for relation in self.zone_predicates()]
+        return [task for task in tasks if task.output().exists()]
+
+    def init_local(self):
+        self.zones = {}
+        for target in luigi.task.flatten(self.input_local()):
+            zones = zonemap.ZoneMap.loads(target.open('r').read())
+            self.zones[zones.relation + ".json"] = zones
+
+    def input_ranges(self, target):
+        """the byte ranges of an input the mappers need, None for all of it"""
+        zones = getattr(self, 'zones', {}).get(target.path)
+        if zones is None:
+            return None
+        return zones.ranges(self.zone_predicates()[zones.relation])
+
+    '''
+    Under late materialization (see latemat.py), the mappers read the relations
+    below the joins narrow: each tuple is cut down to the attributes the joins
+    need and its locator as its line is read, no narrow copy of the relation is
+    written. Not in HDFS, where the mappers do not know the byte offsets of their
+    lines.
+    '''
+
+    def narrow_attributes(self, target):
+        """the attributes an input is read narrow with, None if it is read as it is"""
+        if self.exec_environment == ExecEnv.HDFS:
+            return None
+        for relation, attributes in latemat.configured().get("relations", {}).items():
+            if target.path == relation + ".json":
+                return attributes
+        return None
+
+    def map_lines(self, target, ranges):
+        """the lines of an input the mappers read, of those beginning in the byte ranges (all if None)"""
+        attributes = self.narrow_attributes(target)
+        if attributes is None:
+            return range_lines(target, ranges)
+        return narrow_lines(target, ranges, target.path[:-len(".json")], attributes)
+
+
+class BucketJoinPartTask(RelAlgQueryTask):
+    '''
+    Joins bucket i of the left input with bucket i of the right input, without a
+    shuffle: matching tuples agree on the bucketing attributes and so lie in
+    buckets with the same number. A map-only job streams the left bucket through
+    the mappers, each of which first reads the right bucket into a hash table on
+    its join attributes.
+    '''
+    bucket = luigi.IntParameter()
+    count = luigi.IntParameter()
+    attributes = luigi.ListParameter()
+    reducer = NotImplemented
+
+    def requires(self):
+        raquery = radb.parse.one_statement_from_string(self.querystring)
+        return [BucketTask(relation=chain_relation(ra), attribute=attribute, count=self.count,
+                           exec_environment=self.exec_environment)
+                for ra, attribute in zip(raquery.inputs, self.attributes)]
+
+    def bucket_input(self, side):
+        """bucket i of the left (0) or right (1) input"""
+        filename = bucket_filename(self.requires()[side].relation, self.bucket)
+        return InputData(filename=filename, exec_environment=self.exec_environment).output()
+
+    def input_hadoop(self):
+        return [self.bucket_input(0)]
+
+    def output(self):
+        filename = self.prefix + "tmp" + str(self.step) + ".part" + str(self.bucket)
+        return self.get_output(filename if self.exec_environment == ExecEnv.HDFS else filename + ".tmp")
+
+    def init_mapper(self):
+        raquery = radb.parse.one_statement_from_string(self.querystring)
+        self.chain = raquery.inputs[0]
+        self.cond = raquery.cond
+        self.attrs = join_attributes(raquery)
+        self.table = {}
+        for relation, json_tuple in scan_tuples(self.bucket_input(1)):
+            json_tuple = apply_chain(raquery.inputs[1], relation, json_tuple)
+            if json_tuple is not None:
+                self.table.setdefault(join_key(json_tuple, self.attrs[1]), []).append(json_tuple)
+
+    def mapper(self, line):
+        relation, tuple = line.split('\t')
+        json_tuple = apply_chain(self.chain, relation, codec.loads(tuple))
+        if json_tuple is None:
+            return
+        for other in self.table.get(join_key(json_tuple, self.attrs[0]), []):
+            d = dict(json_tuple)
+            d.update(other)
+            if eval_cond(self.cond, d):
+                yield ('joint1', codec.dumps(d))
+
+
+class BucketJoinTask(OutputMixin):
+    '''
+    Join of two compatibly bucketed relations (see bucket_join): one map-only
+    BucketJoinPartTask per pair of buckets, run side by side, whose outputs are
+    then concatenated.
+    '''
+    querystring = luigi.Parameter()
+    count = luigi.IntParameter()
+    attributes = luigi.ListParameter()
+    step = luigi.IntParameter(default=1)
+    prefix = luigi.Parameter(default="")
+
+    def requires(self):
+        return [BucketJoinPartTask(querystring=self.querystring, bucket=i, count=self.count,
+                                   attributes=self.attributes, step=self.step, prefix=self.prefix,
+                                   exec_environment=self.exec_environment)
+                for i in range(self.count)]
+
+    def output(self):
+        if self.exec_environment == ExecEnv.HDFS:
+            filename = self.prefix + "tmp" + str(self.step)
+        else:
+            filename = self.prefix + "tmp" + str(self.step) + ".tmp"
+        return self.get_output(filename)
+
+    def run(self):
+        with self.output().open('w') as f:
+            for part in self.input():
+                for line in read_lines(part):
+                    f.write(line)
+        for part in self.input():
+            part.remove()
+
 
 '''
 Given the radb-string representation of a relational algebra query,
@@ -163,48 +1746,74 @@ this produces a tree of luigi tasks with the physical query operators.
 '''
 
 
-def task_factory(raquery, step=1, env=ExecEnv.HDFS, optimize=False):
+def task_factory(raquery, step=1, env=ExecEnv.HDFS, optimize=False, prefix="", materialize=True):
     assert (isinstance(raquery, radb.ast.Node))
 
+    # under late materialization, the joins are evaluated narrow below a FetchTask (see latemat.py)
+    if materialize and env != ExecEnv.HDFS and latemat.configured().get("root") == str(raquery):
+        return FetchTask(querystring=str(raquery) + ";", step=step, exec_environment=env, optimize=optimize,
+                         prefix=prefix)
+
+    seek = index_seek(raquery, env)
+    if seek is not None:
+        kind, attribute, literal = seek
+        return IndexSeekTask(querystring=str(raquery) + ";", kind=kind, attribute=attribute, literal=literal,
+                             step=step, exec_environment=env, prefix=prefix)
+
+    bucketed = bucket_join(raquery, env)
+    if bucketed is not None:
+        count, attributes = bucketed
+        return BucketJoinTask(querystring=str(raquery) + ";", count=count, attributes=attributes, step=step,
+                              exec_environment=env, prefix=prefix)
+
     if optimize:
         if isinstance(raquery, radb.ast.Select):
-            return SelectOpTask(querystring=str(raquery) + ";", step=step, exec_environment=env)
+            return SelectOpTask(querystring=str(raquery) + ";", step=step, exec_environment=env, prefix=prefix)
 
         elif isinstance(raquery, radb.ast.Join):
-            return JointOpTask(querystring=str(raquery) + ";", step=step, exec_environment=env)
+            return JointOpTask(querystring=str(raquery) + ";", step=step, exec_environment=env, prefix=prefix)
 
         elif isinstance(raquery, radb.ast.Rename):
-            return RenameOpTask(querystring=str(raquery) + ";", step=step, exec_environment=env)
+            return RenameOpTask(querystring=str(raquery) + ";", step=step, exec_environment=env, prefix=prefix)
 
         elif isinstance(raquery, radb.ast.RelRef):
-            filename = raquery.rel + ".json"
-            return InputData(filename=filename, exec_environment=env)
+            return relation_input(raquery.rel, env)
 
         elif isinstance(raquery, radb.ast.Project):
-            return ProjectOpTask(querystring=str(raquery) + ";", step=step, exec_environment=env)
+            return ProjectOpTask(querystring=str(raquery) + ";", step=step, exec_environment=env, prefix=prefix)
+
+        elif isinstance(raquery, radb.ast.Cross):
+            return CrossTask(querystring=str(raquery) + ";", step=step, exec_environment=env, prefix=prefix, optimize=True)
+
+        elif isinstance(raquery, radb.ast.Aggr):
+            return AggregateTask(querystring=str(raquery) + ";", step=step, exec_environment=env, prefix=prefix,
+                                 optimize=True)
 
         else:
-            # We will not evaluate the Cross product on Hadoop, too expensive.
             raise Exception("Operator " + str(type(raquery)) + " not implemented (yet).")
     else:
         if isinstance(raquery, radb.ast.Select):
-            return SelectTask(querystring=str(raquery) + ";", step=step, exec_environment=env)
+            return SelectTask(querystring=str(raquery) + ";", step=step, exec_environment=env, prefix=prefix)
 
         elif isinstance(raquery, radb.ast.RelRef):
-            filename = raquery.rel + ".json"
-            return InputData(filename=filename, exec_environment=env)
+            return relation_input(raquery.rel, env)
 
         elif isinstance(raquery, radb.ast.Join):
-            return JoinTask(querystring=str(raquery) + ";", step=step, exec_environment=env)
+            return JoinTask(querystring=str(raquery) + ";", step=step, exec_environment=env, prefix=prefix)
 
         elif isinstance(raquery, radb.ast.Project):
-            return ProjectTask(querystring=str(raquery) + ";", step=step, exec_environment=env)
+            return ProjectTask(querystring=str(raquery) + ";", step=step, exec_environment=env, prefix=prefix)
 
         elif isinstance(raquery, radb.ast.Rename):
-            return RenameTask(querystring=str(raquery) + ";", step=step, exec_environment=env)
+            return RenameTask(querystring=str(raquery) + ";", step=step, exec_environment=env, prefix=prefix)
+
+        elif isinstance(raquery, radb.ast.Cross):
+            return CrossTask(querystring=str(raquery) + ";", step=step, exec_environment=env, prefix=prefix)
+
+        elif isinstance(raquery, radb.ast.Aggr):
+            return AggregateTask(querystring=str(raquery) + ";", step=step, exec_environment=env, prefix=prefix)
 
         else:
-            # We will not evaluate the Cross product on Hadoop, too expensive.
             raise Exception("Operator " + str(type(raquery)) + " not implemented (yet).")
 
 
@@ -214,40 +1823,40 @@ class JointOpTask(RelAlgQueryTask):
         ra = radb.parse.one_statement_from_string(self.querystring)
         assert (isinstance(ra, radb.ast.Join))
 
-        task1 = task_factory(ra.inputs[0], step=self.step + 1, env=self.exec_environment, optimize=True)
+        task1 = task_factory(ra.inputs[0], step=self.step + 1, env=self.exec_environment, optimize=True, prefix=self.prefix)
         task2 = task_factory(ra.inputs[1], step=self.step + count_steps(ra.inputs[0]) + 1,
-                             env=self.exec_environment, optimize=True)
+                             env=self.exec_environment, optimize=True, prefix=self.prefix)
         if isinstance(ra.inputs[0], radb.ast.Select):
             if isinstance(ra.inputs[0].inputs[0], radb.ast.Rename):
-                task1 = task_factory(ra.inputs[0].inputs[0].inputs[0], step=self.step + 1, env=self.exec_environment, optimize=True)
+                task1 = task_factory(ra.inputs[0].inputs[0].inputs[0], step=self.step + 1, env=self.exec_environment, optimize=True, prefix=self.prefix)
             else:
-                task1 = task_factory(ra.inputs[0].inputs[0], step=self.step + 1, env=self.exec_environment, optimize=True)
+                task1 = task_factory(ra.inputs[0].inputs[0], step=self.step + 1, env=self.exec_environment, optimize=True, prefix=self.prefix)
         elif isinstance(ra.inputs[1], radb.ast.Select):
             if isinstance(ra.inputs[1].inputs[0], radb.ast.Rename):
                 task2 = task_factory(ra.inputs[1].inputs[0].inputs[0], step=self.step + count_steps(ra.inputs[0]) + 1,
-                                     env=self.exec_environment, optimize=True)
+                                     env=self.exec_environment, optimize=True, prefix=self.prefix)
             else:
                 task2 = task_factory(ra.inputs[1].inputs[0], step=self.step + count_steps(ra.inputs[0]) + 1,
-                                     env=self.exec_environment, optimize=True)
+                                     env=self.exec_environment, optimize=True, prefix=self.prefix)
         if isinstance(ra.inputs[0], radb.ast.Rename):
-            task1 = task_factory(ra.inputs[0].inputs[0], step=self.step + 1, env=self.exec_environment, optimize=True)
+            task1 = task_factory(ra.inputs[0].inputs[0], step=self.step + 1, env=self.exec_environment, optimize=True, prefix=self.prefix)
         elif isinstance(ra.inputs[1], radb.ast.Rename):
             task2 = task_factory(ra.inputs[1].inputs[0], step=self.step + count_steps(ra.inputs[0]) + 1,
-                                 env=self.exec_environment, optimize=True)
+                                 env=self.exec_environment, optimize=True, prefix=self.prefix)
         return [task1, task2]
 
     def mapper(self, line):
         relation, tuple = line.split('\t')
-        json_tuple = json.loads(tuple)
+        json_tuple = codec.loads(tuple)
         ra = radb.parse.one_statement_from_string(self.querystring)
 
         input0 = ra.inputs[0]
         input1 = ra.inputs[1]
         if isinstance(input0, radb.ast.Join) and relation == 'joint1':  # ici l'erreur
-            res = json.dumps(json_tuple)
+            res = tuple
             yield ("join", res)
         if isinstance(input1, radb.ast.Join) and relation == 'joint1':
-            res = json.dumps(json_tuple)
+            res = tuple
             yield ("join", res)
 
         if isinstance(input0, radb.ast.Select):
@@ -271,7 +1880,7 @@ class JointOpTask(RelAlgQueryTask):
                             test = False
                             break
                     if test:
-                        res = json.dumps(d)
+                        res = codec.dumps(d)
                         yield ("join", res)
 
             elif input0.inputs[0].rel == relation:
@@ -284,7 +1893,7 @@ class JointOpTask(RelAlgQueryTask):
                         test = False
                         break
                 if test:
-                    res = json.dumps(json_tuple)
+                    res = tuple
                     yield ("join", res)
 
         elif isinstance(input0, radb.ast.Rename):
@@ -295,11 +1904,11 @@ class JointOpTask(RelAlgQueryTask):
                 new_key_list = [e.replace(relation + ".", rename + ".") for e in key_list]
                 values_list = json_tuple.values()
                 d = {x: y for x, y in zip(new_key_list, values_list)}
-                res = json.dumps(d)
+                res = codec.dumps(d)
                 yield ("join", res)
 
         elif isinstance(input0, radb.ast.RelRef) and relation == input0.rel:
-            res = json.dumps(json_tuple)
+            res = tuple
             yield ("join", res)
 
         if isinstance(input1, radb.ast.Select):
@@ -323,7 +1932,7 @@ class JointOpTask(RelAlgQueryTask):
                             test = False
                             break
                     if test:
-                        res = json.dumps(d)
+                        res = codec.dumps(d)
                         yield ("join", res)
             elif input1.inputs[0].rel == relation:
                 first_key = list(json_tuple.keys())[0]
@@ -335,7 +1944,7 @@ class JointOpTask(RelAlgQueryTask):
                         test = False
                         break
                 if test:
-                    res = json.dumps(json_tuple)
+                    res = tuple
                     yield ("join", res)
 
         elif isinstance(input1, radb.ast.Rename):
@@ -346,91 +1955,405 @@ class JointOpTask(RelAlgQueryTask):
                 new_key_list = [e.replace(relation + ".", rename + ".") for e in key_list]
                 values_list = json_tuple.values()
                 d = {x: y for x, y in zip(new_key_list, values_list)}
-                res = json.dumps(d)
+                res = codec.dumps(d)
                 yield ("join", res)
 
         elif isinstance(input1, radb.ast.RelRef) and relation == input1.rel:
-            res = json.dumps(json_tuple)
+            res = tuple
             yield ("join", res)
 
     def reducer(self, key, values):
         raquery = radb.parse.one_statement_from_string(self.querystring)
-        condition = raquery.cond
-        values = set(values)
-        L = [json.loads(e) for e in values]
-        list_cond = []
-        list_cond = extract_cond_joint(condition)
-        first_key = list_cond[0][0]
-        table_name1 = first_key[:first_key.index(".")]
-        second_key = list_cond[0][1]
-        table_name2 = second_key[:second_key.index(".")]
-        joint_list1, joint_list2 = [], []
-        for e in L:
-            if extract_tabname_record(e) == table_name2:
-                joint_list2.append(e)
+        left_names = relation_names(raquery.inputs[0])
+        left, right = [], []
+        for e in set(values):
+            json_tuple = codec.loads(e)
+            if extract_tabname_record(json_tuple) in left_names:
+                left.append(json_tuple)
             else:
-                joint_list1.append(e)
-        for e1 in joint_list1:
-            for e2 in joint_list2:
-                test = True
-                for c1, c2 in list_cond:
-                    if e1[c1] != e2[c2]:
-                        test = False
-                        break
-                if test:
-                    d = {x: y for x, y in zip(list(e1.keys()) + list(e2.keys()), list(e1.values()) + list(e2.values()))}
-                    res = json.dumps(d)
-                    yield ('joint1', res)
+                right.append(json_tuple)
+        for d in match_join(raquery.cond, join_strategy(raquery), join_attributes(raquery), left, right):
+            yield ('joint1', codec.dumps(d))
+
+
+def sort_task_factory(raquery, order_by, limit=None, step=0, env=ExecEnv.HDFS, optimize=False, prefix=""):
+    """the task for ORDER BY / LIMIT on top of a query: a TopKTask when there is a limit,
+        else a SortTask. It takes step 0, so that the query below keeps its usual steps"""
+    order_by = [list(e) for e in order_by]
+    if limit is not None and len(order_by) == 0 and limit_pushdown(raquery):
+        return LimitScanTask(querystring=str(raquery) + ";", limit=limit, step=step, exec_environment=env,
+                             prefix=prefix)
+    if limit is not None:
+        return TopKTask(querystring=str(raquery) + ";", order_by=order_by, limit=limit, step=step,
+                        exec_environment=env, optimize=optimize, prefix=prefix)
+    return SortTask(querystring=str(raquery) + ";", order_by=order_by, step=step,
+                    exec_environment=env, optimize=optimize, prefix=prefix)
+
+
+def join_input_tasks(raquery, step, env, prefix=""):
+    """the tasks producing the two inputs of a (non optimized) join"""
+    task1 = task_factory(raquery.inputs[0], step=step + 1, env=env, prefix=prefix)
+    task2 = task_factory(raquery.inputs[1], step=step + count_steps(raquery.inputs[0]) + 1, env=env, prefix=prefix)
+    return [task1, task2]
 
 
 class JoinTask(RelAlgQueryTask):
+    '''
+    The partitioning depends on the join condition (see join_strategy): equality terms
+    are hashed on the join attributes, band and inequality conditions are range
+    partitioned or matched on sorted inputs, and any other theta condition falls back
+    to grid partitioning.
+
+    Hash joins are skew-aware: join keys that are heavy hitters in a random sample
+    of the inputs get the tuples of their large side split over several reducers,
+    and the matching tuples of the small side replicated to each of them. Inputs
+    of at most skew_scan_bytes are sampled whole, larger ones at random offsets
+    (see random_lines); in HDFS or compressed, larger inputs are not sampled, and
+    their joins not made skew-aware.
+
+    When exactly one input is filtered by a constant selection, a Bloom filter of its
+    join keys is built first, and the mapper drops the tuples of the other input
+    that cannot find a join partner before they reach the shuffle.
+    '''
+    cells = luigi.IntParameter(default=16, significant=False)
+    skew_sample = luigi.IntParameter(default=10000, significant=False)
+    skew_scan_bytes = luigi.IntParameter(default=16 * 1024 * 1024, significant=False)
+    skew_factor = luigi.FloatParameter(default=2.0, significant=False)
+    semi_join_reduction = True
+    bloom = None
+    heavy = {}
 
     def requires(self):
         raquery = radb.parse.one_statement_from_string(self.querystring)
         assert (isinstance(raquery, radb.ast.Join))
 
-        task1 = task_factory(raquery.inputs[0], step=self.step + 1, env=self.exec_environment)
-        task2 = task_factory(raquery.inputs[1], step=self.step + count_steps(raquery.inputs[0]) + 1,
-                             env=self.exec_environment)
+        return join_input_tasks(raquery, self.step, self.exec_environment, self.prefix)
 
+    def requires_local(self):
+        raquery = radb.parse.one_statement_from_string(self.querystring)
+        if self.semi_join_reduction and semi_join_side(raquery) is not None:
+            return [BloomFilterTask(querystring=self.querystring, step=self.step,
+                                    exec_environment=self.exec_environment, prefix=self.prefix)]
+        return []
+
+    def init_local(self):
+        for target in luigi.task.flatten(self.input_local()):
+            for line in read_lines(target):
+                self.bloom = bloom.BloomFilter.loads(line.split('\t')[1])
+        raquery = radb.parse.one_statement_from_string(self.querystring)
+        if join_strategy(raquery)[0] == 'grid':
+            input0, input1 = self.input()
+            self.rows, self.columns = grid_shape(target_size(input0), target_size(input1), self.cells)
+        elif join_strategy(raquery)[0] == 'hash':
+            attrs = join_attributes(raquery)
+            samples = [random_lines(target, self.skew_sample, self.skew_scan_bytes) for target in self.input()]
+            if None in samples:
+                logger.info("JoinTask: no skew detection for %s, its inputs cannot be sampled", raquery)
+                return
+            samples = [[join_key(codec.loads(line.split('\t')[1]), attrs[side]) for line in lines]
+                       for side, lines in enumerate(samples)]
+            self.heavy = heavy_hitters(samples, self.cells, self.skew_factor)
+
+    def init_mapper(self):
+        raquery = radb.parse.one_statement_from_string(self.querystring)
+        self.cond = raquery.cond
+        self.strategy = join_strategy(raquery)
+        self.left_names = relation_names(raquery.inputs[0])
+        self.attrs = join_attributes(raquery)
+        if self.bloom is not None:
+            probe_side = 1 - semi_join_side(raquery)
+            self.probe_names = relation_names(raquery.inputs[probe_side])
+            self.probe_attrs = self.attrs[probe_side]
+
+    def init_reducer(self):
+        self.init_mapper()
+
+    def partitions(self, side, json_tuple, res):
+        """the reducer keys a tuple of the left (0) or right (1) input is sent to"""
+        if self.strategy[0] == 'hash':
+            key = join_key(json_tuple, self.attrs[side])
+            return split_partitions(key, side, res, self.heavy) if key in self.heavy else [key]
+        if self.strategy[0] == 'band':
+            return band_partitions(side, json_tuple, self.strategy)
+        if self.strategy[0] == 'grid':
+            return grid_cells(side, json_tuple, self.rows, self.columns)
+        return ["join"]
+
+    def mapper(self, line):
+        relation, tuple = line.split('\t')
+        json_tuple = codec.loads(tuple)
+
+        if self.bloom is not None and extract_tabname_record(json_tuple) in self.probe_names:
+            if join_key(json_tuple, self.probe_attrs) not in self.bloom:
+                return
+        side = 0 if extract_tabname_record(json_tuple) in self.left_names else 1
+        res = tuple  # passed through as it was read, the join does not change its inputs
+        for key in self.partitions(side, json_tuple, res):
+            yield (key, res)
+
+    def reducer(self, key, values):
+        left, right = [], []
+        for e in values:
+            json_tuple = codec.loads(e)
+            if extract_tabname_record(json_tuple) in self.left_names:
+                left.append(json_tuple)
+            else:
+                right.append(json_tuple)
+        for d in match_join(self.cond, self.strategy, self.attrs, left, right):
+            yield ('joint1', codec.dumps(d))
+
+
+class CrossTask(RelAlgQueryTask):
+    '''
+    Cross product with block-nested (1-bucket-theta) partitioning: the reducers form a
+    rows x columns grid, each left tuple goes to one row and each right tuple to one
+    column, so every pair of tuples meets in exactly one cell and all cells get about
+    the same work. The grid is sized from the input byte counts, which also serve to
+    warn about, or refuse, products whose output would be too large.
+    '''
+    optimize = luigi.BoolParameter(default=False)
+    cells = luigi.IntParameter(default=16, significant=False)
+    warn_output_bytes = luigi.IntParameter(default=256 * 1024 * 1024, significant=False)
+    max_output_bytes = luigi.IntParameter(default=16 * 1024 * 1024 * 1024, significant=False)
+
+    def requires(self):
+        raquery = radb.parse.one_statement_from_string(self.querystring)
+        assert (isinstance(raquery, radb.ast.Cross))
+
+        task1 = task_factory(raquery.inputs[0], step=self.step + 1, env=self.exec_environment,
+                             optimize=self.optimize, prefix=self.prefix)
+        task2 = task_factory(raquery.inputs[1], step=self.step + count_steps(raquery.inputs[0]) + 1,
+                             env=self.exec_environment, optimize=self.optimize, prefix=self.prefix)
         return [task1, task2]
 
+    def init_local(self):
+        input0, input1 = self.input()
+        size0, size1 = target_size(input0), target_size(input1)
+        estimate = size0 * estimate_rows(input1) + size1 * estimate_rows(input0)
+        if estimate > self.max_output_bytes:
+            raise Exception("CrossTask: the cross product would produce about " + str(estimate) +
+                            " bytes, more than max_output_bytes=" + str(self.max_output_bytes) + ".")
+        if estimate > self.warn_output_bytes:
+            logger.warning("CrossTask: the cross product will produce about %d bytes", estimate)
+        self.rows, self.columns = grid_shape(size0, size1, self.cells)
+
+    @property
+    def n_reduce_tasks(self):
+        return self.cells
+
+    def init_mapper(self):
+        raquery = radb.parse.one_statement_from_string(self.querystring)
+        self.left_names = relation_names(raquery.inputs[0])
+
+    def init_reducer(self):
+        self.init_mapper()
+
     def mapper(self, line):
         relation, tuple = line.split('\t')
-        json_tuple = json.loads(tuple)
+        json_tuple = codec.loads(tuple)
+
+        side = 0 if extract_tabname_record(json_tuple) in self.left_names else 1
+        res = tuple  # passed through as it was read, the join does not change its inputs
+        for cell in grid_cells(side, json_tuple, self.rows, self.columns):
+            yield (cell, res)
 
+    def reducer(self, key, values):
+        left, right = [], []
+        for e in values:
+            json_tuple = codec.loads(e)
+            if extract_tabname_record(json_tuple) in self.left_names:
+                left.append(json_tuple)
+            else:
+                right.append(json_tuple)
+        for e1 in left:
+            for e2 in right:
+                d = dict(e1)
+                d.update(e2)
+                yield ('cross', codec.dumps(d))
+
+
+class AggregateTask(RelAlgQueryTask):
+    '''
+    Grouping with count, sum, min, max and avg. Each mapper aggregates its tuples
+    in a hash table of partial states, flushed whenever it holds max_groups groups
+    and at the end of the input, so that about one partial per group and mapper is
+    shuffled. The combiner and the reducer merge the partial states.
+    '''
+    optimize = luigi.BoolParameter(default=False)
+    max_groups = luigi.IntParameter(default=10000, significant=False)
+
+    def requires(self):
         raquery = radb.parse.one_statement_from_string(self.querystring)
-        condition = raquery.cond
-        res = json.dumps(json_tuple)
-        yield ("join", res)
+        assert (isinstance(raquery, radb.ast.Aggr))
+
+        return [task_factory(raquery.inputs[0], step=self.step + 1, env=self.exec_environment,
+                             optimize=self.optimize, prefix=self.prefix)]
+
+    def init_mapper(self):
+        raquery = radb.parse.one_statement_from_string(self.querystring)
+        self.groupbys = raquery.groupbys
+        self.aggrs = raquery.aggrs
+        self.funcs = [aggr.func.lower() for aggr in raquery.aggrs]
+        self.table = {}
+
+    def init_combiner(self):
+        self.init_mapper()
+
+    def init_reducer(self):
+        self.init_mapper()
+
+    def flush(self):
+        for key, states in self.table.items():
+            yield (key, codec.dumps(states))
+        self.table = {}
+
+    def mapper(self, line):
+        relation, tuple = line.split('\t')
+        json_tuple = codec.loads(tuple)
+
+        key = json.dumps([[attribute_name(attr, json_tuple), attribute_value(attr, json_tuple)]
+                          for attr in self.groupbys])
+        states = [initial_state(func, eval_cond(aggr.args[0], json_tuple))
+                  for func, aggr in zip(self.funcs, self.aggrs)]
+        if key in self.table:
+            states = [merge_states(func, a, b) for func, a, b in zip(self.funcs, self.table[key], states)]
+        self.table[key] = states
+        if len(self.table) >= self.max_groups:
+            for output in self.flush():
+                yield output
+
+    def final_mapper(self):
+        return self.flush()
+
+    def merge(self, values):
+        states = None
+        for e in values:
+            partial = codec.loads(e)
+            states = partial if states is None else \
+                [merge_states(func, a, b) for func, a, b in zip(self.funcs, states, partial)]
+        return states
+
+    def combiner(self, key, values):
+        yield (key, codec.dumps(self.merge(values)))
 
     def reducer(self, key, values):
+        d = {name: value for name, value in codec.loads(key)}
+        for func, aggr, state in zip(self.funcs, self.aggrs, self.merge(values)):
+            d[str(aggr)] = final_value(func, state)
+        yield ('aggr', codec.dumps(d))
+
+
+class TopKTask(RelAlgQueryTask):
+    '''
+    ORDER BY ... LIMIT k: each mapper keeps the k first tuples in a bounded heap and
+    only ships those, a single reducer merges the heaps. The querystring is the
+    query whose result is ordered.
+    '''
+    order_by = luigi.ListParameter(default=[])
+    limit = luigi.IntParameter()
+    optimize = luigi.BoolParameter(default=False)
+
+    def requires(self):
         raquery = radb.parse.one_statement_from_string(self.querystring)
-        condition = raquery.cond
-        L = [json.loads(e) for e in values]
-        list_cond = []
-        list_cond = extract_cond_joint(condition)
-        first_key = list_cond[0][0]
-        table_name1 = first_key[:first_key.index(".")]
-        second_key = list_cond[0][1]
-        table_name2 = second_key[:second_key.index(".")]
-        joint_list1, joint_list2 = [], []
-        for e in L:
-            if extract_tabname_record(e) == table_name2:
-                joint_list2.append(e)
-            else:
-                joint_list1.append(e)
-        for e1 in joint_list1:
-            for e2 in joint_list2:
-                test = True
-                for c1, c2 in list_cond:
-                    if e1[c1] != e2[c2]:
-                        test = False
-                        break
-                if test:
-                    d = {x: y for x, y in zip(list(e1.keys()) + list(e2.keys()), list(e1.values()) + list(e2.values()))}
-                    res = json.dumps(d)
-                    yield ('joint1', res)
+        return [task_factory(raquery, step=self.step + 1, env=self.exec_environment,
+                             optimize=self.optimize, prefix=self.prefix)]
+
+    def init_mapper(self):
+        self.heap = []
+
+    def mapper(self, line):
+        if len(self.order_by) == 0 and len(self.heap) >= self.limit:
+            return []  # any limit tuples will do, the rest of the split is not even parsed
+        relation, tuple = line.split('\t')
+        item = HeapItem(SortKey(self.order_by, codec.loads(tuple)), line)
+        if len(self.heap) < self.limit:
+            heapq.heappush(self.heap, item)
+        elif self.limit > 0 and item.key < self.heap[0].key:
+            heapq.heapreplace(self.heap, item)
+        return []
+
+    def final_mapper(self):
+        for item in self.heap:
+            yield ("topk", item.line)
+
+    def reducer(self, key, values):
+        items = []
+        for line in values:
+            relation, tuple = line.split('\t')
+            items.append((SortKey(self.order_by, codec.loads(tuple)), relation, tuple))
+        items.sort(key=lambda e: e[0])
+        for sort_key, relation, tuple in items[:self.limit]:
+            yield (relation, tuple)
+
+
+def text_hash(s):
+    """the hash code of a hadoop Text holding s (WritableComparator.hashBytes over its signed
+        bytes), made non-negative as by hadoop's HashPartitioner"""
+    h = 1
+    for b in s.encode('utf-8'):
+        h = (31 * h + (b - 256 if b > 127 else b)) & 0xffffffff
+    return h & 0x7fffffff
+
+
+def reducer_key(i, n, serialize=repr):
+    """a map output key that hadoop's HashPartitioner sends to reducer i of n: the zero padded
+        range number i, which also sorts the keys by i, with the first suffix landing it there"""
+    for j in itertools.count():
+        key = "%05d.%d" % (i, j)
+        if text_hash(serialize(key)) % n == i:
+            return key
+
+
+class SortTask(RelAlgQueryTask):
+    '''
+    ORDER BY without a limit: the tuples are range partitioned over the reducers on
+    split points taken from a random sample of the input (see random_lines; inputs
+    that cannot be sampled at random, in HDFS or compressed, by their first tuples),
+    and each reducer sorts its range.
+    Range i is sent to reducer i (see reducer_key), so that its part file in HDFS,
+    part-0000i, holds it, and the local job runner, which reduces the keys in order,
+    writes it i-th: the concatenation of the ranges is globally sorted. The output key
+    is the (zero padded) range number.
+    '''
+    order_by = luigi.ListParameter()
+    optimize = luigi.BoolParameter(default=False)
+    partitions = luigi.IntParameter(default=4, significant=False)
+    sample = luigi.IntParameter(default=10000, significant=False)
+    sample_scan_bytes = luigi.IntParameter(default=16 * 1024 * 1024, significant=False)
+    splits = []
+    keys = ["00000.0"]
+
+    def requires(self):
+        raquery = radb.parse.one_statement_from_string(self.querystring)
+        return [task_factory(raquery, step=self.step + 1, env=self.exec_environment,
+                             optimize=self.optimize, prefix=self.prefix)]
+
+    @property
+    def n_reduce_tasks(self):
+        return self.partitions
+
+    def init_local(self):
+        lines = random_lines(self.input()[0], self.sample, self.sample_scan_bytes)
+        if lines is None:
+            lines = sample_lines(self.input()[0], self.sample)
+        keys = sorted(SortKey(self.order_by, codec.loads(line.split('\t')[1])) for line in lines)
+        self.splits = [keys[len(keys) * i // self.partitions] for i in range(1, self.partitions)] if keys else []
+        serialize = luigi.contrib.hadoop.DataInterchange[self.data_interchange_format]['internal_serialize']
+        self.keys = [reducer_key(i, self.partitions, serialize) for i in range(self.partitions)]
+
+    def mapper(self, line):
+        relation, tuple = line.split('\t')
+        partition = bisect.bisect_right(self.splits, SortKey(self.order_by, codec.loads(tuple)))
+        yield (self.keys[partition], line)
+
+    def reducer(self, key, values):
+        items = []
+        for line in values:
+            relation, tuple = line.split('\t')
+            items.append((SortKey(self.order_by, codec.loads(tuple)), tuple))
+        items.sort(key=lambda e: e[0])
+        for sort_key, tuple in items:
+            yield (key[:key.index(".")], tuple)
 
 
 class SelectOpTask(RelAlgQueryTask):
@@ -438,13 +2361,20 @@ class SelectOpTask(RelAlgQueryTask):
         raquery = radb.parse.one_statement_from_string(self.querystring)
         assert (isinstance(raquery, radb.ast.Select))
         if isinstance(raquery.inputs[0], radb.ast.Rename):
-            return [task_factory(raquery.inputs[0].inputs[0], step=self.step + 1, env=self.exec_environment, optimize=True)]
+            return [task_factory(raquery.inputs[0].inputs[0], step=self.step + 1, env=self.exec_environment, optimize=True, prefix=self.prefix)]
         else:
-            return [task_factory(raquery.inputs[0], step=self.step + 1, env=self.exec_environment, optimize=True)]
+            return [task_factory(raquery.inputs[0], step=self.step + 1, env=self.exec_environment, optimize=True, prefix=self.prefix)]
+
+    def zone_predicates(self):
+        raquery = radb.parse.one_statement_from_string(self.querystring)
+        if isinstance(raquery.inputs[0], radb.ast.RelRef) or (isinstance(raquery.inputs[0], radb.ast.Rename) and
+                                                             isinstance(raquery.inputs[0].inputs[0], radb.ast.RelRef)):
+            return zone_terms(raquery)
+        return {}
 
     def mapper(self, line):
         relation, tuple = line.split('\t')
-        json_tuple = json.loads(tuple)
+        json_tuple = codec.loads(tuple)
         ra = radb.parse.one_statement_from_string(self.querystring)
         ra = clean_select(ra)
         condition = ra.cond
@@ -467,7 +2397,7 @@ class SelectOpTask(RelAlgQueryTask):
                     test = False
                     break
             if test:
-                res = json.dumps(d)
+                res = codec.dumps(d)
                 yield (relation, res)
         else:
             first_key = list(json_tuple.keys())[0]
@@ -488,24 +2418,19 @@ class SelectTask(RelAlgQueryTask):
         raquery = radb.parse.one_statement_from_string(self.querystring)
         assert (isinstance(raquery, radb.ast.Select))
 
-        return [task_factory(raquery.inputs[0], step=self.step + 1, env=self.exec_environment)]
+        return [task_factory(raquery.inputs[0], step=self.step + 1, env=self.exec_environment, prefix=self.prefix)]
+
+    def zone_predicates(self):
+        raquery = radb.parse.one_statement_from_string(self.querystring)
+        if isinstance(raquery.inputs[0], radb.ast.RelRef):
+            return zone_terms(raquery)
+        return {}
 
     def mapper(self, line):
         relation, tuple = line.split('\t')
-        json_tuple = json.loads(tuple)
+        json_tuple = codec.loads(tuple)
         ra = radb.parse.one_statement_from_string(self.querystring)
-        ra = clean_select(ra)
-        condition = ra.cond
-
-        first_key = list(json_tuple.keys())[0]
-        table_name = first_key[:first_key.index(".")]
-        cond_list = extract_cond(table_name, condition)
-        test = True
-        for c1, c2 in cond_list:
-            if not cmp(str(json_tuple[c1]), c2):
-                test = False
-                break
-        if test:
+        if select_matches(ra, json_tuple):
             yield (relation, tuple)
 
 
@@ -515,11 +2440,11 @@ class RenameOpTask(RelAlgQueryTask):
         raquery = radb.parse.one_statement_from_string(self.querystring)
         assert (isinstance(raquery, radb.ast.Rename))
 
-        return [task_factory(raquery.inputs[0], step=self.step + 1, env=self.exec_environment,optimize=True)]
+        return [task_factory(raquery.inputs[0], step=self.step + 1, env=self.exec_environment, optimize=True, prefix=self.prefix)]
 
     def mapper(self, line):
         relation, tuple = line.split('\t')
-        json_tuple = json.loads(tuple)
+        json_tuple = codec.loads(tuple)
 
         ra = radb.parse.one_statement_from_string(self.querystring)
         rename, real_name = get_table(ra)
@@ -529,7 +2454,7 @@ class RenameOpTask(RelAlgQueryTask):
             new_key_list = [e.replace(relation + ".", rename + ".") for e in key_list]
             values_list = json_tuple.values()
             d = {x: y for x, y in zip(new_key_list, values_list)}
-            res = json.dumps(d)
+            res = codec.dumps(d)
             yield (relation, res)
 
 
@@ -540,11 +2465,11 @@ class RenameTask(RelAlgQueryTask):
         raquery = radb.parse.one_statement_from_string(self.querystring)
         assert (isinstance(raquery, radb.ast.Rename))
 
-        return [task_factory(raquery.inputs[0], step=self.step + 1, env=self.exec_environment)]
+        return [task_factory(raquery.inputs[0], step=self.step + 1, env=self.exec_environment, prefix=self.prefix)]
 
     def mapper(self, line):
         relation, tuple = line.split('\t')
-        json_tuple = json.loads(tuple)
+        json_tuple = codec.loads(tuple)
 
         ra = radb.parse.one_statement_from_string(self.querystring)
         rename, real_name = get_table(ra)
@@ -554,7 +2479,7 @@ class RenameTask(RelAlgQueryTask):
             new_key_list = [e.replace(relation + ".", rename + ".") for e in key_list]
             values_list = json_tuple.values()
             d = {x: y for x, y in zip(new_key_list, values_list)}
-            res = json.dumps(d)
+            res = codec.dumps(d)
             yield (relation, res)
 
 
@@ -564,11 +2489,11 @@ class ProjectOpTask(RelAlgQueryTask):
         raquery = radb.parse.one_statement_from_string(self.querystring)
         assert (isinstance(raquery, radb.ast.Project))
 
-        return [task_factory(raquery.inputs[0], step=self.step + 1, env=self.exec_environment, optimize=True)]
+        return [task_factory(raquery.inputs[0], step=self.step + 1, env=self.exec_environment, optimize=True, prefix=self.prefix)]
 
     def mapper(self, line):
         relation, tuple = line.split('\t')
-        json_tuple = json.loads(tuple)
+        json_tuple = codec.loads(tuple)
 
         attrs = radb.parse.one_statement_from_string(self.querystring).attrs
         first_key = list(json_tuple.keys())[0]
@@ -580,7 +2505,7 @@ class ProjectOpTask(RelAlgQueryTask):
             if k in attributes:
                 d[k] = v
         if len(d) != 0:
-            res = json.dumps(d)
+            res = codec.dumps(d)
             yield (relation, res)
 
     def reducer(self, key, values):
@@ -596,11 +2521,11 @@ class ProjectTask(RelAlgQueryTask):
         raquery = radb.parse.one_statement_from_string(self.querystring)
         assert (isinstance(raquery, radb.ast.Project))
 
-        return [task_factory(raquery.inputs[0], step=self.step + 1, env=self.exec_environment)]
+        return [task_factory(raquery.inputs[0], step=self.step + 1, env=self.exec_environment, prefix=self.prefix)]
 
     def mapper(self, line):
         relation, tuple = line.split('\t')
-        json_tuple = json.loads(tuple)
+        json_tuple = codec.loads(tuple)
 
         attrs = radb.parse.one_statement_from_string(self.querystring).attrs
         first_key = list(json_tuple.keys())[0]
@@ -612,7 +2537,7 @@ class ProjectTask(RelAlgQueryTask):
             if k in attributes:
                 d[k] = v
         if len(d) != 0:
-            res = json.dumps(d)
+            res = codec.dumps(d)
             yield (relation, res)
 
     def reducer(self, key, values):
@@ -621,5 +2546,466 @@ class ProjectTask(RelAlgQueryTask):
             yield (key, e)
 
 
+'''
+Adaptive execution: instead of fixing the physical plan up front, AdaptiveTask
+runs a query stage by stage. The inputs of its joins (the join-free subtrees)
+are materialized first; then, as long as joins remain, the rest of the join
+tree is planned again (see raopt.Optimizer.join_plans) from the actual row
+counts of the materialized inputs, as counted by the jobs writing them, and
+only the cheapest join whose inputs are both materialized is run. A join with
+an input of at most broadcast_bytes is run map-side, the small input being
+loaded into every mapper; the others are shuffled over as many reducers as
+their input bytes call for. The operators above the joins (selections,
+projections, grouping) run last.
+'''
+
+
+def observe(target, env):
+    """(rows, attributes) of a materialized intermediate: the rows as counted by the job writing it, else
+        estimated (relations, outputs of other tasks), and the attributes of its first tuple"""
+    attributes = frozenset()
+    for line in sample_lines(target, 1):
+        attributes = frozenset(codec.loads(line.split('\t')[1]))
+    rows = counted_rows(target, env)
+    return (rows if rows is not None else estimate_rows(target)), attributes
+
+
+def split_join_tree(raquery):
+    """(top, inputs, terms): the unary operators above the joins and cross products at the top of
+        a query (from the top), the inputs of those joins and the conjuncts of their conditions"""
+    top = []
+    while isinstance(raquery, radb.ast.Select) or isinstance(raquery, radb.ast.Project) or \
+            isinstance(raquery, radb.ast.Aggr):
+        top.append(raquery)
+        raquery = raquery.inputs[0]
+    inputs, terms, stack = [], [], [raquery]
+    while stack:
+        e = stack.pop()
+        if isinstance(e, radb.ast.Join) or isinstance(e, radb.ast.Cross):
+            if isinstance(e, radb.ast.Join):
+                terms += conjuncts(e.cond)
+            stack += reversed(e.inputs)
+        else:
+            inputs.append(e)
+    return top, inputs, terms
+
+
+def next_join(parts, terms):
+    """plans the joins of the materialized parts, given as (tree, rows, attributes), from what was
+        observed of them: returns the cheapest join (or cross product) of two parts in the plan, the
+        indexes of these parts and the terms left to later joins. Terms joining no two parts are left
+        over for a selection on top"""
+    optimizer = raopt.Optimizer()
+    leaves = [tree for tree, rows, attributes in parts]
+    observed = {id(tree): (max(rows, 1), attributes) for tree, rows, attributes in parts}
+
+    def distinct(reference, ra):
+        rel, name = reference
+        for tree, rows, attributes in parts:
+            if rel in optimizer.relations(tree) if rel is not None else \
+                    any(a.endswith("." + name) for a in attributes):
+                return max(rows, 1)
+        return None
+
+    optimizer.cardinality = lambda tree: float(observed[id(tree)][0])
+    optimizer.schema = lambda tree: observed[id(tree)][1]
+    optimizer.distinct = distinct
+    masks = [optimizer.leaves_of(term, leaves) for term in terms]
+    joining = [i for i, m in enumerate(masks) if m is not None and bin(m).count("1") > 1]
+    optimizer.region = leaves[0]
+    plan = optimizer.join_plans(leaves, [terms[i] for i in joining], [masks[i] for i in joining])[2]
+
+    candidates, stack = [], [plan]
+    while stack:
+        e = stack.pop()
+        if isinstance(e, radb.ast.Join) or isinstance(e, radb.ast.Cross):
+            if all(id(i) in observed for i in e.inputs):
+                rows = observed[id(e.inputs[0])][0] * observed[id(e.inputs[1])][0]
+                if isinstance(e, radb.ast.Join):
+                    rows *= optimizer.selectivity(e.cond, e)
+                candidates.append((rows, e))
+            stack += e.inputs
+    rows, join = min(candidates, key=lambda c: c[0])
+    sides = [[id(tree) for tree in leaves].index(id(i)) for i in join.inputs]
+    used = conjuncts(join.cond) if isinstance(join, radb.ast.Join) else []
+    return join, sides, [term for term in terms if not any(term is u for u in used)]
+
+
+class ExplicitInputs(object):
+    '''
+    Operators of an adaptive plan read the materialized results of the stages
+    below them, given by their paths, instead of planning their inputs.
+    '''
+    inputs = luigi.ListParameter()
+
+    def requires(self):
+        tasks = [InputData(filename=path, exec_environment=self.exec_environment) for path in self.inputs]
+        return tasks[0] if len(tasks) == 1 else tasks
+
+    def requires_local(self):
+        return []
+
+
+class AdaptiveSelectTask(ExplicitInputs, SelectTask):
+    pass
+
+
+class AdaptiveProjectTask(ExplicitInputs, ProjectTask):
+    pass
+
+
+class AdaptiveAggregateTask(ExplicitInputs, AggregateTask):
+    pass
+
+
+class AdaptiveJoinTask(ExplicitInputs, JoinTask):
+    '''
+    A shuffled join (or cross product, as a join on the condition true) of two
+    materialized inputs, over cells reducers.
+    '''
+    semi_join_reduction = False
+
+    @property
+    def n_reduce_tasks(self):
+        return self.cells
+
+    def init_local(self):
+        raquery = radb.parse.one_statement_from_string(self.querystring)
+        if isinstance(raquery, radb.ast.Cross):
+            input0, input1 = self.input()
+            self.rows, self.columns = grid_shape(target_size(input0), target_size(input1), self.cells)
+        else:
+            super(AdaptiveJoinTask, self).init_local()
+
+    def init_mapper(self):
+        raquery = radb.parse.one_statement_from_string(self.querystring)
+        if isinstance(raquery, radb.ast.Join):
+            return super(AdaptiveJoinTask, self).init_mapper()
+        self.cond = None
+        self.strategy = ('grid',)
+        self.left_names = relation_names(raquery.inputs[0])
+        self.attrs = None
+
+    def reducer(self, key, values):
+        left, right = [], []
+        for e in values:
+            json_tuple = codec.loads(e)
+            if extract_tabname_record(json_tuple) in self.left_names:
+                left.append(json_tuple)
+            else:
+                right.append(json_tuple)
+        for d in match_join(self.cond, self.strategy, self.attrs, left, right) if self.cond is not None else \
+                (dict(e1, **e2) for e1 in left for e2 in right):
+            yield ('joint1' if self.cond is not None else 'cross', codec.dumps(d))
+
+
+class BroadcastJoinTask(AdaptiveJoinTask):
+    '''
+    A map-side join: the small input (broadcast, 0 or 1) is loaded into a hash
+    table on its join attributes, shipped with the job to every mapper, and the
+    other input is streamed through the mappers, without a shuffle.
+    '''
+    broadcast = luigi.IntParameter(default=1)
+    reducer = NotImplemented
+
+    def input_hadoop(self):
+        return [self.input()[1 - self.broadcast]]
+
+    def init_local(self):
+        self.init_mapper()
+        self.table = {}
+        attrs = self.attrs[self.broadcast] if self.strategy[0] == 'hash' else None
+        for relation, json_tuple in scan_tuples(self.input()[self.broadcast]):
+            self.table.setdefault(join_key(json_tuple, attrs) if attrs is not None else None, []).append(json_tuple)
+
+    def mapper(self, line):
+        relation, tuple = line.split('\t')
+        json_tuple = codec.loads(tuple)
+        side = 1 - self.broadcast
+        key = join_key(json_tuple, self.attrs[side]) if self.strategy[0] == 'hash' else None
+        for other in self.table.get(key, []):
+            d = dict(json_tuple if side == 0 else other)
+            d.update(other if side == 0 else json_tuple)
+            if self.cond is None or eval_cond(self.cond, d):
+                yield ('joint1' if self.cond is not None else 'cross', codec.dumps(d))
+
+
+class AdaptiveTask(OutputMixin):
+    '''
+    Evaluates a query stage by stage, planning its joins from the sizes of the
+    intermediates (see above). Its output is the one of the query's last stage.
+    '''
+    querystring = luigi.Parameter()
+    step = luigi.IntParameter(default=1)
+    prefix = luigi.Parameter(default="")
+    broadcast_bytes = luigi.IntParameter(default=32 * 1024 * 1024, significant=False)
+    bytes_per_reducer = luigi.IntParameter(default=128 * 1024 * 1024, significant=False)
+    max_reducers = luigi.IntParameter(default=64, significant=False)
+
+    def output(self):
+        if self.exec_environment == ExecEnv.HDFS:
+            filename = self.prefix + "tmp" + str(self.step)
+        else:
+            filename = self.prefix + "tmp" + str(self.step) + ".tmp"
+        return self.get_output(filename)
+
+    def stage(self, task, last):
+        """the task of a stage, the last one writing the output of the query"""
+        if last:
+            return task
+        self.steps += 1
+        return task.clone(step=self.step + self.steps)
+
+    def run(self):
+        raquery = radb.parse.one_statement_from_string(self.querystring)
+        top, inputs, terms = split_join_tree(raquery)
+        if len(inputs) < 2:
+            yield task_factory(raquery, step=self.step, env=self.exec_environment, prefix=self.prefix)
+            return
+
+        self.steps = 0
+        tasks = []
+        for e in inputs:
+            tasks.append(task_factory(e, step=self.step + self.steps + 1, env=self.exec_environment,
+                                      prefix=self.prefix).clone(count_rows=True))
+            self.steps += count_steps(e)
+        yield [task for task in tasks if not isinstance(task, InputData)]
+
+        parts = []
+        for e, task in zip(inputs, tasks):
+            target = task.output()
+            parts.append((e,) + observe(target, self.exec_environment) + (target.path, target_size(target)))
+        while len(parts) > 1:
+            join, sides, terms = next_join([p[:3] for p in parts], terms)
+            (e0, rows0, a0, path0, size0), (e1, rows1, a1, path1, size1) = [parts[i] for i in sides]
+            querystring = str(join) + ";"
+            paths = [path0, path1]
+            last = len(parts) == 2 and not top and not terms
+            if min(size0, size1) <= self.broadcast_bytes:
+                task = BroadcastJoinTask(querystring=querystring, inputs=paths, broadcast=0 if size0 < size1 else 1,
+                                         step=self.step, exec_environment=self.exec_environment, prefix=self.prefix,
+                                         count_rows=True)
+            else:
+                reducers = min(max(int(math.ceil((size0 + size1) / self.bytes_per_reducer)), 1), self.max_reducers)
+                task = AdaptiveJoinTask(querystring=querystring, inputs=paths, cells=reducers, step=self.step,
+                                        exec_environment=self.exec_environment, prefix=self.prefix, count_rows=True)
+            task = self.stage(task, last)
+            if not task.complete():
+                logger.info("AdaptiveTask: %s (%d and %d rows, %d and %d bytes) by %s", join, rows0, rows1, size0,
+                            size1, task)
+            yield task
+            target = task.output()
+            parts = [p for i, p in enumerate(parts) if i not in sides] + \
+                [(join,) + observe(target, self.exec_environment) + (target.path, target_size(target))]
+
+        e, rows, attributes, path, size = parts[0]
+        if terms:
+            top.append(radb.ast.Select(raopt.conjunction(terms), e))
+        for i, op in enumerate(reversed(top)):
+            e = raopt.with_inputs(op, [e])
+            cls = AdaptiveSelectTask if isinstance(op, radb.ast.Select) else \
+                AdaptiveProjectTask if isinstance(op, radb.ast.Project) else AdaptiveAggregateTask
+            task = self.stage(cls(querystring=str(e) + ";", inputs=[path], step=self.step,
+                                  exec_environment=self.exec_environment, prefix=self.prefix), i == len(top) - 1)
+            yield task
+            path = task.output().path
+
+
+'''
+First-rows mode: the query is evaluated by a tree of python generators instead of
+MapReduce jobs, so that tuples are produced as soon as they are found and nothing
+is read once the consumer has the rows it wants. Selections, renamings and
+projections stream, joins and cross products are symmetric (both inputs are read
+alternately and each new tuple is probed against the tuples seen on the other
+side), only grouping blocks.
+'''
+
+
+def limit_pushdown(raquery):
+    """returns True if a LIMIT on top of raquery may be pushed into the scan of its relation"""
+    return isinstance(raquery, radb.ast.RelRef) or scan_chain(raquery)
+
+
+def alternate(*iterators):
+    """yields (index, item) taking items from the iterators in turn, until all are exhausted"""
+    iterators = list(enumerate(iterators))
+    while iterators:
+        for entry in list(iterators):
+            i, it = entry
+            try:
+                yield i, next(it)
+            except StopIteration:
+                iterators.remove(entry)
+
+
+def stream_join(ra, env):
+    """yields the tuples of a join or cross product as soon as both partners have been read"""
+    cond = ra.cond if isinstance(ra, radb.ast.Join) else None
+    strategy = join_strategy(ra) if cond is not None else ('grid',)
+    attrs = join_attributes(ra) if strategy[0] == 'hash' else None
+    relation = 'joint1' if cond is not None else 'cross'
+    seen = [{}, {}]
+    inputs = [stream_tuples(e, env) for e in ra.inputs]
+    for side, (r, json_tuple) in alternate(*inputs):
+        key = join_key(json_tuple, attrs[side]) if attrs is not None else None
+        seen[side].setdefault(key, []).append(json_tuple)
+        for other in seen[1 - side].get(key, []):
+            d = dict(json_tuple if side == 0 else other)
+            d.update(other if side == 0 else json_tuple)
+            if cond is None or eval_cond(cond, d):
+                yield relation, d
+
+
+def stream_aggregate(ra, env):
+    """groups the whole input (grouping cannot stream) and yields one tuple per group"""
+    funcs = [aggr.func.lower() for aggr in ra.aggrs]
+    table = {}
+    for relation, json_tuple in stream_tuples(ra.inputs[0], env):
+        key = json.dumps([[attribute_name(attr, json_tuple), attribute_value(attr, json_tuple)]
+                          for attr in ra.groupbys])
+        states = [initial_state(func, eval_cond(aggr.args[0], json_tuple)) for func, aggr in zip(funcs, ra.aggrs)]
+        if key in table:
+            states = [merge_states(func, a, b) for func, a, b in zip(funcs, table[key], states)]
+        table[key] = states
+    for key, states in table.items():
+        d = {name: value for name, value in codec.loads(key)}
+        for func, aggr, state in zip(funcs, ra.aggrs, states):
+            d[str(aggr)] = final_value(func, state)
+        yield 'aggr', d
+
+
+def stream_tuples(raquery, env=ExecEnv.HDFS):
+    """yields the (relation, tuple) pairs of the result of a query, reading its inputs lazily"""
+    if isinstance(raquery, radb.ast.RelRef):
+        for relation, json_tuple in scan_tuples(InputData(filename=raquery.rel + ".json", exec_environment=env).output()):
+            yield relation, json_tuple
+
+    elif isinstance(raquery, radb.ast.Select):
+        for relation, json_tuple in stream_tuples(raquery.inputs[0], env):
+            if select_matches(raquery, json_tuple):
+                yield relation, json_tuple
+
+    elif isinstance(raquery, radb.ast.Rename):
+        for relation, json_tuple in stream_tuples(raquery.inputs[0], env):
+            prefix = extract_tabname_record(json_tuple) + "."
+            yield relation, {k.replace(prefix, raquery.relname + "."): v for k, v in json_tuple.items()}
+
+    elif isinstance(raquery, radb.ast.Project):
+        seen = set()
+        for relation, json_tuple in stream_tuples(raquery.inputs[0], env):
+            table_name = extract_tabname_record(json_tuple)
+            attributes = [str(att) if att.rel is not None else table_name + "." + att.name for att in raquery.attrs]
+            d = {k: v for k, v in json_tuple.items() if k in attributes}
+            res = codec.dumps(d)
+            if len(d) != 0 and res not in seen:
+                seen.add(res)
+                yield relation, d
+
+    elif isinstance(raquery, radb.ast.Join) or isinstance(raquery, radb.ast.Cross):
+        for output in stream_join(raquery, env):
+            yield output
+
+    elif isinstance(raquery, radb.ast.Aggr):
+        for output in stream_aggregate(raquery, env):
+            yield output
+
+    else:
+        raise Exception("Operator " + str(type(raquery)) + " not implemented (yet).")
+
+
+def first_rows(raquery, order_by=(), limit=None, env=ExecEnv.HDFS):
+    """yields the (relation, tuple) pairs of the result of a query as they are found, up to limit.
+        With an ORDER BY the whole result has to be seen first, only the limit first tuples are kept"""
+    tuples = stream_tuples(raquery, env)
+    if len(order_by) != 0:
+        key = lambda e: SortKey(order_by, e[1])
+        tuples = iter(sorted(tuples, key=key) if limit is None else heapq.nsmallest(limit, tuples, key=key))
+    try:
+        for output in itertools.islice(tuples, limit):
+            yield output
+    finally:
+        if hasattr(tuples, 'close'):
+            tuples.close()
+
+
+'''
+Incremental maintenance of materialized views (see views.py): the delta of a
+query is evaluated by python generators, each leaf (relation) reading a byte
+range of its file. Operators keep duplicates, the view counts them.
+'''
+
+
+def relation_leaves(ra):
+    """the relations read by ra in the order of its leaves, a relation read twice appearing twice"""
+    if isinstance(ra, radb.ast.RelRef):
+        return [ra.rel]
+    return [relation for e in ra.inputs for relation in relation_leaves(e)]
+
+
+def delta_terms(raquery, marks, sizes):
+    """the byte ranges read by the leaves of raquery for each term of its delta: in the i-th
+        term, the leaves before the i-th read the rows up to their mark, the i-th leaf the rows
+        appended after its mark, the leaves after it all rows. Terms with an empty range are left out"""
+    leaves = relation_leaves(raquery)
+    terms = []
+    for i, relation in enumerate(leaves):
+        ranges = [(0, marks.get(r, 0)) for r in leaves[:i]] + [(marks.get(relation, 0), sizes[relation])] + \
+            [(0, sizes[r]) for r in leaves[i + 1:]]
+        if all(start < end for start, end in ranges):
+            terms.append(ranges)
+    return terms
+
+
+def delta_stream(raquery, ranges, env):
+    """yields the (relation, tuple) derivations of raquery, duplicates included, its i-th leaf reading
+        the byte range ranges[i] of its relation. Joins hash the side reading fewer bytes"""
+    if isinstance(raquery, radb.ast.RelRef):
+        start, end = ranges[0]
+        target = InputData(filename=raquery.rel + ".json", exec_environment=env).output()
+        for relation, json_tuple in range_tuples(target, start, end):
+            yield relation, json_tuple
+
+    elif isinstance(raquery, radb.ast.Select):
+        for relation, json_tuple in delta_stream(raquery.inputs[0], ranges, env):
+            if select_matches(raquery, json_tuple):
+                yield relation, json_tuple
+
+    elif isinstance(raquery, radb.ast.Rename):
+        for relation, json_tuple in delta_stream(raquery.inputs[0], ranges, env):
+            prefix = extract_tabname_record(json_tuple) + "."
+            yield relation, {k.replace(prefix, raquery.relname + "."): v for k, v in json_tuple.items()}
+
+    elif isinstance(raquery, radb.ast.Project):
+        for relation, json_tuple in delta_stream(raquery.inputs[0], ranges, env):
+            table_name = extract_tabname_record(json_tuple)
+            attributes = [str(att) if att.rel is not None else table_name + "." + att.name for att in raquery.attrs]
+            d = {k: v for k, v in json_tuple.items() if k in attributes}
+            if len(d) != 0:
+                yield relation, d
+
+    elif isinstance(raquery, radb.ast.Join) or isinstance(raquery, radb.ast.Cross):
+        cond = raquery.cond if isinstance(raquery, radb.ast.Join) else None
+        attrs = join_attributes(raquery) if cond is not None and join_strategy(raquery)[0] == 'hash' else None
+        relation = 'joint1' if cond is not None else 'cross'
+        n = len(relation_leaves(raquery.inputs[0]))
+        sides = [ranges[:n], ranges[n:]]
+        build = 0 if sum(end - start for start, end in sides[0]) <= sum(end - start for start, end in sides[1]) else 1
+        table = {}
+        for r, json_tuple in delta_stream(raquery.inputs[build], sides[build], env):
+            table.setdefault(join_key(json_tuple, attrs[build]) if attrs is not None else None, []).append(json_tuple)
+        if len(table) == 0:
+            return
+        probe = 1 - build
+        for r, json_tuple in delta_stream(raquery.inputs[probe], sides[probe], env):
+            for other in table.get(join_key(json_tuple, attrs[probe]) if attrs is not None else None, []):
+                d = dict(json_tuple if probe == 0 else other)
+                d.update(other if probe == 0 else json_tuple)
+                if cond is None or eval_cond(cond, d):
+                    yield relation, d
+
+    else:
+        raise Exception("Operator " + str(type(raquery)) + " cannot be maintained incrementally.")
+
+
 if __name__ == '__main__':
     luigi.run()
@@ -3,339 +3,502 @@ import radb
 import radb.ast
 import radb.parse
 
+'''
+The optimizer is a small rule engine. A rule looks at one node of the relational
+algebra tree and returns the node rewritten, or None if it does not apply. The
+engine rewrites the tree bottom-up, the inputs of a node before the node, and
+rewrites every result again until no rule applies anymore (a fixpoint). Subtrees
+already in normal form are remembered and never visited twice.
 
-def select_number(ra):
-    return str(ra).count('\\select')
+The rules ask questions about the tree (which relations a subtree produces, which
+attributes a condition refers to, ...) through property visitors, which compute
+a property once per node and cache it. Nothing is decided by scanning str(ra).
+'''
 
 
-def cross_number(ra):
-    return str(ra).count('\\cross')
-
+class PropertyVisitor(object):
+    '''
+    Computes a derived property of a node from the properties of its inputs, by
+    dispatching to visit_<node class>, and memoizes it per node. Nodes are never
+    modified by the rules (they build new ones), so a cached value stays valid.
+    '''
 
-def joint_number(ra):
-    return str(ra).count('\\join')
+    def __init__(self):
+        self.memo = {}
 
+    def __call__(self, node):
+        entry = self.memo.get(id(node))
+        if entry is None or entry[0] is not node:
+            entry = (node, getattr(self, 'visit_' + type(node).__name__, self.generic_visit)(node))
+            self.memo[id(node)] = entry
+        return entry[1]
 
-def tris(x, cross_list):
-    """this function is used to sort the conditions with the same order as the cross tables order"""
-    cross_list_name = [x.rel if isinstance(x, radb.ast.RelRef) else x.relname for x in cross_list]
-    x1 = cross_list_name.index(x.inputs[0].rel)
-    x2 = cross_list_name.index(x.inputs[1].rel)
-    return x1 + x2
+    def generic_visit(self, node):
+        raise Exception("Operator " + str(type(node)) + " not implemented (yet).")
 
 
-def break_select(ra):
-    """ Breaks up Complex selection into simple selection operations."""
-    # valExpreBinary_list_ra will contain all the valExprBinaryOp objects in the right order.
-    valExpreBinary_list_ra = [ra.cond.inputs[1]]
-    inputs_0 = ra.cond.inputs[0]
-    prev_inputs_0 = None
-    while (type(inputs_0.inputs[0]) == radb.ast.ValExprBinaryOp):
-        valExpreBinary_list_ra.append(inputs_0.inputs[1])
-        prev_inputs_0 = inputs_0
-        inputs_0 = inputs_0.inputs[0]
-    if type(inputs_0.inputs[0]) != radb.ast.ValExprBinaryOp and prev_inputs_0 == None:
-        valExpreBinary_list_ra.append(inputs_0)
-    elif prev_inputs_0 != None:
-        valExpreBinary_list_ra.append(prev_inputs_0.inputs[0])
-
-    # The creation of the desired Selection object.
-    select_index_number = len(valExpreBinary_list_ra)
-    res = radb.ast.Select(cond=valExpreBinary_list_ra[0], input=ra.inputs[0])
-    for i in range(1, select_index_number):
-        res = (radb.ast.Select(cond=valExpreBinary_list_ra[i], input=res))
-    return res
-
-
-def clean_query(sql_query):
-    """this function eliminates extra whitespaces"""
-    return re.sub("\s\s+", " ", sql_query).strip()
-
-
-def cross_tolist(cross_object):
-    """this function returns a list containing the tables from a cross object"""
-    cross_object_list = [cross_object.inputs[1]]
-    test_cross = cross_object.inputs[0]
-    if not isinstance(test_cross, radb.ast.Cross):
-        cross_object_list.append(test_cross)
-        return cross_object_list
-    while (isinstance(test_cross.inputs[0], radb.ast.Cross)):
-        cross_object_list.append(test_cross.inputs[1])
-        test_cross = test_cross.inputs[0]
-    cross_object_list.extend(test_cross.inputs[::-1])
-    return cross_object_list
-
-
-def extract_cross_select(ra):
-    """this function returns a list containing the select_objects inside a cross object(s)"""
-    cross_select_list = [ra.inputs[1]]
-    test_cross = ra.inputs[0]
-
-    while (isinstance(test_cross, radb.ast.Cross)):
-        cross_select_list.append(test_cross.inputs[1])
-        test_cross = test_cross.inputs[0]
-    cross_select_list.append(test_cross)
-
-    return cross_select_list
-
-
-def rule_merge_selections_cross(ra):
-    """this function merge the select_objects inside the cross_object(s)"""
-    L = extract_cross_select(ra)
-    selections = [merge_select(s) if isinstance(s, radb.ast.Select) else s for s in L]
-    n = len(selections)
-    res = selections[-1]
-    for i in range(n - 2, -1, -1):
-        res = radb.ast.Cross(res, selections[i])
-    return res
-
-
-def split_selection_cross(ra):
-    """this function returns: list of select_conditions and a list of
-            tables (inside a cross object) in the form of a tuple"""
-    cross_list = []
-    list_selection_cond = [ra.cond]
-    test_cross = ra.inputs[0]
-    while (isinstance(test_cross, radb.ast.Select)):
-        list_selection_cond.append(test_cross.cond)
-        test_cross = test_cross.inputs[0]
-
-    if isinstance(test_cross, radb.ast.Cross):
-        cross_list = cross_tolist(test_cross)
-
-    return list_selection_cond, cross_list
-
-
-def is_cross_select(s):
-    """this function returns True if both terms of a select_condition are AttRef
-                and have the same attribute name (T.name) else False"""
-    return isinstance(s.inputs[0], radb.ast.AttrRef) and isinstance(s.inputs[1], radb.ast.AttrRef) and (s.inputs[
-        0].name == s.inputs[1].name or s.inputs[0].name[1:] == s.inputs[1].name[1:])
-
-
-def remaining_select(select_list):
-    """returns the select_conditions that are not pushed down"""
-    return [s for s in select_list if not is_cross_select(s)]
-
-
-def is_neither(s):
-    """used to extract select_conditions that are not pushed_down and that
-        are not used in push_step1 and push_step2 functions"""
-    return isinstance(s.inputs[0], radb.ast.AttrRef) and isinstance(s.inputs[1], radb.ast.AttrRef) and str(s).count(
-        '.') == 2
-
-
-def replace(table, remaining_list, dd):
-    """this function used to replace table with the suitable select_obj
-                    while parsing the ra object recursiely"""
-    L = []
-    for cond in remaining_list:
-        if isinstance(table, radb.ast.Rename):
-            if table.relname is None:
-                a = dd[table.inputs[0].rel].get(cond.inputs[0].name, False)
-                if a:
-                    L.append(cond)
+class Relations(PropertyVisitor):
+    '''
+    The names (or aliases) of the relations whose attributes a subtree produces.
+    '''
+
+    def visit_RelRef(self, node):
+        return frozenset([node.rel])
+
+    def visit_Rename(self, node):
+        return frozenset([node.relname]) if node.relname is not None else self(node.inputs[0])
+
+    def visit_Select(self, node):
+        return self(node.inputs[0])
+
+    def generic_visit(self, node):
+        return frozenset().union(*[self(e) for e in node.inputs])
+
+
+class Schema(PropertyVisitor):
+    '''
+    The qualified attribute names ("relation.attribute") a subtree produces, as far
+    as the data dictionary knows the relations.
+    '''
+
+    def __init__(self, dd):
+        super(Schema, self).__init__()
+        self.dd = dd
+
+    def visit_RelRef(self, node):
+        return frozenset(node.rel + "." + a for a in self.dd.get(node.rel, {}))
+
+    def visit_Rename(self, node):
+        if node.relname is None:
+            return self(node.inputs[0])
+        return frozenset(node.relname + a[a.index("."):] for a in self(node.inputs[0]))
+
+    def visit_Select(self, node):
+        return self(node.inputs[0])
+
+    def generic_visit(self, node):
+        return frozenset().union(*[self(e) for e in node.inputs])
+
+
+class Conjuncts(PropertyVisitor):
+    '''
+    The terms of a condition, read as a conjunction.
+    '''
+
+    def visit_ValExprBinaryOp(self, node):
+        if node.op == radb.ast.sym.AND:
+            return self(node.inputs[0]) + self(node.inputs[1])
+        return (node,)
+
+    def generic_visit(self, node):
+        return (node,)
+
+
+def is_constant(attr):
+    """returns True if an attribute reference stands for a literal (sql2ra keeps literals as attribute names)"""
+    if attr.rel is not None:
+        return re.match(r"^-?\d+$", attr.rel) is not None
+    return attr.name.startswith("'") or re.match(r"^-?\d+(\.\d+)?$", attr.name) is not None
+
+
+class References(PropertyVisitor):
+    '''
+    The attributes a condition refers to, as (relation or None, attribute name) pairs.
+    '''
+
+    def visit_AttrRef(self, node):
+        return frozenset() if is_constant(node) else frozenset([(node.rel, node.name)])
+
+    def generic_visit(self, node):
+        return frozenset().union(*[self(e) for e in getattr(node, 'inputs', None) or []])
+
+
+class Bases(PropertyVisitor):
+    '''
+    Maps the relation names (or aliases) a subtree produces to the base relations they stand for.
+    '''
+
+    def visit_RelRef(self, node):
+        return {node.rel: node.rel}
+
+    def visit_Rename(self, node):
+        bases = self(node.inputs[0])
+        if node.relname is None or len(set(bases.values())) != 1:
+            return bases
+        return {node.relname: list(bases.values())[0]}
+
+    def generic_visit(self, node):
+        bases = {}
+        for e in node.inputs:
+            bases.update(self(e))
+        return bases
+
+
+class Cardinality(PropertyVisitor):
+    '''
+    The estimated number of tuples a subtree produces, from the statistics catalog:
+    the base relations' sizes times the selectivities of the conditions.
+    '''
+
+    def __init__(self, optimizer):
+        super(Cardinality, self).__init__()
+        self.optimizer = optimizer
+
+    def visit_RelRef(self, node):
+        return float(self.optimizer.catalog.rows(node.rel))
+
+    def visit_Select(self, node):
+        return self(node.inputs[0]) * self.optimizer.selectivity(node.cond, node)
+
+    def visit_Join(self, node):
+        return self(node.inputs[0]) * self(node.inputs[1]) * self.optimizer.selectivity(node.cond, node)
+
+    def visit_Cross(self, node):
+        return self(node.inputs[0]) * self(node.inputs[1])
+
+    def generic_visit(self, node):
+        return self(node.inputs[0])
+
+
+def with_inputs(ra, inputs):
+    """returns a copy of the node ra reading the given inputs"""
+    if isinstance(ra, radb.ast.Select):
+        return radb.ast.Select(ra.cond, inputs[0])
+    if isinstance(ra, radb.ast.Project):
+        return radb.ast.Project(ra.attrs, inputs[0])
+    if isinstance(ra, radb.ast.Rename):
+        return radb.ast.Rename(ra.relname, ra.attrnames, inputs[0])
+    if isinstance(ra, radb.ast.Aggr):
+        return radb.ast.Aggr(ra.groupbys, ra.aggrs, inputs[0])
+    if isinstance(ra, radb.ast.Cross):
+        return radb.ast.Cross(inputs[0], inputs[1])
+    if isinstance(ra, radb.ast.Join):
+        return radb.ast.Join(inputs[0], ra.cond, inputs[1])
+    raise Exception("Operator " + str(type(ra)) + " not implemented (yet).")
+
+
+def conjunction(terms):
+    """the condition t1 and t2 and ... (associating to the left, as parsed)"""
+    cond = terms[0]
+    for term in terms[1:]:
+        cond = radb.ast.ValExprBinaryOp(cond, radb.ast.sym.AND, term)
+    return cond
+
+
+def selections(conds, ra):
+    """the stack of selections sigma_{c1}(sigma_{c2}(... ra))"""
+    for cond in reversed(conds):
+        ra = radb.ast.Select(cond, ra)
+    return ra
+
+
+class RuleEngine(object):
+    '''
+    Applies a list of rules to a tree until none applies anymore. The rules are
+    tried in order at each node; the first one that applies wins. Top-down, the
+    rules are applied to a node before its inputs are rewritten (a rule moving
+    things down then handles them all in one go), and again afterwards.
+    '''
+
+    def __init__(self, rules, top_down=False):
+        self.rules = rules
+        self.top_down = top_down
+        self.normal = {}
+
+    def apply(self, ra):
+        """applies the first rule that applies to the node, returns None if there is none"""
+        for rule in self.rules:
+            res = rule(ra)
+            if res is not None:
+                return res
+        return None
+
+    def rewrite(self, ra):
+        if self.normal.get(id(ra), (None,))[0] is ra:
+            return self.normal[id(ra)][1]
+        node = ra
+        res = self.apply(node) if self.top_down else None
+        while res is not None:
+            node, res = res, self.apply(res)
+        inputs = [self.rewrite(e) for e in node.inputs]
+        if any(a is not b for a, b in zip(inputs, node.inputs)):
+            node = with_inputs(node, inputs)
+        res = self.apply(node)
+        if res is not None:
+            node = self.rewrite(res)
+        self.normal[id(ra)] = (ra, node)
+        self.normal[id(node)] = (node, node)
+        return node
+
+
+class Optimizer(object):
+    '''
+    The optimization rules, sharing the property visitors of one optimization run.
+    '''
+
+    def __init__(self, dd=None, catalog=None, bushy=True, dp_limit=10):
+        self.relations = Relations()
+        self.schema = Schema(dd or {})
+        self.conjuncts = Conjuncts()
+        self.references = References()
+        self.bases = Bases()
+        self.cardinality = Cardinality(self)
+        self.catalog = catalog
+        self.bushy = bushy
+        self.dp_limit = dp_limit
+        self.planned = {}
+        self.region = None
+
+    def input_side(self, cond, ra):
+        """the index of the input of a cross product or join holding all attributes of a condition, or None"""
+        references = self.references(cond)
+        if len(references) == 0:
+            return None
+        for i, e in enumerate(ra.inputs):
+            if all(rel in self.relations(e) if rel is not None else
+                   any(a.endswith("." + name) for a in self.schema(e)) for rel, name in references):
+                return i
+        return None
+
+    def break_up_selection(self, ra):
+        """sigma_{a and b}(R) -> sigma_{a}(sigma_{b}(R))"""
+        if isinstance(ra, radb.ast.Select) and len(self.conjuncts(ra.cond)) > 1:
+            return radb.ast.Select(ra.cond.inputs[0], radb.ast.Select(ra.cond.inputs[1], ra.inputs[0]))
+        return None
+
+    def push_down_selections(self, ra):
+        """moves the selections of a stack over a cross product (or join) into the inputs holding
+            their attributes, all at once. The selections a stack keeps stay in their order"""
+        if not isinstance(ra, radb.ast.Select):
+            return None
+        conds, below = [], ra
+        while isinstance(below, radb.ast.Select):
+            conds.append(below.cond)
+            below = below.inputs[0]
+        if not (isinstance(below, radb.ast.Cross) or isinstance(below, radb.ast.Join)):
+            return None
+        sides = [self.input_side(cond, below) for cond in conds]
+        if all(side is None for side in sides):
+            return None
+        inputs = [selections([c for c, s in zip(conds, sides) if s == i], e) for i, e in enumerate(below.inputs)]
+        return selections([c for c, s in zip(conds, sides) if s is None], with_inputs(below, inputs))
+
+    def merge_selections(self, ra):
+        """sigma_{a}(sigma_{b}(R)) -> sigma_{a and b}(R)"""
+        if isinstance(ra, radb.ast.Select) and isinstance(ra.inputs[0], radb.ast.Select):
+            below = ra.inputs[0]
+            return radb.ast.Select(conjunction(self.conjuncts(ra.cond) + self.conjuncts(below.cond)), below.inputs[0])
+        return None
+
+    def introduce_join(self, ra):
+        """sigma_{c}(R x S) -> R join_{c} S"""
+        if isinstance(ra, radb.ast.Select) and isinstance(ra.inputs[0], radb.ast.Cross):
+            cross = ra.inputs[0]
+            return radb.ast.Join(cross.inputs[0], ra.cond, cross.inputs[1])
+        return None
+
+    def distinct(self, reference, ra):
+        """the number of distinct values of an attribute of ra, None if the catalog does not know"""
+        rel, name = reference
+        bases = self.bases(ra)
+        for alias in ([rel] if rel is not None else bases):
+            if alias in bases:
+                d = self.catalog.distinct(bases[alias], name)
+                if d is not None:
+                    return max(d, 1)
+        return None
+
+    def selectivity(self, cond, ra):
+        """the estimated fraction of the tuples of ra satisfying a condition: 1 / distinct values
+            for equalities (of the attribute with the most of them, for two attributes), 1/10 if
+            those are unknown, and 1/3 for any other comparison"""
+        s = 1.0
+        for term in self.conjuncts(cond):
+            references = self.references(term)
+            if len(references) == 0:
+                continue
+            if isinstance(term, radb.ast.ValExprBinaryOp) and term.op == radb.ast.sym.EQ:
+                distinct = [self.distinct(r, ra) for r in references]
+                s *= 1.0 / max(distinct) if None not in distinct else 0.1
             else:
-                if table.relname == cond.inputs[0].rel:
-                    a = dd[table.inputs[0].rel].get(cond.inputs[0].name, False)
-                    if a:
-                        L.append(cond)
+                s /= 3.0
+        return s
+
+    def leaves_of(self, cond, leaves):
+        """the bit mask of the join inputs holding the attributes of a condition"""
+        mask = 0
+        for rel, name in self.references(cond):
+            for i, e in enumerate(leaves):
+                if rel in self.relations(e) if rel is not None else \
+                        any(a.endswith("." + name) for a in self.schema(e)):
+                    mask |= 1 << i
+                    break
+            else:
+                return None
+        return mask
+
+    def join_plans(self, leaves, terms, masks):
+        """the cheapest join tree for each connected set of inputs, or for all inputs (greedily) when
+            there are more than dp_limit of them. Plans are (cost, tuples, tree), the cost of a join
+            being the tuples it reads and writes. The connected sets are joined by dynamic programming
+            over their pairs with a connected complement, enumerated as by DPccp (Moerkotte and
+            Neumann, 2006) on the graph linking the inputs of each condition, those of a condition on
+            more than two inputs all with each other: a pair is only joined if one of the conditions
+            is placed on its join. The pairs are planned by increasing size rather than in the order
+            of their enumeration, which then needs no breadth-first numbering of the inputs."""
+        sel = [self.selectivity(term, self.region) for term in terms]
+        edges = [(m, term, s) for m, term, s in zip(masks, terms, sel) if bin(m).count("1") > 1]
+
+        def linked(s1, s2):
+            return any(m & s1 and m & s2 and not m & ~(s1 | s2) for m, term, s in edges)
+
+        def join(p1, s1, p2, s2):
+            placed = [(term, s) for m, term, s in edges if m & s1 and m & s2 and not m & ~(s1 | s2)]
+            rows = p1[1] * p2[1]
+            for term, s in placed:
+                rows *= s
+            tree = radb.ast.Join(p1[2], conjunction([term for term, s in placed]), p2[2]) if placed else \
+                radb.ast.Cross(p1[2], p2[2])
+            self.planned[id(tree)] = tree
+            return p1[0] + p2[0] + p1[1] + p2[1] + rows, rows, tree
+
+        best = {1 << i: (0.0, self.cardinality(e), e) for i, e in enumerate(leaves)}
+        n = len(leaves)
+        if n <= self.dp_limit:
+            for s1, s2 in sorted(connected_pairs(n, [m for m, term, s in edges]),
+                                 key=lambda pair: bin(pair[0] | pair[1]).count("1")):
+                if s1 not in best or s2 not in best or not linked(s1, s2):
+                    continue
+                # s1 holds the lowest input; bushy plans join it on the left, left-deep ones a single input right
+                sides = [(s1, s2)] if self.bushy else [(a, b) for a, b in ((s1, s2), (s2, s1)) if b & (b - 1) == 0]
+                for a, b in sides:
+                    plan = join(best[a], a, best[b], b)
+                    if s1 | s2 not in best or plan[0] < best[s1 | s2][0]:
+                        best[s1 | s2] = plan
+            components = []
+            for i in range(n):
+                if any(i in c for c in components):
+                    continue
+                c = max((s for s in best if s & (1 << i)), key=lambda s: bin(s).count("1"))
+                components.append(set(j for j in range(n) if c & (1 << j)))
+            plans = [(sum(1 << j for j in c), best[sum(1 << j for j in c)]) for c in components]
         else:
-            if cond.inputs[0].rel == None:
-                a = dd[table.rel].get(cond.inputs[0].name, False)
-                if a:
-                    L.append(cond)
-            elif table.rel == cond.inputs[0].rel:
-                a = dd[table.rel].get(cond.inputs[0].name, False)
-                if a:
-                    L.append(cond)
-
-    n = len(L)
-    if n == 0:
-        return table
-    if n == 1:
-        return radb.ast.Select(L[0], table)
-    elif n > 1:
-        res = radb.ast.Select(L[0], table)
-        for i in range(1, n):
-            res = radb.ast.Select(L[i], res)
-
-        return res
-
-
-def swap(s):
-    """swap two consecutive selections"""
-    if isinstance(s, radb.ast.Select):
-        if isinstance(s.inputs[0], radb.ast.Select):
-            return radb.ast.Select(s.inputs[0].cond, radb.ast.Select(s.cond, s.inputs[0].inputs[0]))
-
-
-def select_rest(rest_list, input):
-    """used to add the is_neither(select) selections"""
-    res = rest_list[0]
-    if len(rest_list) == 1:
-        return radb.ast.Select(res, input)
-    elif len(rest_list) > 1:
-        res_input = radb.ast.Select(res, input)
-        for i in range(1, len(rest_list)):
-            res = radb.ast.Select(rest_list[i], res_input)
-        return res
-
-
-def push_step1(s_cond_list, cross_list):
-    """push only the select_objects used for the cross between tables"""
-    if len(s_cond_list) == 0:
-        return cross_list[0]
-    return radb.ast.Select(s_cond_list[0], radb.ast.Cross(push_step1(s_cond_list[1:], cross_list[1:]), cross_list[0]))
-
-
-def push_step2(remaining_list, cross_list, dd):
-    """push the select_objects that are not used for the cross"""
-    if len(cross_list) == 1:
-        return replace(cross_list[0], remaining_list, dd)
-    return radb.ast.Cross(push_step2(remaining_list, cross_list[1:], dd), replace(
-        cross_list[0], remaining_list, dd))
-
-
-def push_step3(s_cond_list, remaining_list, cross_list, dd):
-    """push_step1 and push_step2 combined(problem python doesn't use referencing so
-                I am obliged to recreate and return another object"""
-    if len(cross_list) == 1:
-        return replace(cross_list[0], remaining_list, dd)
-    return radb.ast.Select(s_cond_list[0],
-                           radb.ast.Cross(push_step3(s_cond_list[1:], remaining_list, cross_list[1:], dd), replace(
-                               cross_list[0], remaining_list, dd)))
-
-
-def push_down_rule_selection(ra, dd):
-    """used to push_down selections"""
-    s_cond_list, cross_list = split_selection_cross(ra)
-    remaining_s_list = remaining_select(s_cond_list)[::-1]
-    s_cond_list = [e for e in s_cond_list if e not in remaining_s_list]
-    s_cond_list.sort(key=lambda x: tris(x, cross_list))
-    rest = [e for e in remaining_s_list if is_neither(e)]
-    remaining_s_list = [e for e in remaining_s_list if e not in rest]
-
-    if len(remaining_s_list) == 0 and len(rest) == 0:
-        return push_step1(s_cond_list, cross_list)
-    elif len(remaining_s_list) == 0 and len(rest) != 0:
-        return swap(select_rest(rest, push_step1(s_cond_list, cross_list)))
-    elif len(remaining_s_list) != 0 and len(s_cond_list) == 0 and len(rest) == 0:
-        return push_step2(remaining_s_list, cross_list, dd)
-    elif len(remaining_s_list) != 0 and len(s_cond_list) == 0 and len(rest) != 0:
-        return select_rest(rest, push_step2(remaining_s_list, cross_list, dd))
-    elif len(remaining_s_list) != 0 and len(s_cond_list) != 0 and len(rest) == 0:
-        res = push_step3(s_cond_list, remaining_s_list, cross_list, dd)
-        return res
-    elif len(remaining_s_list) != 0 and len(s_cond_list) != 0 and len(rest) != 0:
-        return swap(select_rest(rest, push_step3(s_cond_list, remaining_s_list, cross_list, dd)))
-
-
-def merge_select(select_object):
-    """merge select_objects"""
-    if isinstance(select_object, radb.ast.RelRef):  # it is a simple select or just a table
-        return select_object
-
-    valEcprBinaryOp_list = [select_object.cond]
-    test_select = select_object.inputs[0]
-    if isinstance(test_select, radb.ast.RelRef):  # it is a simple select or just a table
-        return select_object
-
-    if not isinstance(test_select, radb.ast.Cross):
-
-        while (isinstance(test_select.inputs[0], radb.ast.Select)):
-            valEcprBinaryOp_list.append(test_select.cond)
-            test_select = test_select.inputs[0]
-
-        valEcprBinaryOp_list.append(test_select.cond)
-        n = len(valEcprBinaryOp_list)
-        res = valEcprBinaryOp_list[0]
-        for i in range(1, n):
-            res = radb.ast.ValExprBinaryOp(res, radb.ast.sym.AND, valEcprBinaryOp_list[i])
-
-        return radb.ast.Select(cond=res, input=test_select.inputs[0])
-    else:
-        return radb.ast.Select(cond=valEcprBinaryOp_list[0], input=test_select)
-
-
-def joint_r(object):
-    """joint function"""
-    if isinstance(object, radb.ast.RelRef):
-        return object
-    if isinstance(object.inputs[0], radb.ast.Rename):
-        return object
-
-    if isinstance(object.inputs[0], radb.ast.RelRef):
-        return object
-    else:
-        if isinstance(object.inputs[0], radb.ast.Cross):
-            return radb.ast.Join(joint_r(object.inputs[0].inputs[0]), object.cond, object.inputs[0].inputs[1])
-        if isinstance(object.inputs[1], radb.ast.RelRef):
-            return radb.ast.Join(joint_r(object.inputs[0]), object.cond, object.inputs[1])
+            plans = sorted(best.items())
+            while True:
+                candidates = [(s1, s2) for s1, p1 in plans for s2, p2 in plans if s1 != s2 and linked(s1, s2) and
+                              (self.bushy and s1 < s2 or not self.bushy and s2 & (s2 - 1) == 0 and
+                               (s1 & (s1 - 1) != 0 or all(s & (s - 1) == 0 for s, p in plans)))]
+                if not candidates:
+                    break
+                plan, s1, s2 = min(((join(dict(plans)[s1], s1, dict(plans)[s2], s2), s1, s2) for s1, s2 in candidates),
+                                   key=lambda c: (c[0][1], c[0][0]))
+                plans = sorted([(s, p) for s, p in plans if s not in (s1, s2)] + [(s1 | s2, plan)])
+        s, plan = plans[0]
+        for s2, p2 in plans[1:]:
+            plan, s = join(plan, s, p2, s2), s | s2
+        return plan
+
+    def reorder_joins(self, ra):
+        """replaces a tree of joins and cross products by the cheapest one joining the same inputs"""
+        if not (isinstance(ra, radb.ast.Join) or isinstance(ra, radb.ast.Cross)) or id(ra) in self.planned:
+            return None
+        leaves, terms, stack = [], [], [ra]
+        while stack:
+            e = stack.pop()
+            if isinstance(e, radb.ast.Join) or isinstance(e, radb.ast.Cross):
+                if isinstance(e, radb.ast.Join):
+                    terms += self.conjuncts(e.cond)
+                stack += reversed(e.inputs)
+            else:
+                leaves.append(e)
+        if len(leaves) < 3:
+            return None
+        self.region = ra
+        masks = [self.leaves_of(term, leaves) for term in terms]
+        top = [term for term, m in zip(terms, masks) if not m]
+        for i in range(len(leaves)):
+            leaves[i] = selections([term for term, m in zip(terms, masks) if m == 1 << i], leaves[i])
+        placed = [(term, m) for term, m in zip(terms, masks) if m and m & (m - 1)]
+        plan = self.join_plans(leaves, [term for term, m in placed], [m for term, m in placed])[2]
+        return selections(top, plan)
+
+
+def subsets(mask):
+    """the non-empty subsets of a bit mask"""
+    s = mask
+    while s:
+        yield s
+        s = (s - 1) & mask
+
+
+def connected_pairs(n, edges):
+    """the pairs (s1, s2) of disjoint connected sets of n inputs linked by an edge (bit masks of
+        the inputs it links), each pair once with the lowest input in s1: the csg-cmp pairs DPccp
+        enumerates, without duplicates"""
+    neighbors = [0] * n
+    for m in edges:
+        for i in range(n):
+            if m & (1 << i):
+                neighbors[i] |= m & ~(1 << i)
+
+    def neighborhood(s):
+        mask = 0
+        for i in range(n):
+            if s & (1 << i):
+                mask |= neighbors[i]
+        return mask & ~s
+
+    pairs = []
+
+    def complements(s1, s2, excluded):
+        n2 = neighborhood(s2) & ~excluded
+        for s in subsets(n2):
+            pairs.append((s1, s2 | s))
+        for s in subsets(n2):
+            complements(s1, s2 | s, excluded | n2)
+
+    def emit(s1):
+        excluded = s1 | ((s1 & -s1) - 1)
+        n1 = neighborhood(s1) & ~excluded
+        for i in reversed(range(n)):
+            if n1 & (1 << i):
+                pairs.append((s1, 1 << i))
+                complements(s1, 1 << i, excluded | (n1 & ((1 << (i + 1)) - 1)))
+
+    def sets(s, excluded):
+        n1 = neighborhood(s) & ~excluded
+        for s2 in subsets(n1):
+            emit(s | s2)
+        for s2 in subsets(n1):
+            sets(s | s2, excluded | n1)
+
+    for i in reversed(range(n)):
+        emit(1 << i)
+        sets(1 << i, (1 << (i + 1)) - 1)
+    return pairs
 
 
 def rule_break_up_selections(ra):
     """break_up selections function"""
-    if isinstance(ra, radb.ast.RelRef):
-        return ra
-    if str(ra).count('and') == 0:
-        return ra
-    if isinstance(ra, radb.ast.Select):
-        return break_select(ra)
-    elif isinstance(ra, radb.ast.Project):
-        return radb.ast.Project(attrs=ra.attrs, input=break_select(ra.inputs[0]))
-    elif isinstance(ra, radb.ast.Cross):
-        if isinstance(ra.inputs[0], radb.ast.Select):
-            return radb.ast.Cross(break_select(ra.inputs[0]), ra.inputs[1])
-        elif isinstance(ra.inputs[1], radb.ast.Select):
-            return radb.ast.Cross(ra.inputs[0], break_select(ra.inputs[1]))
+    return RuleEngine([Optimizer().break_up_selection]).rewrite(ra)
 
 
 def rule_push_down_selections(ra, dd):
     """push_down selections function """
-    if isinstance(ra, radb.ast.RelRef):
-        return ra
-    if cross_number(ra) == 0:
-        return ra
-    elif isinstance(ra, radb.ast.Project):
-        res = radb.ast.Project(ra.attrs, push_down_rule_selection(ra.inputs[0], dd))
-        return res
-    elif isinstance(ra, radb.ast.Select):
-        return push_down_rule_selection(ra, dd)
-    else:
-        return ra
+    return RuleEngine([Optimizer(dd).push_down_selections], top_down=True).rewrite(ra)
 
 
 def rule_merge_selections(ra):
     """merge selections function"""
-    if isinstance(ra, radb.ast.RelRef):
-        return ra
-    if select_number(ra) <= 1:
-        return ra
-    if isinstance(ra, radb.ast.Select):
-        return merge_select(ra)
-    if isinstance(ra, radb.ast.Cross):
-        return rule_merge_selections_cross(ra)
-    if isinstance(ra, radb.ast.Project):
-        if isinstance(ra.inputs[0], radb.ast.Select):
-            return radb.ast.Project(attrs=ra.attrs, input=merge_select(ra.inputs[0]))
-        elif isinstance(ra.inputs[0], radb.ast.Cross):
-            return radb.ast.Project(attrs=ra.attrs, input=rule_merge_selections_cross(ra.inputs[0]))
+    return RuleEngine([Optimizer().merge_selections]).rewrite(ra)
 
 
 def rule_introduce_joins(ra):
     """join introduce function"""
-    if isinstance(ra, radb.ast.RelRef):
-        return ra
-    if cross_number(ra) == 0:
-        return ra
-    if select_number(ra) == 0:
-        return ra
-    if isinstance(ra, radb.ast.Cross):
-        return ra
-    if isinstance(ra, radb.ast.Project):
-        return radb.ast.Project(attrs=ra.attrs, input=joint_r(ra.inputs[0]))
-    else:
-        return joint_r(ra)
+    return RuleEngine([Optimizer().introduce_join]).rewrite(ra)
 
 
+def rule_reorder_joins(ra, dd, catalog, bushy=True, dp_limit=10):
+    """chooses the join order (and shape: bushy, or left-deep with base relations on the right)
+        with the least estimated cost, exhaustively (DPccp) up to dp_limit relations, greedily beyond"""
+    return RuleEngine([Optimizer(dd, catalog, bushy, dp_limit).reorder_joins], top_down=True).rewrite(ra)
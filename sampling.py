@@ -0,0 +1,182 @@
+import hashlib
+import json
+import math
+import statistics
+
+import luigi
+import radb.ast
+
+import raopt
+
+'''
+Approximate queries (see miniHive.py --sample): the relations of a query are
+read through samples of a given fraction p of their tuples (ra2mr.SampleTask),
+the query is evaluated on the samples as usual, and counts and sums are scaled
+up by 1/p.
+
+A single relation is sampled by Bernoulli sampling (every tuple is kept with
+probability p) or block sampling (every block of block_size bytes is kept with
+probability p; only those blocks are read, except in HDFS). Sampling both
+inputs of a join independently would keep a joined pair with probability p * p
+only, and lose most of the matches, so the relations joined on the attributes
+of a join key (the largest set of relations whose join attributes the join
+conditions equate) are sampled on the hash of that key instead: a tuple is
+kept if its key hashes below p, the same for all relations, so that a key's
+tuples are either all kept or all dropped on every side of the joins, and a
+joined tuple is kept with probability p. The other relations are read whole.
+
+The confidence intervals follow the normal approximation, the variance of an
+estimate being that of a sample of clusters: the tuples of a key value for hash
+samples, single tuples otherwise (which understates the variance of block
+samples, whose tuples are dropped together). Groups missing in the sample are
+missing in the estimates, minimums and maximums are those of the sample.
+
+The sampling plan of a query is installed in [minihive] sample of the luigi
+configuration, for the tasks reading the relations (see ra2mr.relation_input).
+'''
+
+METHODS = ["bernoulli", "block"]
+
+
+def configured():
+    """the samples of the relations, {relation: {"method": ..., "fraction": ..., "key": [...], "seed": ...}}"""
+    return json.loads(luigi.configuration.get_config().get('minihive', 'sample', '') or '{}')
+
+
+def hashed(values, seed=0):
+    """a number in [0, 1) the values hash to, the same in all relations (crc32, as used for the
+        buckets, is linear and spreads neighboring keys unevenly, hence a cryptographic hash)"""
+    digest = hashlib.blake2b(json.dumps([seed, values]).encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'big') / 2.0 ** 64
+
+
+def key_classes(ra, dd):
+    """the sets of (alias, base relation, attribute) that equality terms of the join (and selection)
+        conditions of ra equate, unqualified attributes being looked up in the data dictionary"""
+    optimizer = raopt.Optimizer(dd)
+    bases = optimizer.bases(ra)
+
+    def resolve(reference):
+        rel, name = reference
+        aliases = [rel] if rel is not None else [a for a, base in bases.items() if name in dd.get(base, {})]
+        return (aliases[0], bases[aliases[0]], name) if len(aliases) == 1 and aliases[0] in bases else None
+
+    classes, stack = [], [ra]
+    while stack:
+        e = stack.pop()
+        stack += e.inputs or []
+        if not (isinstance(e, radb.ast.Join) or isinstance(e, radb.ast.Select)) or e.cond is None:
+            continue
+        for term in optimizer.conjuncts(e.cond):
+            references = optimizer.references(term)
+            if not isinstance(term, radb.ast.ValExprBinaryOp) or term.op != radb.ast.sym.EQ or \
+                    len(references) != 2:
+                continue
+            attributes = set(resolve(r) for r in references)
+            if None in attributes:
+                continue
+            merged = [c for c in classes if c & attributes]
+            classes = [c for c in classes if not c & attributes] + [attributes.union(*merged)]
+    return classes
+
+
+def plan(ra, dd, fraction, method="bernoulli", seed=0, stats=None):
+    """the samples of the relations of a query, {relation: spec} (see configured), and the attributes
+        (alias, attribute) identifying the clusters of the sampled tuples (none: every tuple is one).
+        The relations of the largest join key are sampled on its hash, or else the largest relation
+        (by the catalog stats) is sampled with method"""
+    best = []
+    for c in key_classes(ra, dd):
+        attributes = {}
+        for alias, base, name in c:
+            attributes.setdefault(base, set()).add(name)
+        # a relation joined on two attributes of the key (a self join) cannot be sampled on both
+        c = [(alias, base, name) for alias, base, name in c if len(attributes[base]) == 1]
+        if len(set(base for alias, base, name in c)) > max(1, len(set(base for alias, base, name in best))):
+            best = c
+    if best:
+        specs = {base: {"method": "hash", "fraction": fraction, "key": [name], "seed": seed}
+                 for alias, base, name in best}
+        return specs, sorted((alias, name) for alias, base, name in best)
+    relations = sorted(set(raopt.Optimizer(dd).bases(ra).values()))
+    if stats is not None:
+        relations.sort(key=lambda relation: -stats.rows(relation))
+    return {relations[0]: {"method": method, "fraction": fraction, "key": [], "seed": seed}}, []
+
+
+class Sampling(object):
+    '''
+    Installs the samples of a plan in the configuration while a query runs.
+    '''
+
+    def __init__(self, specs):
+        self.specs = specs
+
+    def __enter__(self):
+        luigi.configuration.get_config().set('minihive', 'sample', json.dumps(self.specs))
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        luigi.configuration.get_config().set('minihive', 'sample', '')
+        return False
+
+
+def cluster(json_tuple, clusters, i):
+    """the cluster of the i-th sampled tuple: its value of a key attribute, or the tuple itself"""
+    for alias, name in clusters:
+        if alias + "." + name in json_tuple:
+            return json.dumps(json_tuple[alias + "." + name])
+    return i
+
+
+def interval(value, variance, confidence):
+    """the confidence interval [low, high] of an estimate, by the normal approximation"""
+    z = statistics.NormalDist().inv_cdf((1 + confidence) / 2.0)
+    half = z * math.sqrt(max(variance, 0.0))
+    return [value - half, value + half]
+
+
+def estimates(tuples, aggr, fraction, clusters, confidence=0.95):
+    """the estimated result of an aggregation aggr (None: of the number of tuples of the query) from
+        the tuples of its input evaluated on the samples: (tuple, {aggregate: [low, high] or None}) per group"""
+    from ra2mr import attribute_name, attribute_value, eval_cond  # ra2mr reads samples through this module
+
+    groupbys = aggr.groupbys if aggr is not None else []
+    aggrs = aggr.aggrs if aggr is not None else []
+    groups = {}
+    for i, json_tuple in enumerate(tuples):
+        key = json.dumps([[attribute_name(attr, json_tuple), attribute_value(attr, json_tuple)] for attr in groupbys])
+        values = [eval_cond(a.args[0], json_tuple) for a in aggrs]
+        group = groups.setdefault(key, {"values": [[] for a in aggrs], "clusters": {}})
+        sums = group["clusters"].setdefault(cluster(json_tuple, clusters, i), [0] + [0] * len(aggrs))
+        sums[0] += 1
+        for j, value in enumerate(values):
+            group["values"][j].append(value)
+            sums[j + 1] += value if aggrs[j].func.lower() in ('sum', 'avg') else 0
+    if aggr is None and not groups:
+        groups[json.dumps([])] = {"values": [], "clusters": {}}
+
+    p = fraction
+    factor = (1 - p) / (p * p)
+    for key, group in groups.items():
+        d = {name: value for name, value in json.loads(key)}
+        intervals = {}
+        sums = list(group["clusters"].values())
+        count = sum(s[0] for s in sums)
+        if aggr is None:
+            d["rows"] = count / p
+            intervals["rows"] = interval(d["rows"], factor * sum(s[0] ** 2 for s in sums), confidence)
+        for j, a in enumerate(aggrs):
+            func = a.func.lower()
+            if func == 'count':
+                value, variance = count / p, factor * sum(s[0] ** 2 for s in sums)
+            elif func == 'sum':
+                value, variance = sum(s[j + 1] for s in sums) / p, factor * sum(s[j + 1] ** 2 for s in sums)
+            elif func == 'avg':
+                value = float(sum(s[j + 1] for s in sums)) / count
+                variance = factor * sum((s[j + 1] - value * s[0]) ** 2 for s in sums) / (count / p) ** 2
+            else:
+                value, variance = (min if func == 'min' else max)(group["values"][j]), None
+            d[str(a)] = value
+            intervals[str(a)] = interval(value, variance, confidence) if variance is not None else None
+        yield d, intervals
@@ -5,15 +5,63 @@ import radb.ast
 import radb.parse
 
 
+def is_distinct(stmt_tokens):
+    """returns True if the query is a select distinct"""
+    return stmt_tokens[2].ttype is sqlparse.tokens.Keyword and stmt_tokens[2].normalized == 'DISTINCT'
+
+
+def select_list(stmt_tokens):
+    """returns the token of the select clause, behind the distinct keyword if there is one"""
+    return stmt_tokens[4] if is_distinct(stmt_tokens) else stmt_tokens[2]
+
+
 def columns(stmt_tokens):
     """returns a list containing all columns name in the query or * """
-    p = stmt_tokens[4].value
+    p = select_list(stmt_tokens).value
     if p.count('*'):
         return "*"
     else:
         return re.findall(r"[\w.']+", p)
 
 
+def aggregates(stmt_tokens):
+    """returns a list of (function, argument) pairs for the aggregates of the select clause"""
+    return re.findall(r"(count|sum|min|max|avg)\s*\(\s*([\w.*]+)\s*\)", select_list(stmt_tokens).value,
+                      re.IGNORECASE)
+
+
+def split_order_by_limit(sql_query):
+    """returns the sql_query without its order by and limit clauses, the list of (attribute, 'asc' or 'desc')
+        pairs to order on, and the limit (None if there is none)"""
+    limit = None
+    match = re.search(r"\slimit\s+(\d+)\s*$", sql_query, re.IGNORECASE)
+    if match is not None:
+        limit = int(match.group(1))
+        sql_query = sql_query[:match.start()]
+    order_by = []
+    match = re.search(r"\sorder\s+by\s+(.*)$", sql_query, re.IGNORECASE)
+    if match is not None:
+        for attribute, direction in re.findall(r"([\w.]+(?:\s*\([\w.*]+\))?)(?:\s+(asc|desc))?",
+                                               match.group(1), re.IGNORECASE):
+            order_by.append((re.sub(r"\s+", "", attribute).replace("(*)", "(1)"), (direction or 'asc').lower()))
+        sql_query = sql_query[:match.start()]
+    return sql_query, order_by, limit
+
+
+def order_by_limit(stmt):
+    """returns the order by attributes and the limit of a query (see split_order_by_limit)"""
+    sql, order_by, limit = split_order_by_limit(clean_query(stmt.value))
+    return order_by, limit
+
+
+def split_group_by(sql_query):
+    """returns the sql_query without its group by clause, and the list of grouping attributes"""
+    match = re.search(r"\sgroup\s+by\s+(.*)$", sql_query, re.IGNORECASE)
+    if match is None:
+        return sql_query, []
+    return sql_query[:match.start()], re.findall(r"[\w.]+", match.group(1))
+
+
 def extract_rel_name(attribute):
     """ returns a dictionary containing rel and name attributes used for the construction of the object AttrRef"""
     if attribute.count('.') != 0:
@@ -40,7 +88,8 @@ def extract_table_name(name):
 
 def table_list_names(stmt_tokens):
     """ returns a list containing tables name"""
-    return list(map(lambda x: x.strip(), clean_table_names(stmt_tokens[8].value).split(',')))
+    tables = stmt_tokens[8 if is_distinct(stmt_tokens) else 6]
+    return list(map(lambda x: x.strip(), clean_table_names(tables.value).split(',')))
 
 
 def clean_table_names(table_names):
@@ -69,7 +118,7 @@ def cross(table_names):
 def select(stmt_tokens, table_names):
     """ the select operation """
     where_clause = stmt_tokens[-1] if str(stmt_tokens[-1][0]) == 'where' else None
-    where_string = where_clause.value.replace('and', ' ')
+    where_string = re.sub(r"\band\b", " ", where_clause.value)
     attributes_list = re.findall(r"[\w']+[.|\s][\w']+|[\d']+[-]+[\w']+|[\w']+[\d']+|[\d']+|[\w']+[\w']+", where_string[5:])
     attref_list = [radb.ast.AttrRef(rel=extract_rel_name(attribute)['rel'], name=extract_rel_name(attribute)['name'])
                    for attribute in attributes_list]
@@ -96,9 +145,30 @@ def project(attributes, stmt_tokens, table_names):
     return radb.ast.Project(attrs, inputs)
 
 
+def aggregate(aggrs, group_by, stmt_tokens, table_names):
+    """ grouping and aggregation operation, count(*) counts the constant 1 """
+    groupbys = [radb.ast.AttrRef(rel=extract_rel_name(attribute)['rel'], name=extract_rel_name(attribute)['name'])
+                for attribute in group_by]
+    funcs = [radb.ast.FuncValExpr(func.lower(), [radb.ast.RANumber('1') if arg == '*' else radb.ast.AttrRef(
+        rel=extract_rel_name(arg)['rel'], name=extract_rel_name(arg)['name'])]) for func, arg in aggrs]
+    if str(stmt_tokens[-1][0]) != 'where':
+        inputs = cross(table_names)
+    else:
+        inputs = select(stmt_tokens, table_names)
+
+    return radb.ast.Aggr(groupbys, funcs, inputs)
+
+
 def translate(stmt):
-    sql = clean_query(stmt.value)
+    sql, order_by, limit = split_order_by_limit(clean_query(stmt.value))
+    sql, group_by = split_group_by(sql)
     stmt_tokens = sqlparse.parse(sql)[0].tokens
+    aggrs = aggregates(stmt_tokens)
+    if len(aggrs) != 0 or len(group_by) != 0:
+        # one tuple per group, distinct or not
+        return aggregate(aggrs, group_by, stmt_tokens, table_list_names(stmt_tokens))
+    if not is_distinct(stmt_tokens):
+        raise Exception("sql2ra: only select distinct queries are supported (relations are sets): " + stmt.value)
     patters = {'operation': stmt_tokens[0].value, "distinct": stmt_tokens[2], 'columns': columns(stmt_tokens),
                'from': table_list_names(stmt_tokens),
                'condition': stmt_tokens[-1] if str(stmt_tokens[-1][0]) == 'where' else None}
@@ -1,9 +1,26 @@
+import asyncio
 import json
+import os
+import tempfile
 import unittest
+from unittest import mock
 
 import luigi
+import luigi.contrib.hadoop
+import radb.ast
+import radb.parse
 import sqlparse
 
+import catalog
+import codec
+import costcounter
+import explain
+import latemat
+import lifecycle
+import localscan
+import miniHive
+import plancache
+import queryserver
 import ra2mr
 import raopt
 import sql2ra
@@ -14,6 +31,14 @@ May be called like any Python unittest, or using pytest, e.g. "pytest test_e2e.p
 '''
 
 
+class FixedCatalog(object):
+    """statistics given by the test instead of collected from the data"""
+
+    def __init__(self, rows, distinct):
+        self.rows = rows.get
+        self.distinct = lambda relation, attribute: distinct.get(relation + "." + attribute)
+
+
 class End2EndUnitTests(unittest.TestCase):
 
     def setUp(self):
@@ -64,6 +89,13 @@ class End2EndUnitTests(unittest.TestCase):
         computed = self._evaluate(sqlstring)
         self.assertEqual(len(computed), 9)
 
+    def test_not_distinct(self):
+        # bags are not supported: the query is rejected rather than evaluated as a select distinct
+        with self.assertRaisesRegex(Exception, "select distinct"):
+            self._evaluate("select gender from Person")
+        self.assertEqual(str(sql2ra.translate(sqlparse.parse("select count(*) from Person")[0])),
+                         str(sql2ra.translate(sqlparse.parse("select distinct count(*) from Person")[0])))
+
     def test_project_name_age(self):
         sqlstring = "select distinct name, age from Person"
         computed = self._evaluate(sqlstring)
@@ -128,6 +160,477 @@ class End2EndUnitTests(unittest.TestCase):
         computed = self._evaluate(sqlstring)
         self.assertEqual(len(computed), 1)
 
+    def test_alias_containing_and(self):
+        sqlstring = "select distinct Sandra.name from Person Sandra where Sandra.gender = 'female'"
+        computed = self._evaluate(sqlstring)
+        self.assertEqual(len(computed), 3)
+
+    def test_10way_join_plan(self):
+        dd = {"Person": {"name": "string", "age": "integer", "gender": "string"}}
+        aliases = ["P" + str(i) for i in range(10)]
+        sqlstring = "select distinct P0.name from " + ", ".join("Person " + a for a in aliases) + \
+                    " where " + " and ".join(a + ".name = " + b + ".name" for a, b in zip(aliases, aliases[1:])) + \
+                    " and P9.age = 16"
+        ra = miniHive.plan(sqlstring, dd)
+        self.assertEqual(str(ra).count("\\join"), 9)
+        self.assertEqual(str(ra).count("\\cross"), 0)
+        self.assertIn("\\select_{P9.age = 16} (\\rename_{P9: *} Person)", str(ra))
+
+    def test_catalog(self):
+        stats = catalog.Catalog(ra2mr.ExecEnv.MOCK)
+        self.assertEqual(stats.rows("Person"), 9)
+        self.assertEqual(stats.distinct("Person", "gender"), 2)
+        self.assertEqual(stats.distinct("Eats", "pizza"), 5)
+
+    def test_catalog_shared(self):
+        catalog.catalogs.clear()
+        sqlstring = "select distinct * from Person, Eats, Serves " \
+                    "where Person.name = Eats.name and Eats.pizza = Serves.pizza"
+        dd = {"Person": {"name": "string", "age": "integer", "gender": "string"},
+              "Eats": {"name": "string", "pizza": "string"},
+              "Serves": {"pizzeria": "string", "pizza": "string", "price": "integer"}}
+        with mock.patch("catalog.analyze", wraps=catalog.analyze) as analyze, \
+                mock.patch("ra2mr.target_size", wraps=ra2mr.target_size) as target_size:
+            for i in range(2):
+                miniHive.plan(sqlstring, dd, catalog.shared(ra2mr.ExecEnv.MOCK))
+            # the relations of the query are analyzed once, and their sizes checked once per query
+            self.assertEqual(sorted(c.args[0].path for c in analyze.call_args_list),
+                             ["Eats.json", "Person.json", "Serves.json"])
+            self.assertEqual(target_size.call_count, 2 * 3)
+        catalog.catalogs.clear()
+
+    def test_reorder_joins_bushy(self):
+        dd = {"R1": {"a": "int"}, "R2": {"a": "int", "b": "int"}, "R3": {"b": "int", "c": "int"}, "R4": {"c": "int"}}
+        stats = FixedCatalog({"R1": 1000, "R2": 1000, "R3": 1000, "R4": 1000},
+                             {"R1.a": 1000, "R2.a": 1000, "R2.b": 1, "R3.b": 1, "R3.c": 1000, "R4.c": 1000})
+        ra = radb.parse.one_statement_from_string(
+            "((R1 \\join_{R1.a = R2.a} R2) \\join_{R2.b = R3.b} R3) \\join_{R3.c = R4.c} R4;")
+        bushy = "(R1 \\join_{R1.a = R2.a} R2) \\join_{R2.b = R3.b} (R3 \\join_{R3.c = R4.c} R4)"
+        self.assertEqual(str(raopt.rule_reorder_joins(ra, dd, stats)), bushy)
+        self.assertEqual(str(raopt.rule_reorder_joins(ra, dd, stats, dp_limit=2)), bushy)
+        left_deep = raopt.rule_reorder_joins(ra, dd, stats, bushy=False)
+        self.assertTrue(all(isinstance(e, radb.ast.RelRef) for e in
+                            [left_deep.inputs[1], left_deep.inputs[0].inputs[1], left_deep.inputs[0].inputs[0].inputs[1]]))
+
+    def test_connected_pairs(self):
+        # the csg-cmp pairs of a chain and of a star of 4 inputs, each once
+        chain = raopt.connected_pairs(4, [0b0011, 0b0110, 0b1100])
+        self.assertEqual(len(chain), len(set(chain)))
+        self.assertEqual(len(chain), (4 ** 3 - 4) // 6)
+        self.assertIn((0b0011, 0b1100), chain)
+        self.assertNotIn((0b0101, 0b0010), chain)
+        star = raopt.connected_pairs(4, [0b0011, 0b0101, 0b1001])
+        self.assertEqual(len(set(star)), 3 * 2 ** 2)
+        self.assertTrue(all(s1 & -s1 < s2 & -s2 and not s1 & s2 for s1, s2 in star))
+
+    def test_reorder_joins_4way(self):
+        dd = {}
+        dd["Person"] = {"name": "string", "age": "integer", "gender": "string"}
+        dd["Eats"] = {"name": "string", "pizza": "string"}
+        dd["Serves"] = {"pizzeria": "string", "pizza": "string", "price": "integer"}
+        dd["Frequents"] = {"name": "string", "pizzeria": "string"}
+        sqlstring = "select distinct P.name from Person P, Eats E, Serves S, Frequents F " \
+                    "where P.name = E.name and E.pizza = S.pizza and F.pizzeria = S.pizzeria and F.name = P.name " \
+                    "and S.price = 9"
+        for optimize in (False, True):
+            task = miniHive.query_task(sqlstring, dd, ra2mr.ExecEnv.MOCK, optimize,
+                                       stats=catalog.Catalog(ra2mr.ExecEnv.MOCK))
+            luigi.build([task], local_scheduler=True)
+            rows = [json.loads(line.split('\t')[1]) for line in ra2mr.read_lines(task.output())]
+            self.assertEqual(sorted(e["P.name"] for e in rows), ["Ben", "Gus", "Hil"])
+            test_ra2mr.prepareMockFileSystem()
+
+    def test_parallel_workers(self):
+        dd = {}
+        dd["Person"] = {"name": "string", "age": "integer", "gender": "string"}
+        dd["Eats"] = {"name": "string", "pizza": "string"}
+        dd["Serves"] = {"pizzeria": "string", "pizza": "string", "price": "integer"}
+        sqlstring = "select distinct Person.name from Person, Eats, Serves " \
+                    "where Person.name = Eats.name and Eats.pizza = Serves.pizza and Serves.price = 9"
+        for memory in (None, 1):
+            task = miniHive.query_task(sqlstring, dd, ra2mr.ExecEnv.MOCK, False)
+            self.assertTrue(miniHive.build([task], workers=3, memory=memory))
+            rows = [json.loads(line.split('\t')[1]) for line in ra2mr.read_lines(task.output())]
+            self.assertEqual(sorted(e["Person.name"] for e in rows), ["Ben", "Dan", "Eli", "Gus", "Hil"])
+            with miniHive.Settings({('resources', 'memory'): str(memory or 1024)}):
+                self.assertEqual(task.resources, {"memory": 1})
+            test_ra2mr.prepareMockFileSystem()
+
+        # parallelism is opt-in: by default, the tasks run in the process of the build
+        task = miniHive.query_task(sqlstring, dd, ra2mr.ExecEnv.MOCK, False)
+        with mock.patch('luigi.build', wraps=luigi.build) as luigi_build:
+            self.assertTrue(miniHive.build([task]))
+        self.assertEqual(luigi_build.call_args[1]["workers"], 1)
+
+    def test_intermediates_collected(self):
+        dd = {}
+        dd["Person"] = {"name": "string", "age": "integer", "gender": "string"}
+        dd["Eats"] = {"name": "string", "pizza": "string"}
+        dd["Serves"] = {"pizzeria": "string", "pizza": "string", "price": "integer"}
+        sqlstring = "select distinct Person.name from Person, Eats, Serves " \
+                    "where Person.name = Eats.name and Eats.pizza = Serves.pizza and Serves.price = 9"
+        fs = luigi.mock.MockFileSystem()
+        written = {}
+        for retain in (False, True):
+            task = miniHive.query_task(sqlstring, dd, ra2mr.ExecEnv.MOCK, False)
+            self.assertTrue(miniHive.build([task], workers=1, retain=retain, count=True))
+            written[retain] = lifecycle.written
+            rows = [json.loads(line.split('\t')[1]) for line in ra2mr.read_lines(task.output())]
+            self.assertEqual(sorted(e["Person.name"] for e in rows), ["Ben", "Dan", "Eli", "Gus", "Hil"])
+            tmpfiles = [path for path in fs.listdir('') if path.endswith('.tmp')]
+            if retain:
+                self.assertGreater(len(tmpfiles), 1)
+                # the costs counted as the intermediates are written are those of the files retained
+                costs = sum(costcounter.line_costs(line) for path in tmpfiles
+                            for line in ra2mr.read_lines(luigi.mock.MockTarget(path)))
+                self.assertEqual(written[retain][0], costs)
+            else:
+                self.assertEqual(tmpfiles, [task.output().path])
+            test_ra2mr.prepareMockFileSystem()
+        self.assertGreater(written[False][0], 0)
+        self.assertEqual(written[False], written[True])
+
+    def test_checkpoint_resume(self):
+        dd = {}
+        dd["Person"] = {"name": "string", "age": "integer", "gender": "string"}
+        dd["Eats"] = {"name": "string", "pizza": "string"}
+        sqlstring = "select distinct * from Person, Eats where Person.name = Eats.name"
+        expected = sorted(self._evaluate(sqlstring))
+        test_ra2mr.prepareMockFileSystem()
+        fs = luigi.mock.MockFileSystem()
+        config = luigi.configuration.get_config()
+        config.set('minihive', 'checkpoint_partition_mb', str(256 / 2.0 ** 20))
+        run_reducer = luigi.contrib.hadoop.JobTask.run_reducer
+        reduced = []
+
+        def reducer(crash_at=None):
+            def run(job, stdin, stdout):
+                reduced.append(job.task_id)
+                if len(reduced) == crash_at:
+                    raise Exception("crash")
+                run_reducer(job, stdin, stdout)
+            del reduced[:]
+            return mock.patch.object(luigi.contrib.hadoop.JobTask, 'run_reducer', run)
+
+        try:
+            task = miniHive.query_task(sqlstring, dd, ra2mr.ExecEnv.MOCK, False)
+            with reducer():
+                self.assertTrue(miniHive.build([task], workers=1, retain=True, checkpoint=True))
+            partitions = len(reduced)
+            self.assertGreater(partitions, 2)
+            self.assertEqual(sorted(ra2mr.read_lines(task.output())), expected)
+            self.assertEqual([path for path in fs.listdir('') if '.tmp.' in path], [task.output().path + ".manifest"])
+
+            # a crash leaves the partitions committed so far, which are not reduced again
+            test_ra2mr.prepareMockFileSystem()
+            with reducer(crash_at=2):
+                self.assertFalse(miniHive.build([task], workers=1, retain=True, checkpoint=True))
+            committed = ra2mr.checkpoint.load(luigi.mock.MockTarget(task.output().path + ".partitions"))
+            self.assertGreater(len(committed["map"]), 1)
+            self.assertEqual(committed["reduce"], [0])
+            with reducer():
+                self.assertTrue(miniHive.build([task], workers=1, retain=True, checkpoint=True))
+            self.assertEqual(len(reduced), partitions - 1)
+            self.assertEqual(sorted(ra2mr.read_lines(task.output())), expected)
+
+            # a committed task is not run again, unless its output has changed since
+            with reducer():
+                self.assertTrue(miniHive.build([task], workers=1, retain=True, checkpoint=True))
+            self.assertEqual(len(reduced), 0)
+            with task.output().open('w') as f:
+                f.write("Person\t{}\n")
+            with miniHive.Settings({('minihive', 'checkpoint'): 'True'}):
+                self.assertFalse(task.complete())
+            with reducer():
+                self.assertTrue(miniHive.build([task], workers=1, retain=True, checkpoint=True))
+            self.assertEqual(len(reduced), partitions)
+            self.assertFalse(ra2mr.checkpoint.enabled())
+        finally:
+            config.remove_option('minihive', 'checkpoint_partition_mb')
+
+    def test_explain_analyze(self):
+        dd = {}
+        dd["Person"] = {"name": "string", "age": "integer", "gender": "string"}
+        dd["Eats"] = {"name": "string", "pizza": "string"}
+        stats = FixedCatalog({"Person": 9, "Eats": 20}, {"Person.name": 9, "Eats.name": 9})
+        sqlstring = "select distinct Person.name, Eats.pizza from Person, Eats where Person.name = Eats.name"
+        task = miniHive.query_task(sqlstring, dd, ra2mr.ExecEnv.MOCK, False)
+        optimizer = raopt.Optimizer(dd, stats)
+
+        lines = explain.explain(task, optimizer)
+        self.assertEqual(lines[1], "ProjectTask  \\project_{Person.name, Eats.pizza}  step 1 -> tmp1.tmp  est 20 rows")
+        self.assertIn("InputData  Eats.json  est 20 rows", [line.strip() for line in lines])
+        self.assertFalse(task.complete())
+
+        with explain.Profile() as profile:
+            self.assertTrue(miniHive.build([task], workers=1, retain=True))
+        lines = explain.explain(task, optimizer, profile)
+        self.assertTrue(lines[1].startswith("ProjectTask  \\project_{Person.name, Eats.pizza}  step 1 -> tmp1.tmp  "
+                                            "est 20 rows  actual 20 rows, "))
+        self.assertTrue(lines[1].endswith("error 1.0x over"))
+        self.assertEqual(len(lines), len(explain.explain(task, optimizer)))
+
+    def test_approximate_counts(self):
+        dd = {}
+        dd["Person"] = {"name": "string", "age": "integer", "gender": "string"}
+        dd["Eats"] = {"name": "string", "pizza": "string"}
+        sqlstring = "select count(*) from Person, Eats where Person.name = Eats.name"
+        specs, tuples, estimates = miniHive.approximate(sqlstring, dd, ra2mr.ExecEnv.MOCK, 1.0)
+        self.assertEqual(specs["Person"]["method"], "hash")
+        self.assertEqual(specs["Eats"]["key"], ["name"])
+        self.assertEqual(estimates, [({"count(1)": 20.0}, {"count(1)": [20.0, 20.0]})])
+        self.assertEqual(ra2mr.sampling.configured(), {})
+
+        # the samples are evaluated apart from the (exact) plan of the first query, which did not sample
+        specs, tuples, estimates = miniHive.approximate(sqlstring, dd, ra2mr.ExecEnv.MOCK, 0.5, seed=1, retain=True)
+        self.assertTrue(ra2mr.SampleTask(relation="Person", exec_environment=ra2mr.ExecEnv.MOCK,
+                                         **specs["Person"]).output().exists())
+        self.assertLess(len(tuples), 20)
+        (estimate, intervals), = estimates
+        self.assertEqual(estimate["count(1)"], 2 * len(tuples))
+        self.assertEqual(len(set(e["Person.name"] for e in tuples)), len(set(e["Eats.name"] for e in tuples)))
+        self.assertLessEqual(intervals["count(1)"][0], 20)
+        self.assertGreaterEqual(intervals["count(1)"][1], 20)
+
+        test_ra2mr.prepareMockFileSystem()
+        specs, tuples, estimates = miniHive.approximate("select gender, count(*) from Person group by gender", dd,
+                                                        ra2mr.ExecEnv.MOCK, 0.5, seed=1, retain=True)
+        self.assertEqual(specs, {"Person": {"method": "bernoulli", "fraction": 0.5, "key": [], "seed": 1}})
+        self.assertTrue(ra2mr.SampleTask(relation="Person", exec_environment=ra2mr.ExecEnv.MOCK,
+                                         **specs["Person"]).output().exists())
+        self.assertLess(len(tuples), 9)
+        self.assertEqual(sum(e["count(1)"] for e, intervals in estimates), 2 * len(tuples))
+
+    def test_late_materialization(self):
+        def widen():
+            # long attributes the joins do not need, which are worth fetching late
+            test_ra2mr.prepareMockFileSystem()
+            for relation, attribute in [("Person", "bio"), ("Eats", "note")]:
+                lines = luigi.mock.MockFileSystem().get_data(relation + ".json").decode('utf-8').splitlines()
+                with luigi.mock.MockTarget(relation + ".json").open('w') as f:
+                    for line in lines:
+                        json_tuple = json.loads(line.split('\t')[1])
+                        json_tuple[relation + "." + attribute] = attribute * 50
+                        f.write(relation + "\t" + json.dumps(json_tuple) + "\n")
+
+        def intermediate_bytes():
+            fs = luigi.mock.MockFileSystem()
+            return sum(len(fs.get_data(path)) for path in fs.listdir('') if path.endswith('.tmp'))
+
+        dd = {}
+        dd["Person"] = {"name": "string", "age": "integer", "gender": "string", "bio": "string"}
+        dd["Eats"] = {"name": "string", "pizza": "string", "note": "string"}
+        dd["Frequents"] = {"name": "string", "pizzeria": "string"}
+        sqlstring = "select distinct * from Person, Eats, Frequents where Person.name = Eats.name and " \
+                    "Eats.name = Frequents.name and Person.gender = 'female'"
+        widen()
+        task = miniHive.query_task(sqlstring, dd, ra2mr.ExecEnv.MOCK, False)
+        self.assertTrue(miniHive.build([task], workers=1, retain=True))
+        expected = [json.loads(line.split('\t')[1]) for line in ra2mr.read_lines(task.output())]
+        wide = intermediate_bytes()
+        widen()
+
+        task = miniHive.query_task(sqlstring, dd, ra2mr.ExecEnv.MOCK, False, late=True)
+        try:
+            self.assertEqual(latemat.configured()["relations"],
+                             {"Person": ["gender", "name"], "Eats": ["name"], "Frequents": ["name"]})
+            self.assertIsInstance(task, ra2mr.FetchTask)
+            self.assertTrue(miniHive.build([task], workers=1, retain=True))
+        finally:
+            latemat.configure(None)
+        computed = [json.loads(line.split('\t')[1]) for line in ra2mr.read_lines(task.output())]
+        self.assertEqual(sorted(json.dumps(t, sort_keys=True) for t in computed),
+                         sorted(json.dumps(t, sort_keys=True) for t in expected))
+        self.assertTrue(all("Person.bio" in e and "Person.__locator" not in e for e in computed))
+        # the mappers read the relations narrow, there is no narrow copy of them
+        self.assertLess(intermediate_bytes(), wide)
+        fs = luigi.mock.MockFileSystem()
+        relations = [path for path in fs.listdir('') if path.split(".")[0] in dd]
+        self.assertEqual(sorted(relations), ["Eats.json", "Frequents.json", "Person.json"])
+
+        # on the short relations, the narrow intermediates and the fetched tuples would be larger
+        test_ra2mr.prepareMockFileSystem()
+        del dd["Person"]["bio"], dd["Eats"]["note"]
+        task = miniHive.query_task(sqlstring, dd, ra2mr.ExecEnv.MOCK, False, late=True)
+        self.assertEqual(latemat.configured(), {})
+        self.assertNotIsInstance(task, ra2mr.FetchTask)
+
+    def test_mmap_scan_splits(self):
+        with open("PARTSUPP.json") as f:
+            expected = [(line.split('\t')[0], json.loads(line.split('\t')[1])) for line in f]
+        self.assertEqual(list(localscan.tuples("PARTSUPP.json")), expected)
+        for n in (2, 7, 64):
+            scanned = []
+            for start, end in localscan.splits("PARTSUPP.json", n):
+                scanned += localscan.tuples("PARTSUPP.json", start, end)
+            self.assertEqual(scanned, expected)
+
+    def test_codec_backends(self):
+        sqlstring = "select distinct Person.name, Eats.pizza from Person, Eats " \
+                    "where Person.name = Eats.name and Person.gender = 'female'"
+        try:
+            for backend in codec.BACKENDS:
+                codec.use(backend)
+                t1 = codec.loads('{"Person.name": "Amy", "Person.age": 16}')
+                t2 = codec.loads(memoryview(b'{"Person.name": "Bea", "Person.age": 15}'))
+                self.assertTrue(all(k1 is k2 for k1, k2 in zip(t1, t2)))
+                self.assertEqual(codec.loads(codec.dumps(t1)), t1)
+                self.assertEqual(len(self._evaluate(sqlstring)), 5)
+                test_ra2mr.prepareMockFileSystem()
+        finally:
+            codec.use()
+
+    def test_bucket_join(self):
+        stats = catalog.Catalog(ra2mr.ExecEnv.MOCK)
+        stats.bucket("Person", "name", 3)
+        stats.bucket("Eats", "name", 3)
+        self.assertEqual(stats.buckets("Eats"), {"attribute": "name", "count": 3})
+        self.assertIsNone(stats.buckets("Serves"))
+
+        raquery = radb.parse.one_statement_from_string(
+            "(\\select_{Person.gender = 'female'} Person) \\join_{Person.name = Eats.name} Eats;")
+        for optimize in (False, True):
+            task = ra2mr.task_factory(raquery, env=ra2mr.ExecEnv.MOCK, optimize=optimize)
+            self.assertIsInstance(task, ra2mr.BucketJoinTask)
+            self.assertTrue(luigi.build([task], local_scheduler=True))
+            rows = [json.loads(line.split('\t')[1]) for line in ra2mr.read_lines(task.output())]
+            self.assertEqual(sorted((e["Person.name"], e["Eats.pizza"]) for e in rows),
+                             [("Amy", "mushroom"), ("Amy", "pepperoni"), ("Fay", "mushroom"),
+                              ("Hil", "cheese"), ("Hil", "supreme")])
+            task.output().remove()
+        self.assertEqual(task.requires()[0].reducer, NotImplemented)
+
+        # the layout is planned once: the buckets are built again if their manifest is gone by then
+        task = ra2mr.task_factory(raquery, env=ra2mr.ExecEnv.MOCK)
+        luigi.mock.MockFileSystem().remove("Eats.buckets")
+        self.assertTrue(luigi.build([task], local_scheduler=True))
+        self.assertEqual(stats.buckets("Eats"), {"attribute": "name", "count": 3})
+
+    def test_person_cross_serves(self):
+        sqlstring = "select distinct Person.name, Serves.pizzeria from Person, Serves where Person.age = 16"
+        computed = self._evaluate(sqlstring)
+        self.assertEqual(len(computed), 6)
+
+    def test_count_persons_per_gender(self):
+        sqlstring = "select Person.gender, count(*) from Person group by Person.gender"
+        computed = self._evaluate(sqlstring)
+        counts = {}
+        for line in computed:
+            json_tuple = json.loads(line.split('\t')[1])
+            counts[json_tuple["Person.gender"]] = json_tuple["count(1)"]
+        self.assertEqual(counts, {"female": 3, "male": 6})
+
+    def test_count_eaters_per_pizza(self):
+        sqlstring = "select distinct Eats.pizza, count(Person.name) from Person, Eats " \
+                    "where Person.name = Eats.name group by Eats.pizza"
+        computed = self._evaluate(sqlstring)
+        self.assertEqual(len(computed), 5)
+
+    def test_youngest_pizza_eaters(self):
+        dd = {}
+        dd["Person"] = {"name": "string", "age": "integer", "gender": "string"}
+        dd["Eats"] = {"name": "string", "pizza": "string"}
+        sqlstring = "select distinct Person.name, Person.age from Person, Eats where Person.name = Eats.name " \
+                    "order by Person.age limit 2"
+        task = miniHive.query_task(sqlstring, dd, ra2mr.ExecEnv.MOCK, False)
+        luigi.build([task], local_scheduler=True)
+
+        f = task.output().open('r')
+        names = [json.loads(line.split('\t')[1])["Person.name"] for line in f]
+        self.assertEqual(names, ["Dan", "Amy"])
+
+    def test_first_rows_mushroom_lovers(self):
+        dd = {}
+        dd["Person"] = {"name": "string", "age": "integer", "gender": "string"}
+        dd["Eats"] = {"name": "string", "pizza": "string"}
+        sqlstring = "select distinct Person.name from Person, Eats " \
+                    "where Person.name = Eats.name and Eats.pizza = 'mushroom'"
+        rows = [json_tuple for relation, json_tuple in miniHive.first_rows(sqlstring, dd, ra2mr.ExecEnv.MOCK)]
+        self.assertEqual(len(rows), 4)
+        rows = list(miniHive.first_rows(sqlstring + " limit 1", dd, ra2mr.ExecEnv.MOCK))
+        self.assertEqual(len(rows), 1)
+
+    def test_plan_cache(self):
+        dd = {}
+        dd["Person"] = {"name": "string", "age": "integer", "gender": "string"}
+        dd["Eats"] = {"name": "string", "pizza": "string"}
+        cache = plancache.PlanCache(dd, capacity=1)
+        for sqlstring in ["select distinct Person.name from Person, Eats where Person.name = Eats.name "
+                          "and Eats.pizza = 'mushroom' and Person.age = 16 order by Person.name limit 3",
+                          "select distinct Person.name from Person, Eats where Person.name = Eats.name "
+                          "and Eats.pizza = 'pepperoni' and Person.age = 21 order by Person.name limit 5"]:
+            ra, order_by, limit = cache.plan(sqlstring)
+            self.assertEqual(str(ra), str(miniHive.plan(sqlstring, dd)))
+            self.assertEqual((order_by, limit), sql2ra.order_by_limit(sqlparse.parse(sqlstring)[0]))
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+        cache.plan("select distinct * from Person where gender = 'female'")
+        cache.plan("select distinct Person.name from Person, Eats where Person.name = Eats.name "
+                   "and Eats.pizza = 'cheese' and Person.age = 13 order by Person.name limit 1")
+        self.assertEqual((cache.hits, cache.misses), (1, 3))
+
+    def test_query_service_shares_scans(self):
+        dd = {}
+        dd["Person"] = {"name": "string", "age": "integer", "gender": "string"}
+        dd["Eats"] = {"name": "string", "pizza": "string"}
+        service = queryserver.QueryService(dd, env=ra2mr.ExecEnv.MOCK)
+
+        async def submit_all():
+            return await asyncio.gather(
+                service.submit("select distinct * from Person where gender='female'"),
+                service.submit("select distinct * from Person where age=21"),
+                service.submit("select distinct Person.name from Person, Eats "
+                               "where Person.name = Eats.name and Eats.pizza = 'mushroom'"))
+
+        females, aged_21, mushroom_lovers = asyncio.run(submit_all())
+        self.assertEqual(len(females), 3)
+        self.assertEqual(len(aged_21), 2)
+        self.assertEqual(len(mushroom_lovers), 4)
+        self.assertEqual(service.shared_scan_count, 1)
+        self.assertEqual(sorted(luigi.mock.MockFileSystem().get_all_data().keys()),
+                         ['Eats.json', 'Frequents.json', 'Person.json', 'Serves.json'])
+
+    def test_query_service_failure_is_per_query(self):
+        dd = {}
+        dd["Person"] = {"name": "string", "age": "integer", "gender": "string"}
+        dd["Missing"] = {"name": "string"}
+        service = queryserver.QueryService(dd, env=ra2mr.ExecEnv.MOCK)
+
+        async def submit_all():
+            return await asyncio.gather(
+                service.answer("select distinct * from Person where gender='female'"),
+                service.answer("select distinct * from Missing where name='Amy'"))
+
+        females, missing = [json.loads(answer) for answer in asyncio.run(submit_all())]
+        self.assertEqual(len(females["rows"]), 3)
+        self.assertEqual(missing["error"], "query evaluation failed")
+
+
+    def test_query_service_answers_each_query_on_the_socket(self):
+        dd = {}
+        dd["Person"] = {"name": "string", "age": "integer", "gender": "string"}
+        service = queryserver.QueryService(dd, env=ra2mr.ExecEnv.MOCK)
+
+        async def converse(path):
+            server = await asyncio.start_unix_server(lambda r, w: queryserver.serve_connection(service, r, w),
+                                                     path=path)
+            async with server:
+                reader, writer = await asyncio.open_unix_connection(path)
+                answers = []
+                # the connection stays open: each query is sent once the previous one is answered
+                for query in ["select distinct * from Person where gender='female'",
+                              "select distinct * from Person where age=21"]:
+                    writer.write((query + "\n").encode('utf-8'))
+                    await writer.drain()
+                    answers.append(json.loads(await asyncio.wait_for(reader.readline(), 60)))
+                writer.close()
+                return answers
+
+        with tempfile.TemporaryDirectory() as tmp:
+            females, aged_21 = asyncio.run(converse(os.path.join(tmp, "minihive.sock")))
+        self.assertEqual(len(females["rows"]), 3)
+        self.assertEqual(len(aged_21["rows"]), 2)
+
 
 if __name__ == '__main__':
     unittest.main()
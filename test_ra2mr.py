@@ -1,8 +1,15 @@
+import gzip
 import json
+import os
+import tarfile
+import tempfile
+import types
 
 import luigi
+import luigi.contrib.hadoop
 import radb
 
+import compression
 import ra2mr
 
 '''
@@ -137,18 +144,33 @@ class TestMREvaluation(object):
                     break
             assert (item_found)
 
+    def test_jobs_ship_the_local_modules(self):
+        # hadoop streaming ships luigi, the module of the job and its extra_modules only
+        task = ra2mr.SelectTask(querystring="\\select_{gender='female'} Person;")
+        here = os.path.dirname(os.path.abspath(ra2mr.__file__))
+        imported = set(name for name, m in vars(ra2mr).items() if isinstance(m, types.ModuleType) and
+                       os.path.dirname(os.path.abspath(getattr(m, '__file__', '/') or '/')) == here)
+        shipped = set(m.__name__ for m in task.extra_modules())
+        assert 'codec' in shipped and 'bloom' in shipped
+        assert imported <= shipped
+
+        with tempfile.TemporaryDirectory() as tmp:
+            luigi.contrib.hadoop.create_packages_archive(task.extra_modules(), os.path.join(tmp, 'packages.tar'))
+            archived = tarfile.open(os.path.join(tmp, 'packages.tar')).getnames()
+        assert set(name + ".py" for name in imported) <= set(archived)
+
     def test_select_person_gender_female_person(self):
-        querystring = "\select_{Person.gender='female'}(Person);"
+        querystring = r"\select_{Person.gender='female'}(Person);"
         expected = [self.person_amy, self.person_fay, self.person_hil]
         self._check(querystring, expected)
 
     def test_select_gender_female_person(self):
-        querystring = "\select_{gender='female'}(Person);"
+        querystring = r"\select_{gender='female'}(Person);"
         expected = [self.person_amy, self.person_fay, self.person_hil]
         self._check(querystring, expected)
 
     def test_select_female_gender_person(self):
-        querystring = "\select_{'female'=gender}(Person);"
+        querystring = r"\select_{'female'=gender}(Person);"
         expected = [self.person_amy, self.person_fay, self.person_hil]
         self._check(querystring, expected)
 
@@ -166,36 +188,36 @@ class TestMREvaluation(object):
                 assert k.startswith('P.')
 
     def test_select_p_gender_female_p(self):
-        querystring = "\select_{P.gender='female'} \\rename_{P:*} (Person);"
+        querystring = r"\select_{P.gender='female'} \rename_{P:*} (Person);"
         computed = self._evaluate(querystring)
         assert len(computed) == 3
 
     def test_select_age_21_Person(self):
-        querystring = "\select_{age=21}(Person);"
+        querystring = r"\select_{age=21}(Person);"
         result = [self.person_fay, self.person_ben]
         self._check(querystring, result)
 
     def test_select_price_9_Serves(self):
-        querystring = "\select_{price=9}(Serves);"
+        querystring = r"\select_{price=9}(Serves);"
         computed = self._evaluate(querystring)
         assert len(computed) == 1
 
     def test_select_person_female_age_16(self):
-        querystring = "\select_{gender='female' and age=16}(Person);"
+        querystring = r"\select_{gender='female' and age=16}(Person);"
         result = [self.person_amy]
         self._check(querystring, result)
 
     def test_select_person_age_3(self):
-        querystring = "\select_{age=3}(Person);"
+        querystring = r"\select_{age=3}(Person);"
         self._check(querystring, [])
 
     def test_select_pizza_mushroom(self):
-        querystring = "\project_{pizza} \select_{pizza='mushroom'} Eats;"
+        querystring = r"\project_{pizza} \select_{pizza='mushroom'} Eats;"
         computed = self._evaluate(querystring)
         assert len(computed) == 1
 
     def test_person_join_eats_mushroom(self):
-        querystring = "Person \join_{Person.name = Eats.name} (\select_{pizza='mushroom'} Eats);"
+        querystring = r"Person \join_{Person.name = Eats.name} (\select_{pizza='mushroom'} Eats);"
         computed = self._evaluate(querystring)
         assert len(computed) == 4
 
@@ -204,17 +226,17 @@ class TestMREvaluation(object):
         assert len(json_tuple.keys()) == 5
 
     def test_project_Person_gender(self):
-        querystring = "\project_{gender} Person;"
+        querystring = r"\project_{gender} Person;"
         result = ['{"Person.gender": "female"}', '{"Person.gender": "male"}']
         self._check(querystring, result)
 
     def test_project_person_join_eats(self):
-        querystring = "\project_{Person.name, Eats.pizza} (Person \join_{Person.name = Eats.name} Eats);"
+        querystring = r"\project_{Person.name, Eats.pizza} (Person \join_{Person.name = Eats.name} Eats);"
         computed = self._evaluate(querystring)
         assert len(computed) == 20
 
     def test_female_person_join_eats(self):
-        querystring = "(\select_{gender='female'} Person) \join_{Person.name = Eats.name} Eats;"
+        querystring = r"(\select_{gender='female'} Person) \join_{Person.name = Eats.name} Eats;"
         computed = self._evaluate(querystring)
         assert len(computed) == 5
 
@@ -227,43 +249,376 @@ class TestMREvaluation(object):
             assert json_tuple["Person.gender"] == "female"
 
     def test_empty_join(self):
-        querystring = "Person \join_{Person.name = Serves.pizzeria} Serves;"
+        querystring = r"Person \join_{Person.name = Serves.pizzeria} Serves;"
         computed = self._evaluate(querystring)
         assert computed == []
 
     def test_person_join_eats_then_join_frequents(self):
-        querystring = "(Person \join_{Person.name = Eats.name} Eats) \join_{Eats.name = Frequents.name} Frequents;"
+        querystring = r"(Person \join_{Person.name = Eats.name} Eats) \join_{Eats.name = Frequents.name} Frequents;"
         computed = self._evaluate(querystring)
         assert len(computed) == 42
 
     def test_eats_join_person_then_join_frequents(self):
-        querystring = "(Eats \join_{Person.name = Eats.name} Person) \join_{Eats.name = Frequents.name} Frequents;"
+        querystring = r"(Eats \join_{Person.name = Eats.name} Person) \join_{Eats.name = Frequents.name} Frequents;"
         computed = self._evaluate(querystring)
         assert len(computed) == 42
 
     def test_person_then_join_eats_join_frequents(self):
-        querystring = "Person \join_{Person.name = Eats.name} (Eats \join_{Eats.name = Frequents.name} Frequents);"
+        querystring = r"Person \join_{Person.name = Eats.name} (Eats \join_{Eats.name = Frequents.name} Frequents);"
         computed = self._evaluate(querystring)
         assert len(computed) == 42
 
     def test_person_join_eats_join_serves(self):
-        querystring = "Person \join_{Person.name = Eats.name} Eats " \
-                      "\join_{Eats.pizza = Serves.pizza} \select_{price=8}Serves;"
+        querystring = r"Person \join_{Person.name = Eats.name} Eats " \
+                      r"\join_{Eats.pizza = Serves.pizza} \select_{price=8}Serves;"
         computed = self._evaluate(querystring)
         assert len(computed) == 8
 
     def test_person_join_eats_join_serves_dominos(self):
-        querystring = "(Person \join_{Person.name = Eats.name} Eats) " \
-                      "\join_{Eats.pizza = Serves.pizza} (\select_{pizzeria='Dominos'} Serves);"
+        querystring = r"(Person \join_{Person.name = Eats.name} Eats) " \
+                      r"\join_{Eats.pizza = Serves.pizza} (\select_{pizzeria='Dominos'} Serves);"
         computed = self._evaluate(querystring)
         assert len(computed) == 9
 
     def test_person_join_rename(self):
-        querystring = "(\\rename_{A:*} Eats) \join_{A.pizza = B.pizza} (\\rename_{B:*} Eats);"
+        querystring = r"(\rename_{A:*} Eats) \join_{A.pizza = B.pizza} (\rename_{B:*} Eats);"
         computed = self._evaluate(querystring)
         assert len(computed) == 94
 
     def test_person_join_conjunction(self):
-        querystring = "(\\rename_{P:*} Person) \join_{P.gender = Q.gender and P.age = Q.age} (\\rename_{Q:*} Person);"
+        querystring = r"(\rename_{P:*} Person) \join_{P.gender = Q.gender and P.age = Q.age} (\rename_{Q:*} Person);"
         computed = self._evaluate(querystring)
         assert len(computed) == 9
+
+    def test_semi_join_drops_persons_without_mushroom(self):
+        querystring = r"Person \join_{Person.name = Eats.name} (\select_{pizza='mushroom'} Eats);"
+        task = ra2mr.task_factory(radb.parse.one_statement_from_string(querystring), env=ra2mr.ExecEnv.MOCK)
+        luigi.build([task], local_scheduler=True)
+
+        task.init_local()
+        task.init_mapper()
+        kept = []
+        for line in luigi.mock.MockTarget('Person.json').open('r'):
+            for relation, tuple in task.mapper(line.rstrip('\n')):
+                kept.append(json.loads(tuple)["Person.name"])
+        assert set(["Amy", "Dan", "Fay", "Gus"]) <= set(kept)
+        assert len(kept) < 9
+
+    def test_person_cross_frequents(self):
+        querystring = r"Person \cross Frequents;"
+        computed = self._evaluate(querystring)
+        assert len(computed) == 9 * 19
+
+        pairs = set()
+        for line in computed:
+            relation, tuple = line.split('\t')
+            json_tuple = json.loads(tuple)
+            pairs.add((json_tuple["Person.name"], json_tuple["Frequents.name"], json_tuple["Frequents.pizzeria"]))
+        assert len(pairs) == 9 * 19
+
+    def test_select_cross_size_guard(self):
+        querystring = r"(\select_{gender='female'} Person) \cross Eats;"
+        task = ra2mr.CrossTask(querystring=querystring, exec_environment=ra2mr.ExecEnv.MOCK, max_output_bytes=100)
+        assert not luigi.build([task], local_scheduler=True)
+
+        computed = self._evaluate(querystring)
+        assert len(computed) == 3 * 20
+
+    def test_person_band_join(self):
+        querystring = r"(\rename_{P:*} Person) \join_{P.age >= Q.age - 2 and P.age <= Q.age + 2} (\rename_{Q:*} Person);"
+        computed = self._evaluate(querystring)
+        assert len(computed) == 13
+
+        for line in computed:
+            relation, tuple = line.split('\t')
+            json_tuple = json.loads(tuple)
+            assert abs(json_tuple["P.age"] - json_tuple["Q.age"]) <= 2
+
+    def test_string_band_join(self):
+        querystring = r"(\rename_{P:*} Person) \join_{P.name >= E.name and P.name <= E.name} (\rename_{E:*} Eats);"
+        assert ra2mr.join_strategy(radb.parse.one_statement_from_string(querystring))[0] == 'band'
+        computed = self._evaluate(querystring)
+        assert len(computed) == 20
+
+        for line in computed:
+            relation, tuple = line.split('\t')
+            json_tuple = json.loads(tuple)
+            assert json_tuple["P.name"] == json_tuple["E.name"]
+
+    def test_person_inequality_join(self):
+        querystring = r"(\rename_{P:*} Person) \join_{P.age < Q.age} (\rename_{Q:*} Person);"
+        computed = self._evaluate(querystring)
+        assert len(computed) == 35
+
+    def test_person_theta_join(self):
+        querystring = r"(\rename_{P:*} Person) \join_{P.gender <> Q.gender} (\rename_{Q:*} Person);"
+        computed = self._evaluate(querystring)
+        assert len(computed) == 36
+
+    def test_join_with_residual_condition(self):
+        querystring = r"(\rename_{P:*} Person) \join_{P.gender = Q.gender and P.age < Q.age} (\rename_{Q:*} Person);"
+        computed = self._evaluate(querystring)
+        assert len(computed) == 18
+
+    def test_skewed_join_splits_heavy_hitters(self):
+        querystring = r"Person \join_{Person.name = Eats.name} Eats;"
+        task = ra2mr.task_factory(radb.parse.one_statement_from_string(querystring), env=ra2mr.ExecEnv.MOCK)
+        computed = self._evaluate(querystring)
+        assert len(computed) == 20
+        assert '["Dan"]' in task.heavy
+
+        large_side, splits = task.heavy['["Dan"]']
+        assert large_side == 1 and splits > 1
+        task.init_mapper()
+        keys = set()
+        for line in luigi.mock.MockTarget('Eats.json').open('r'):
+            for key, tuple in task.mapper(line.rstrip('\n')):
+                if json.loads(tuple)["Eats.name"] == "Dan":
+                    keys.add(key)
+        assert len(keys) > 1
+
+    def test_skew_sample_is_uniform(self):
+        with luigi.mock.MockTarget('Skewed.json').open('w') as f:
+            for i in range(1000):
+                f.write('Skewed\t' + json.dumps({"Skewed.a": i}) + '\n')
+        lines = ra2mr.reservoir_lines(luigi.mock.MockTarget('Skewed.json'), 100)
+        values = [json.loads(line.split('\t')[1])["Skewed.a"] for line in lines]
+        assert len(set(values)) == 100
+        # not the first lines of the input: its second half is sampled too
+        assert len([v for v in values if v >= 500]) > 25
+        assert len(ra2mr.reservoir_lines(luigi.mock.MockTarget('Skewed.json'), 2000)) == 1000
+
+        # larger inputs are read at random offsets only
+        lines = ra2mr.random_lines(luigi.mock.MockTarget('Skewed.json'), 100, 0)
+        values = [json.loads(line.split('\t')[1])["Skewed.a"] for line in lines]
+        assert 90 <= len(values) <= 100
+        assert len([v for v in values if v >= 500]) > 25
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'Skewed.json')
+            with open(path, 'wb') as f:
+                f.write(luigi.mock.MockFileSystem().get_data('Skewed.json'))
+            lines = ra2mr.random_lines(luigi.LocalTarget(path), 100, 0)
+        assert [json.loads(line.split('\t')[1]) for line in lines] == [{"Skewed.a": v} for v in values]
+        # compressed inputs cannot be read at an offset, and are only sampled if they are small
+        data = luigi.mock.MockFileSystem().get_all_data()
+        data['Skewed.gz.json'] = gzip.compress(data['Skewed.json'])
+        gzipped = luigi.mock.MockTarget('Skewed.gz.json', format=compression.text_format())
+        assert ra2mr.random_lines(gzipped, 100, 0) is None
+        assert len(ra2mr.random_lines(gzipped, 100, 2 ** 20)) == 100
+
+    def test_aggregate_pizzas_per_person(self):
+        querystring = "\\aggr_{Eats.name: count(Eats.pizza)} Eats;"
+        computed = self._evaluate(querystring)
+        assert len(computed) == 9
+
+        counts = {}
+        for line in computed:
+            relation, tuple = line.split('\t')
+            json_tuple = json.loads(tuple)
+            counts[json_tuple["Eats.name"]] = json_tuple["count(Eats.pizza)"]
+        assert counts["Dan"] == 5
+        assert counts["Amy"] == 2
+
+    def test_aggregate_prices_per_pizzeria(self):
+        querystring = "\\aggr_{pizzeria: min(price), max(price), avg(price), sum(price)} Serves;"
+        computed = self._evaluate(querystring)
+
+        pizzerias = {}
+        for line in computed:
+            relation, tuple = line.split('\t')
+            json_tuple = json.loads(tuple)
+            pizzerias[json_tuple["Serves.pizzeria"]] = json_tuple
+        assert pizzerias["Straw Hat"]["min(price)"] == 8
+        assert pizzerias["Straw Hat"]["max(price)"] == 9.25
+        assert abs(pizzerias["Straw Hat"]["avg(price)"] - 26.42 / 3) < 1e-6
+
+    def test_aggregate_flushes_partial_states(self):
+        querystring = "\\aggr_{count(1)} Eats;"
+        task = ra2mr.AggregateTask(querystring=querystring, exec_environment=ra2mr.ExecEnv.MOCK, max_groups=1)
+        luigi.build([task], local_scheduler=True)
+
+        f = task.output().open('r')
+        lines = [line for line in f]
+        f.close()
+        assert len(lines) == 1
+        assert json.loads(lines[0].split('\t')[1]) == {"count(1)": 20}
+
+    def _evaluate_sorted(self, querystring, order_by, limit=None):
+        raquery = radb.parse.one_statement_from_string(querystring)
+
+        task = ra2mr.sort_task_factory(raquery, order_by, limit, env=ra2mr.ExecEnv.MOCK)
+        luigi.build([task], local_scheduler=True)
+
+        f = task.output().open('r')
+        tuples = [json.loads(line.split('\t')[1]) for line in f]
+        f.close()
+        return tuples
+
+    def test_top_3_oldest_persons(self):
+        computed = self._evaluate_sorted("Person;", [("age", "desc")], 3)
+        assert [e["Person.name"] for e in computed] == ["Eli", "Cal", "Hil"]
+
+    def test_top_2_cheapest_mushroom_pizzerias(self):
+        computed = self._evaluate_sorted(r"\select_{pizza='mushroom'} Serves;", [("price", "asc"), ("pizzeria", "asc")], 2)
+        assert len(computed) == 2
+        assert computed[0]["Serves.price"] <= computed[1]["Serves.price"]
+
+    def test_sort_persons_by_age(self):
+        computed = self._evaluate_sorted("Person;", [("Person.age", "asc"), ("Person.name", "desc")])
+        assert [e["Person.age"] for e in computed] == [13, 16, 18, 21, 21, 24, 30, 33, 45]
+        assert [e["Person.name"] for e in computed][3:5] == ["Fay", "Ben"]
+
+    def test_sort_ranges_to_reducers_in_order(self):
+        # hadoop's HashPartitioner sends each map output key to a reducer, whose part files are concatenated
+        task = ra2mr.SortTask(querystring="Person;", order_by=[("Person.age", "asc")], partitions=4,
+                              exec_environment=ra2mr.ExecEnv.MOCK)
+        task.init_local()
+        serialize = luigi.contrib.hadoop.DataInterchange[task.data_interchange_format]['internal_serialize']
+        reducers = [[] for i in range(4)]
+        for line in luigi.mock.MockTarget('Person.json').open('r'):
+            for key, value in task.mapper(line.rstrip('\n')):
+                reducers[ra2mr.text_hash(serialize(key)) % 4].append((key, value))
+        assert sum(1 for pairs in reducers if pairs) > 1
+
+        ages = []
+        for pairs in reducers:
+            for key in sorted(set(k for k, v in pairs)):
+                for relation, tuple in task.reducer(key, [v for k, v in pairs if k == key]):
+                    ages.append(json.loads(tuple)["Person.age"])
+        assert ages == [13, 16, 18, 21, 21, 24, 30, 33, 45]
+
+    def test_sort_splits_key_ordered_input(self):
+        # on an input ordered by the sort key, the first tuples would put all split points in its head
+        with luigi.mock.MockTarget('Ordered.json').open('w') as f:
+            for i in range(1000):
+                f.write('Ordered\t' + json.dumps({"Ordered.a": i}) + '\n')
+        for scan_bytes in [0, 2 ** 20]:
+            task = ra2mr.SortTask(querystring="Ordered;", order_by=[("Ordered.a", "asc")], partitions=4, sample=100,
+                                  sample_scan_bytes=scan_bytes, exec_environment=ra2mr.ExecEnv.MOCK)
+            task.init_local()
+            counts = {}
+            for line in luigi.mock.MockTarget('Ordered.json').open('r'):
+                for key, value in task.mapper(line.rstrip('\n')):
+                    counts[key] = counts.get(key, 0) + 1
+            assert len(counts) == 4 and max(counts.values()) < 500
+
+    def test_limit_pushed_into_scan(self):
+        raquery = radb.parse.one_statement_from_string(r"\select_{gender='male'} Person;")
+        task = ra2mr.sort_task_factory(raquery, [], 2, env=ra2mr.ExecEnv.MOCK)
+        assert isinstance(task, ra2mr.LimitScanTask)
+        computed = self._evaluate_sorted(r"\select_{gender='male'} Person;", [], 2)
+        assert len(computed) == 2
+        assert all(e["Person.gender"] == "male" for e in computed)
+
+    def test_first_rows_person_join_eats(self):
+        raquery = radb.parse.one_statement_from_string("Person \\join_{Person.name = Eats.name} Eats;")
+        assert len(list(ra2mr.first_rows(raquery, env=ra2mr.ExecEnv.MOCK))) == 20
+        assert len(list(ra2mr.first_rows(raquery, limit=3, env=ra2mr.ExecEnv.MOCK))) == 3
+
+    def test_first_rows_oldest_pizza_eaters(self):
+        raquery = radb.parse.one_statement_from_string(
+            r"\project_{Person.name, Person.age} (Person \join_{Person.name = Eats.name} Eats);")
+        computed = [e for relation, e in ra2mr.first_rows(raquery, [("Person.age", "desc")], 2, ra2mr.ExecEnv.MOCK)]
+        assert [e["Person.name"] for e in computed] == ["Eli", "Cal"]
+
+    def test_index_seek(self):
+        for kind in ("hash", "sorted"):
+            prepareMockFileSystem()
+            assert luigi.build([ra2mr.IndexTask(relation="Person", attribute="age", kind=kind,
+                                                exec_environment=ra2mr.ExecEnv.MOCK)], local_scheduler=True)
+            raquery = radb.parse.one_statement_from_string(r"\select_{age=21 and gender='female'} Person;")
+            assert isinstance(ra2mr.task_factory(raquery, env=ra2mr.ExecEnv.MOCK), ra2mr.IndexSeekTask)
+            self._check(r"\select_{age=21 and gender='female'} Person;", [self.person_fay])
+
+            # the relation changes: the index is rebuilt before it is used
+            data = luigi.mock.MockTarget('Person.json').fs.get_data('Person.json').decode('utf-8')
+            with luigi.mock.MockTarget('Person.json').open('w') as f:
+                f.write(data + 'Person\t{"Person.name": "Joy", "Person.age": 21, "Person.gender": "female"}\n')
+            luigi.mock.MockFileSystem().remove('tmp1.tmp')
+            computed = self._evaluate(r"\select_{age=21} Person;")
+            assert sorted(json.loads(line.split('\t')[1])["Person.name"] for line in computed) == ["Ben", "Fay", "Joy"]
+
+    def test_zone_map_skips_blocks(self):
+        assert luigi.build([ra2mr.ZoneMapTask(relation="Person", block_rows=2, exec_environment=ra2mr.ExecEnv.MOCK)],
+                           local_scheduler=True)
+        task = ra2mr.task_factory(radb.parse.one_statement_from_string(r"\select_{age=45} Person;"),
+                                  env=ra2mr.ExecEnv.MOCK)
+        task.init_local()
+        ranges = task.input_ranges(task.input()[0])
+        assert sum(end - start for start, end in ranges) < ra2mr.target_size(task.input()[0]) / 2
+
+        self._check(r"\select_{age=45} Person;", ['{"Person.name": "Eli", "Person.age": 45, "Person.gender": "male"}'])
+        luigi.mock.MockFileSystem().remove('tmp1.tmp')
+        self._check(r"\select_{name='Amy' and gender='female'} Person;", [self.person_amy])
+        luigi.mock.MockFileSystem().remove('tmp1.tmp')
+        self._check(r"\select_{gender='female'} Person;", [self.person_amy, self.person_fay, self.person_hil])
+
+    def test_compressed_intermediates(self):
+        querystring = "\\project_{P.name, E.pizza} (\\select_{P.gender='female'} \\rename_{P:*} Person \\join_{P.name = E.name} \\rename_{E:*} Eats);"
+        expected = self._evaluate(querystring)
+        config = luigi.configuration.get_config()
+        config.set('minihive', 'compression', 'gzip')
+        try:
+            prepareMockFileSystem()
+            computed = self._evaluate(querystring)
+            tmpfiles = [path for path in luigi.mock.MockFileSystem().listdir('') if path.endswith('.tmp')]
+        finally:
+            config.set('minihive', 'compression', '')
+        assert sorted(computed) == sorted(expected)
+        assert len(tmpfiles) > 1
+        for path in tmpfiles:
+            assert luigi.mock.MockFileSystem().get_data(path).startswith(compression.MAGIC["gzip"])
+
+    def test_view_refresh_reads_appended_rows(self):
+        querystring = "\\project_{P.name, E.pizza} (\\rename_{P:*} Person \\join_{P.name = E.name} \\rename_{E:*} Eats);"
+        task = ra2mr.ViewTask(name="PizzaView", querystring=querystring, exec_environment=ra2mr.ExecEnv.MOCK)
+        fs = luigi.mock.MockFileSystem()
+
+        def view_rows():
+            return sorted(line.rstrip('\n').split('\t')[1] for line in ra2mr.read_lines(task.output()[1]))
+
+        def query_rows():
+            for path in fs.listdir(''):
+                if path.endswith('.tmp'):
+                    fs.remove(path)
+            return sorted(json.dumps(json.loads(line.split('\t')[1])) for line in self._evaluate(querystring))
+
+        assert luigi.build([task], local_scheduler=True)
+        assert view_rows() == query_rows()
+
+        for relation, rows in [("Person", ['{"Person.name": "Joe", "Person.age": 20, "Person.gender": "male"}']),
+                               ("Eats", ['{"Eats.name": "Joe", "Eats.pizza": "cheese"}',
+                                         '{"Eats.name": "Amy", "Eats.pizza": "mushroom"}'])]:
+            data = fs.get_data(relation + ".json").decode('utf-8')
+            with luigi.mock.MockTarget(relation + ".json").open('w') as f:
+                f.write(data + "".join(relation + "\t" + row + "\n" for row in rows))
+        assert not task.complete()
+
+        assert luigi.build([task], local_scheduler=True)
+        assert task.complete()
+        assert view_rows() == query_rows()
+        assert len(view_rows()) == len(set(view_rows()))
+        assert task.load().counts[json.dumps({"P.name": "Amy", "E.pizza": "mushroom"})] == 2
+
+    def test_adaptive_joins(self):
+        querystring = "\\project_{P.name, S.pizzeria} ((\\rename_{P:*} Person \\join_{P.name = E.name} " \
+                      "\\rename_{E:*} Eats) \\join_{E.pizza = S.pizza} \\select_{S.price > 9} \\rename_{S:*} Serves);"
+        expected = sorted(json.dumps(json.loads(line.split('\t')[1])) for line in self._evaluate(querystring))
+
+        fs = luigi.mock.MockFileSystem()
+        for broadcast_bytes in [32 * 1024 * 1024, 0]:
+            for path in fs.listdir(''):
+                if '.tmp' in path:
+                    fs.remove(path)
+            task = ra2mr.AdaptiveTask(querystring=querystring, broadcast_bytes=broadcast_bytes, bytes_per_reducer=256,
+                                      exec_environment=ra2mr.ExecEnv.MOCK)
+            assert luigi.build([task], local_scheduler=True)
+            computed = sorted(json.dumps(json.loads(line.split('\t')[1])) for line in ra2mr.read_lines(task.output()))
+            assert computed == expected
+
+            # the joins are planned from the rows counted by the jobs, not by reading their outputs
+            counted = [path[:-len(".rows")] for path in fs.listdir('') if path.endswith('.tmp.rows')]
+            assert len(counted) >= 3
+            for path in counted:
+                target = luigi.mock.MockTarget(path)
+                assert ra2mr.counted_rows(target, ra2mr.ExecEnv.MOCK) == len(list(ra2mr.read_lines(target)))
@@ -0,0 +1,92 @@
+import argparse
+import json
+
+import luigi
+
+'''
+Materialized views over append-only relations: the result of a saved query is
+kept in NAME.json, and the manifest NAME.view records the query, the size in
+bytes (high-water mark) each relation had when the view was last refreshed and
+the number of derivations of each result tuple.
+
+A refresh only evaluates the rows appended since (see ra2mr.ViewTask): for a
+query over relations R1, ..., Rn, the new derivations are the union over i of
+R1 (old rows) x ... x delta Ri x ... x Rn (all rows), which ra2mr.delta_stream
+evaluates with joins built on their smaller side, usually the delta. Operators
+keep duplicates, DISTINCT is applied once, on the counts: a tuple joins the
+stored output when its count leaves 0. Selections, projections, renamings,
+joins and cross products are maintained, other operators are not.
+
+The output is appended to, and the manifest, which records the size of the
+output, is written last: a refresh interrupted in between is undone by the
+next one, which cuts the output back to its recorded size. Views are created
+and refreshed with
+
+    python views.py --env LOCAL GERMANS "select distinct * from CUSTOMER, NATION where ..."
+
+A relation that shrank (it was rewritten, not appended to) is read again from
+the start, the view is rebuilt.
+'''
+
+
+def filename(name):
+    return name + ".view"
+
+
+def output_filename(name):
+    return name + ".json"
+
+
+class View(object):
+    '''
+    The state of a view: its query (a relational algebra string), the byte offset
+    up to which each relation has been read, the size of the output and the
+    count of every result tuple (keyed by its json encoding).
+    '''
+
+    def __init__(self, name, querystring, marks=None, output_size=0, counts=None):
+        self.name = name
+        self.querystring = querystring
+        self.marks = marks if marks is not None else {}
+        self.output_size = output_size
+        self.counts = counts if counts is not None else {}
+
+    def merge(self, derivations):
+        """counts the (relation, tuple) derivations, returns the output lines of the tuples new to the view"""
+        lines = []
+        for relation, json_tuple in derivations:
+            k = json.dumps(json_tuple)
+            count = self.counts.get(k, 0)
+            self.counts[k] = count + 1
+            if count == 0:
+                lines.append(relation + "\t" + k + "\n")
+        return lines
+
+    def dumps(self):
+        """two lines: a header, which can be checked without reading the counts, and the counts"""
+        header = {"name": self.name, "query": self.querystring, "marks": self.marks,
+                  "output_size": self.output_size}
+        return json.dumps(header) + "\n" + json.dumps(self.counts) + "\n"
+
+    @classmethod
+    def loads(cls, s):
+        header, counts = s.split("\n", 1)
+        d = json.loads(header)
+        return cls(d["name"], d["query"], d["marks"], d["output_size"], json.loads(counts))
+
+
+if __name__ == "__main__":
+    import miniHive  # ra2mr imports this module, the tool plans queries and needs its tasks
+    import ra2mr
+
+    parser = argparse.ArgumentParser(description='Creating and refreshing miniHive materialized views.')
+    parser.add_argument('--env', choices=['LOCAL'], default='LOCAL',
+                        help='execution environment, local only (HDFS files cannot be read at an offset)')
+    parser.add_argument('name', help='the view, stored in NAME.json')
+    parser.add_argument('query', help='SQL query (select, project, join)')
+
+    args = parser.parse_args()
+    env = ra2mr.ExecEnv.LOCAL
+    ra = miniHive.plan(args.query, miniHive.data_dictionary())
+    task = ra2mr.ViewTask(name=args.name, querystring=str(ra) + ";", exec_environment=env)
+    luigi.build([task], local_scheduler=True)
@@ -0,0 +1,152 @@
+import argparse
+import json
+
+import luigi
+
+from bloom import BloomFilter
+import index
+
+'''
+Zone maps: a sidecar file per relation (CUSTOMER.zones for CUSTOMER.json) that
+cuts the relation into blocks of block_rows lines and records, for each block,
+its byte range, the min and max of its integer attributes and a small Bloom
+filter of the values of its string attributes. Scans with selections
+attr = literal read only the blocks that may hold a match (see
+ra2mr.RelAlgQueryTask.input_ranges); the lines of the other blocks are neither
+read nor decoded. Relations stored in key order thus skip nearly all blocks
+for a key lookup.
+
+Values are compared the way selections compare them (see ra2mr.cmp): on their
+letters and digits. An integer matches a literal with the same digits whatever
+its sign, so a block may match n if n or -n lies between its min and max.
+
+Like indexes (see index.py), zone maps record the version of the relation they
+were built from and are rebuilt by ra2mr.ZoneMapTask once it has changed. They
+are created with
+
+    python zonemap.py CUSTOMER PARTSUPP
+'''
+
+
+def filename(relation):
+    return relation + ".zones"
+
+
+def new_block(begin):
+    return {"begin": begin, "end": begin, "rows": 0, "min": {}, "max": {}, "bloom": {}}
+
+
+class ZoneMap(object):
+    '''
+    The blocks of a relation, as a list of dicts: byte range [begin, end), rows,
+    min and max per integer attribute and Bloom filter (dumped) per string
+    attribute. Attributes with values of mixed or other types are not recorded,
+    a block may hold any of their values.
+    '''
+
+    def __init__(self, relation, fingerprint=None, block_rows=1000, blocks=None):
+        self.relation = relation
+        self.fingerprint = fingerprint
+        self.block_rows = block_rows
+        self.blocks = blocks if blocks is not None else []
+        self.filters = {}
+
+    @classmethod
+    def build(cls, relation, fingerprint, records, size, block_rows=1000, error_rate=0.01):
+        """the zone map of the (offset, tuple) pairs of a relation of size bytes"""
+        zones = cls(relation, fingerprint, block_rows)
+        block, ints, strings = None, {}, {}
+        for offset, json_tuple in records:
+            if block is None or block["rows"] == block_rows:
+                if block is not None:
+                    zones.close_block(block, offset, ints, strings, error_rate)
+                block, ints, strings = new_block(offset), {}, {}
+            block["rows"] += 1
+            for attribute, value in json_tuple.items():
+                kind = "int" if isinstance(value, int) and not isinstance(value, bool) else \
+                    "string" if isinstance(value, str) else "other"
+                if block["rows"] == 1:
+                    ints[attribute] = [] if kind == "int" else None
+                    strings[attribute] = set() if kind == "string" else None
+                if ints.get(attribute) is not None:
+                    if kind == "int":
+                        ints[attribute].append(value)
+                    else:
+                        ints[attribute] = None
+                if strings.get(attribute) is not None:
+                    if kind == "string":
+                        strings[attribute].add(index.key(value))
+                    else:
+                        strings[attribute] = None
+        if block is not None:
+            zones.close_block(block, size, ints, strings, error_rate)
+        return zones
+
+    def close_block(self, block, end, ints, strings, error_rate):
+        block["end"] = end
+        for attribute, values in ints.items():
+            if values:
+                block["min"][attribute] = min(values)
+                block["max"][attribute] = max(values)
+        for attribute, keys in strings.items():
+            if keys:
+                bloom = BloomFilter.for_capacity(len(keys), error_rate)
+                for k in keys:
+                    bloom.add(k)
+                block["bloom"][attribute] = bloom.dumps()
+        self.blocks.append(block)
+
+    def bloom(self, i, attribute):
+        if (i, attribute) not in self.filters:
+            self.filters[(i, attribute)] = BloomFilter.loads(self.blocks[i]["bloom"][attribute])
+        return self.filters[(i, attribute)]
+
+    def may_match(self, i, attribute, literal):
+        """False if no tuple of block i can have attribute (qualified) equal to the literal (its text)"""
+        block = self.blocks[i]
+        k = index.key(literal)
+        if attribute in block["bloom"]:
+            return k in self.bloom(i, attribute)
+        if attribute in block["min"]:
+            if not k.isdigit():
+                return False
+            n = int(k)
+            return block["min"][attribute] <= n <= block["max"][attribute] or \
+                block["min"][attribute] <= -n <= block["max"][attribute]
+        return True
+
+    def ranges(self, terms):
+        """the byte ranges of the blocks that may hold tuples satisfying all (attribute, literal) terms,
+            adjacent blocks merged"""
+        ranges = []
+        for i, block in enumerate(self.blocks):
+            if all(self.may_match(i, attribute, literal) for attribute, literal in terms):
+                if ranges and ranges[-1][1] == block["begin"]:
+                    ranges[-1][1] = block["end"]
+                else:
+                    ranges.append([block["begin"], block["end"]])
+        return [tuple(r) for r in ranges]
+
+    def dumps(self):
+        """a header line, which can be checked without reading the blocks, and a line per block"""
+        header = {"relation": self.relation, "fingerprint": self.fingerprint, "block_rows": self.block_rows}
+        return "".join(json.dumps(e) + "\n" for e in [header] + self.blocks)
+
+    @classmethod
+    def loads(cls, s):
+        lines = s.splitlines()
+        header = json.loads(lines[0])
+        return cls(header["relation"], header["fingerprint"], header["block_rows"],
+                   [json.loads(line) for line in lines[1:]])
+
+
+if __name__ == "__main__":
+    import ra2mr  # ra2mr imports this module, the tool needs its tasks
+
+    parser = argparse.ArgumentParser(description='Creating the zone maps of miniHive relations.')
+    parser.add_argument('--block-rows', type=int, default=1000, help='lines per block')
+    parser.add_argument('relations', nargs='+', help='relations to map')
+
+    args = parser.parse_args()
+    luigi.build([ra2mr.ZoneMapTask(relation=relation, block_rows=args.block_rows, exec_environment=ra2mr.ExecEnv.LOCAL)
+                 for relation in args.relations], local_scheduler=True)